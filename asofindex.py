@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# As-of index of an elset table: the table <table>_asof of intervals (NORAD_CAT_ID, VALID_FROM, VALID_TO, GP_ID).
+# For each object and each EPOCH, GP_ID is the elset published last, valid from its EPOCH until the next EPOCH of the object
+# (VALID_TO is NULL for the newest elset). The table is clustered by (NORAD_CAT_ID, VALID_FROM),
+# so the newest elset of an object at time T is one index probe, and a catalog at time T is one probe per object
+# instead of a GROUP BY over the whole elset table.
+#
+# json2sqlite3.py --asof creates the index, and json2sqlite3.py and update.py keep it up to date once it exists.
+# VALID_FROM and VALID_TO are in the layout of EPOCH (text or microseconds, see elsetschema.py).
+#
+# Usage: asofindex.py DATABASE [TABLE]            (build or rebuild the index)
+#        asofindex.py -t 2020-10-10 DATABASE       (number of objects at the time, and the time of the query)
+
+import os
+import sys
+import time
+import argparse
+import sqlite3
+from dateutil.parser import parse
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+import elsetschema
+
+create_table = '''CREATE TABLE IF NOT EXISTS {0}_asof (
+    NORAD_CAT_ID integer, VALID_FROM {1}, VALID_TO {1}, GP_ID integer, PRIMARY KEY (NORAD_CAT_ID, VALID_FROM)) WITHOUT ROWID'''
+
+# A new elset. Of the elsets with the same EPOCH, the one published last (the largest GP_ID) is used
+upsert_interval = '''INSERT INTO {0}_asof VALUES (?, ?, NULL, ?)
+    ON CONFLICT (NORAD_CAT_ID, VALID_FROM) DO UPDATE SET GP_ID = max(GP_ID, excluded.GP_ID)'''
+
+# The end of the interval of a new elset, and of the interval before it
+update_next = '''UPDATE {0}_asof SET VALID_TO = (SELECT MIN(VALID_FROM) FROM {0}_asof WHERE NORAD_CAT_ID = ?1 AND VALID_FROM > ?2)
+    WHERE NORAD_CAT_ID = ?1 AND VALID_FROM = ?2'''
+update_previous = '''UPDATE {0}_asof SET VALID_TO = ?2
+    WHERE NORAD_CAT_ID = ?1 AND VALID_FROM = (SELECT MAX(VALID_FROM) FROM {0}_asof WHERE NORAD_CAT_ID = ?1 AND VALID_FROM < ?2)'''
+
+# All the objects of the index, by skipping from one NORAD_CAT_ID to the next in the primary key
+all_objects = '''WITH RECURSIVE ids(n) AS (SELECT MIN(NORAD_CAT_ID) FROM {0}_asof
+    UNION ALL SELECT (SELECT MIN(NORAD_CAT_ID) FROM {0}_asof WHERE NORAD_CAT_ID > n) FROM ids WHERE n IS NOT NULL)
+    SELECT n FROM ids WHERE n IS NOT NULL'''
+
+# Columns of the rows passed to update()
+COLUMNS = ['NORAD_CAT_ID', 'EPOCH', 'GP_ID']
+
+def has_index(con, table):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table + '_asof',)).fetchone() is not None
+
+# Creates the index of the table (empty)
+def create(cur, table):
+    cur.execute(create_table.format(table, 'integer' if elsetschema.is_compact(cur, table) else 'timestamp'))
+
+# Adds the elsets (NORAD_CAT_ID, EPOCH, GP_ID as stored in the table) to the index.
+# Elsets already in the index are ignored, so the rows may include duplicates.
+def update(cur, table, rows):
+    rows = [row for row in rows if row[0] is not None and row[1] is not None]
+    if len(rows) == 0:
+        return
+    cur.executemany(upsert_interval.format(table), rows)
+    keys = sorted(set((row[0], row[1]) for row in rows))
+    cur.executemany(update_next.format(table), keys)
+    cur.executemany(update_previous.format(table), keys)
+
+# Builds the index from all the elsets of the table, in one transaction, so readers see the old index until it is committed.
+# Runs in the transaction of the caller if one is open (committed by the caller), otherwise in its own
+def rebuild(cur, table):
+    own = not cur.connection.in_transaction
+    # sqlite3 doesn't begin a transaction before DDL, so the DROP would be committed alone
+    if own:
+        cur.execute('BEGIN IMMEDIATE')
+    try:
+        cur.execute('DROP TABLE IF EXISTS {}_asof'.format(table))
+        create(cur, table)
+        cur.execute('''INSERT INTO {0}_asof SELECT NORAD_CAT_ID, EPOCH, NULL, MAX(GP_ID) FROM {0}
+            WHERE NORAD_CAT_ID IS NOT NULL AND EPOCH IS NOT NULL GROUP BY NORAD_CAT_ID, EPOCH ORDER BY NORAD_CAT_ID, EPOCH'''.format(table))
+        cur.execute('''UPDATE {0}_asof SET VALID_TO = (SELECT MIN(b.VALID_FROM) FROM {0}_asof b
+            WHERE b.NORAD_CAT_ID = {0}_asof.NORAD_CAT_ID AND b.VALID_FROM > {0}_asof.VALID_FROM)'''.format(table))
+        if own:
+            cur.execute('COMMIT')
+    except BaseException:
+        if own:
+            cur.execute('ROLLBACK')
+        raise
+
+# SQL of the intervals valid at a time (the first parameter, in the layout of EPOCH): the newest elset with EPOCH <= the time
+# of each object. objects: SQL selecting the NORAD_CAT_IDs (None: all the objects)
+def snapshot_query(table, objects = None):
+    if objects is None:
+        objects = all_objects.format(table)
+    return '''SELECT a.NORAD_CAT_ID, a.VALID_FROM, a.VALID_TO, a.GP_ID FROM ({1}) o CROSS JOIN {0}_asof a ON a.NORAD_CAT_ID = o.n
+        AND a.VALID_FROM = (SELECT MAX(VALID_FROM) FROM {0}_asof WHERE NORAD_CAT_ID = o.n AND VALID_FROM <= ?)'''.format(table, objects)
+
+# The intervals (NORAD_CAT_ID, VALID_FROM, VALID_TO, GP_ID) valid at t (datetime) of all the objects or the given objects
+def snapshot(con, table, t, norad_cat_ids = None):
+    objects = None
+    if norad_cat_ids is not None:
+        objects = 'SELECT {} AS n'.format(' AS n UNION ALL SELECT '.join(str(int(x)) for x in norad_cat_ids)) if len(norad_cat_ids) > 0 else 'SELECT NULL AS n'
+    return con.execute(snapshot_query(table, objects), (elsetschema.to_param(t, elsetschema.is_compact(con, table)),)).fetchall()
+
+def main():
+    logger = setup_logger('asofindex')
+    metrics = get_metrics('asofindex')
+
+    parser = argparse.ArgumentParser(description='Build the as-of index (TABLE_asof) of an elset table, or query it.')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 database created by json2sqlite3.py')
+    parser.add_argument('TABLE', type=str, nargs='?', default='elset', help='Table name. Default: elset')
+    parser.add_argument('-t', '--time', type=str, help='Count the objects at the time (UTC) with the index instead of building it')
+    parser.add_argument('-d', '--drop', action='store_true', help='Drop the index')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.DATABASE):
+        logger.critical('error: {} not found'.format(args.DATABASE))
+        sys.exit(1)
+
+    con = sqlite3.connect(args.DATABASE)
+    cur = con.cursor()
+    table = args.TABLE
+
+    if args.time is not None:
+        if not has_index(con, table):
+            logger.critical('error: {} has no table {}_asof'.format(args.DATABASE, table))
+            sys.exit(1)
+        t = parse(args.time)
+        starttime = time.monotonic()
+        rows = snapshot(con, table, t)
+        logger.info('{} objects at {} ({:.3f} sec)'.format(len(rows), t, time.monotonic() - starttime))
+    elif args.drop:
+        cur.execute('DROP TABLE IF EXISTS {}_asof'.format(table))
+        con.commit()
+        logger.info('{}_asof dropped'.format(table))
+    else:
+        with metrics.timer('build'):
+            rebuild(cur, table)
+            con.commit()
+        nrows = cur.execute('SELECT COUNT(*) FROM {}_asof'.format(table)).fetchone()[0]
+        logger.info('{}_asof: {} intervals'.format(table, nrows))
+        metrics.inc('intervals', nrows)
+    con.close()
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('asofindex', main)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import argparse
+import sqlite3
+import subprocess
+import tempfile
+import random
+import resource
+import platform
+from datetime import datetime
+
+# Directory of the scripts
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def script(name):
+    return os.path.join(ROOT, name)
+
+# Run a command in a child process. Return elapsed time (sec) and peak RSS (MB) of the child.
+# The peak RSS includes the memory of this process at fork, so this process shouldn't import large modules.
+# The child runs in workdir (a temporary directory), where its logs and metrics are written,
+# so that the runs are not taken for real ones in log/ and by the Prometheus textfile collector.
+def measure(cmd, workdir, stdout = subprocess.DEVNULL):
+    logdir = os.path.join(workdir, 'log')
+    os.makedirs(logdir, exist_ok = True)
+    env = dict(os.environ, METRICS_FILE = os.path.join(logdir, 'metrics.jsonl'), METRICS_TEXTFILE_DIR = logdir,
+        PYTHONPATH = os.pathsep.join([ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    starttime = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout = stdout, stderr = subprocess.DEVNULL, cwd = workdir, env = env)
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    elapsed = time.monotonic() - starttime
+    # os.waitstatus_to_exitcode() is Python 3.9+ (the cron job runs Python 3.8)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if proc.returncode != 0:
+        raise RuntimeError('{} failed ({})'.format(' '.join(cmd), proc.returncode))
+    # ru_maxrss is in KB on Linux
+    return elapsed, rusage.ru_maxrss / 1024
+
+def count_rows(dbfile, table):
+    with sqlite3.connect(dbfile) as con:
+        return con.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+# Recorded with each result, so that results of different versions and machines can be compared
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, cwd = ROOT).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'time': datetime.now().isoformat(timespec = 'seconds'), 'commit': commit,
+        'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+def report(results, output = None):
+    for r in results:
+        print('{:<14} {:<12} {:8.2f} sec {:8.1f} MB {:10.0f} rows/sec'.format(
+            r['benchmark'], r['mode'], r['elapsed'], r['max_rss_mb'], r['rows_per_sec']))
+    if output is not None:
+        meta = metadata()
+        with open(output, 'a') as fp:
+            for r in results:
+                fp.write(json.dumps(dict(meta, **r)) + '\n')
+
+# json2sqlite3.py: pandas (the whole file in memory) vs streaming vs bulk-load
+def bench_json2sqlite3(files, extra_args = []):
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode, option in [('pandas', ['-p']), ('stream', []), ('bulk', ['--bulk'])]:
+            dbfile = os.path.join(tmpdir, mode + '.sqlite3')
+            cmd = [sys.executable, script('json2sqlite3.py')] + option + extra_args + files + [dbfile, 'elset']
+            elapsed, max_rss = measure(cmd, tmpdir)
+            rows = count_rows(dbfile, 'elset')
+            results.append({'benchmark': 'json2sqlite3', 'mode': mode, 'files': len(files), 'rows': rows,
+                'elapsed': elapsed, 'max_rss_mb': max_rss, 'rows_per_sec': rows / elapsed})
+    return results
+
+# json2tle.py, json2csv.py: pandas vs streaming. The inputs are linked into a temporary directory,
+# as the outputs are written next to them. 'startup' is the time to convert an empty file.
+def bench_convert(files):
+    from gpjson import iter_records
+    rows = sum(sum(1 for record in iter_records(f)) for f in files)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        links = []
+        for i, f in enumerate(files):
+            links.append(os.path.join(tmpdir, '{}-{}'.format(i, os.path.basename(f))))
+            os.symlink(f, links[-1])
+        empty = os.path.join(tmpdir, 'empty.json')
+        with open(empty, 'w') as fp:
+            fp.write('[]')
+        for name in ['json2tle.py', 'json2csv.py']:
+            for mode, option in [('pandas', ['-p']), ('stream', [])]:
+                elapsed, max_rss = measure([sys.executable, script(name)] + option + links, tmpdir)
+                results.append({'benchmark': name[:-3], 'mode': mode, 'files': len(files), 'rows': rows,
+                    'elapsed': elapsed, 'max_rss_mb': max_rss, 'rows_per_sec': rows / elapsed})
+            elapsed, max_rss = measure([sys.executable, script(name), empty], tmpdir)
+            results.append({'benchmark': name[:-3], 'mode': 'startup', 'files': 1, 'rows': 0,
+                'elapsed': elapsed, 'max_rss_mb': max_rss, 'rows_per_sec': 0.0})
+    return results
+
+# Fill an (empty) elset table with synthetic records in GP_ID order, i.e. in the order they are
+# published: consecutive records belong to different objects, like the real gp_history.
+def fill_synthetic(dbfile, table, rows, objects):
+    with sqlite3.connect(dbfile) as con:
+        con.execute('''INSERT INTO {} (CREATION_DATE, EPOCH, OBJECT_ID, MEAN_MOTION, ECCENTRICITY, INCLINATION, RA_OF_ASC_NODE,
+            ARG_OF_PERICENTER, MEAN_ANOMALY, NORAD_CAT_ID, REV_AT_EPOCH, BSTAR, SEMIMAJOR_AXIS, PERIOD, APOAPSIS, PERIAPSIS, GP_ID)
+            WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < ?)
+            SELECT strftime('%Y-%m-%d %H:%M:%f', 2451545.0 + i * 3650.0 / ?1),
+                strftime('%Y-%m-%d %H:%M:%f', 2451545.0 + i * 3650.0 / ?1 - 0.25),
+                '2000-001A', 15.0 + (i % 97) / 1000.0, 0.001, 51.6, i % 360, (i * 7) % 360, (i * 13) % 360,
+                (i * 7919) % ?2 + 1, i % 100000, 0.0001, 6778.0, 92.0, 420.0, 410.0, i
+            FROM seq'''.format(table), (rows, objects))
+
+# Read the history of random objects (SELECT * ... WHERE NORAD_CAT_ID = ? ORDER BY EPOCH)
+def query_histories(dbfile, table, ids):
+    starttime = time.monotonic()
+    rows = 0
+    for norad_cat_id in ids:
+        # A new connection for each object, so that the page cache of SQLite doesn't help
+        with sqlite3.connect(dbfile) as con:
+            rows += len(con.execute('SELECT * FROM {} WHERE NORAD_CAT_ID = ? ORDER BY EPOCH'.format(table), (norad_cat_id,)).fetchall())
+    return time.monotonic() - starttime, rows
+
+# json2sqlite3.py: table keyed on GP_ID vs clustered by (NORAD_CAT_ID, EPOCH, GP_ID)
+def bench_layout(rows, objects, queries, directory = None):
+    results = []
+    ids = random.Random(0).sample(range(1, objects + 1), min(queries, objects))
+    with tempfile.TemporaryDirectory(dir = directory) as tmpdir:
+        empty = os.path.join(tmpdir, 'empty.json')
+        with open(empty, 'w') as fp:
+            fp.write('[]')
+        for mode, option in [('gp_id', []), ('clustered', ['-c'])]:
+            dbfile = os.path.join(tmpdir, mode + '.sqlite3')
+            # json2sqlite3.py creates the table and its indexes
+            measure([sys.executable, script('json2sqlite3.py')] + option + [empty, dbfile, 'elset'], tmpdir)
+            starttime = time.monotonic()
+            fill_synthetic(dbfile, 'elset', rows, objects)
+            load = time.monotonic() - starttime
+            elapsed, nrows = query_histories(dbfile, 'elset', ids)
+            results.append({'benchmark': 'layout', 'mode': mode, 'rows': rows, 'objects': objects, 'queries': len(ids),
+                'load_elapsed': load, 'db_bytes': os.path.getsize(dbfile), 'rows_read': nrows,
+                'elapsed': elapsed, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'rows_per_sec': nrows / elapsed})
+    return results
+
+# Child processes of the pipeline benchmark, run with `python -c`
+READ_CODE = '''import sys
+from gpjson import iter_records
+for f in sys.argv[1:]:
+    for record in iter_records(f):
+        pass
+'''
+
+DEDUP_CODE = '''import sys
+from gpjson import iter_batches
+from gpdedup import Deduplicator
+dedup = Deduplicator()
+for f in sys.argv[1:]:
+    for batch in iter_batches(f, ['GP_ID'], 100000):
+        dedup.filter(f, [row[0] for row in batch])
+'''
+
+QUERY_CODE = '''import sys, random
+from elsetdb import ElsetDB
+db = ElsetDB(sys.argv[1])
+ids = random.Random(0).sample(range(1, int(sys.argv[2]) + 1), min(100, int(sys.argv[2])))
+db.get_elsets(ids, columns = ['MEAN_MOTION', 'ECCENTRICITY'])
+db.get_elsets(ids, '2005-01-01', '2006-01-01')
+db.latest_as_of('2009-12-31', lookback = 30)
+'''
+
+# Each stage of the pipeline on synthetic data: read, dedup, convert, load and query
+def bench_pipeline(rows, objects, files, overlap, duplicates, nulls, suffix, directory = None):
+    results = []
+
+    def add(benchmark, mode, cmd, nrows, stdout = subprocess.DEVNULL):
+        elapsed, max_rss = measure(cmd, tmpdir, stdout)
+        results.append({'benchmark': benchmark, 'mode': mode, 'files': files, 'rows': nrows,
+            'elapsed': elapsed, 'max_rss_mb': max_rss, 'rows_per_sec': nrows / elapsed})
+
+    python = sys.executable
+    with tempfile.TemporaryDirectory(dir = directory) as tmpdir:
+        # gengp.py prints '<file>: <n> records' for each file
+        listfile = os.path.join(tmpdir, 'files.txt')
+        with open(listfile, 'w') as fp:
+            add('generate', suffix[1:], [python, script('gengp.py'), '-n', str(rows), '--objects', str(objects), '-f', str(files),
+                '--overlap', str(overlap), '-d', str(duplicates), '--nulls', str(nulls), '-l', '1',
+                os.path.join(tmpdir, 'gp' + suffix)], rows, fp)
+        with open(listfile) as fp:
+            generated = [line.rsplit(': ', 1) for line in fp.read().splitlines()]
+        jsonfiles = [f for f, n in generated]
+        nrecords = sum(int(n.split()[0]) for f, n in generated)
+        add('read', 'iter_records', [python, '-c', READ_CODE] + jsonfiles, nrecords)
+        add('dedup', 'bitmap', [python, '-c', DEDUP_CODE] + jsonfiles, nrecords)
+
+        parquetfile = os.path.join(tmpdir, 'out.parquet')
+        add('convert', 'parquet', [python, script('json2parquet.py')] + jsonfiles + [parquetfile], nrecords)
+        add('convert', 'parquet-part', [python, script('json2parquet.py'), '-p'] + jsonfiles + [os.path.join(tmpdir, 'part')], nrecords)
+        add('convert', 'csv', [python, script('json2csv.py')] + jsonfiles, nrecords)
+        add('convert', 'tle', [python, script('json2tle.py')] + jsonfiles, nrecords)
+
+        for mode, option, inputs in [('pandas', ['-p'], jsonfiles), ('stream', [], jsonfiles), ('replace', ['-r'], jsonfiles),
+                ('bulk', ['--bulk'], jsonfiles), ('dedup-bulk', ['--dedup', '--bulk'], jsonfiles),
+                ('clustered', ['-c', '--bulk'], jsonfiles), ('parquet', ['--bulk'], [parquetfile])]:
+            dbfile = os.path.join(tmpdir, mode + '.sqlite3')
+            add('load', mode, [python, script('json2sqlite3.py')] + option + inputs + [dbfile, 'elset'], nrecords)
+
+        rows_db = count_rows(os.path.join(tmpdir, 'bulk.sqlite3'), 'elset')
+        for mode, source in [('sqlite3', 'bulk.sqlite3'), ('clustered', 'clustered.sqlite3'), ('parquet', 'out.parquet'), ('parquet-part', 'part')]:
+            add('query', mode, [python, '-c', QUERY_CODE, os.path.join(tmpdir, source), str(objects)], rows_db)
+        add('query', 'daily', [python, script('daily.py'), '-o', os.path.join(tmpdir, 'daily.parquet'), os.path.join(tmpdir, 'bulk.sqlite3')], rows_db)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the conversion scripts.')
+    parser.add_argument('-o', '--output', type=str, help='Append the results to this file as JSON lines.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('json2sqlite3', help='json2sqlite3.py: pandas vs streaming vs bulk-load')
+    p.add_argument('FILE', type=str, nargs='+', help='Input JSON files.')
+
+    p = subparsers.add_parser('convert', help='json2tle.py and json2csv.py: pandas vs streaming')
+    p.add_argument('FILE', type=str, nargs='+', help='Input JSON files.')
+
+    p = subparsers.add_parser('layout', help='json2sqlite3.py: table keyed on GP_ID vs clustered (-c), on a synthetic database')
+    p.add_argument('-n', '--rows', type=int, default=5000000, help='Number of records. Default: 5000000')
+    p.add_argument('--objects', type=int, default=50000, help='Number of objects. Default: 50000')
+    p.add_argument('-q', '--queries', type=int, default=200, help='Number of objects whose history is read. Default: 200')
+    p.add_argument('--tmpdir', type=str, help='Directory of the temporary databases.')
+
+    p = subparsers.add_parser('pipeline', help='Read, dedup, convert, load and query stages on synthetic JSON files made by gengp.py')
+    p.add_argument('-n', '--rows', type=int, default=200000, help='Number of records (without duplicates). Default: 200000')
+    p.add_argument('--objects', type=int, default=2000, help='Number of objects. Default: 2000')
+    p.add_argument('-f', '--files', type=int, default=4, help='Number of JSON files. Default: 4')
+    p.add_argument('--overlap', type=float, default=0.1, help='Fraction of the records shared by consecutive files. Default: 0.1')
+    p.add_argument('-d', '--duplicates', type=float, default=0.05, help='Fraction of duplicated records in a file. Default: 0.05')
+    p.add_argument('--nulls', type=float, default=0.02, help='Fraction of objects with null columns. Default: 0.02')
+    p.add_argument('-z', '--compress', type=str, default='', choices=['', '.xz', '.zst'], help='Compression of the JSON files. Default: none')
+    p.add_argument('--tmpdir', type=str, help='Directory of the temporary files.')
+
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output is not None else None
+    # The children run in subdirectories of tmpdir, so it must not be relative
+    tmpdir = os.path.abspath(args.tmpdir) if getattr(args, 'tmpdir', None) is not None else None
+
+    if args.command == 'json2sqlite3':
+        results = bench_json2sqlite3([os.path.abspath(f) for f in args.FILE])
+    elif args.command == 'convert':
+        results = bench_convert([os.path.abspath(f) for f in args.FILE])
+    elif args.command == 'layout':
+        results = bench_layout(args.rows, args.objects, args.queries, tmpdir)
+    elif args.command == 'pipeline':
+        results = bench_pipeline(args.rows, args.objects, args.files, args.overlap, args.duplicates, args.nulls,
+            '.json' + args.compress, tmpdir)
+
+    report(results, output)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
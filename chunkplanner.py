@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+from datetime import datetime, timedelta
+import elsetschema
+
+# Upper limit of records per request in adaptive mode
+MAX_RECORDS = 100000
+
+# Upper limit of units per request in adaptive mode
+MAX_CHUNK = 10000
+
+# Appears once in every record of gp, gp_history and satcat JSON
+RECORD_MARKER = b'"NORAD_CAT_ID"'
+
+# Plans the ranges [lo, hi] of units (NORAD Catalog Numbers or day ordinals) to request.
+#
+# Without `adaptive`, ranges of `chunk` units are returned in order, as before.
+# With `adaptive`, each range is extended as long as the estimated number of records stays
+# under `max_records`. The estimate of a unit is taken from `counts` (e.g. the number of
+# records already in the elset database) if available, otherwise from the sizes of previous
+# responses. A range which fails is split in half and requested again.
+# Units in `completed` (e.g. downloaded by a previous run) are never requested.
+class ChunkPlanner:
+
+    def __init__(self, start, end, chunk = 1, adaptive = False, counts = None, max_records = MAX_RECORDS, completed = None):
+        self.start = start
+        self.end = end
+        self.chunk = chunk
+        self.adaptive = adaptive
+        self.counts = counts if counts is not None else {}
+        self.max_records = max_records
+        self.completed = completed if completed is not None else set()
+        # Records per unit of the units without local knowledge
+        self.estimate = max_records / chunk
+        self.pos = start
+        self.pending = []
+        self.ndone = 0
+
+    def _estimate(self, unit):
+        return self.counts.get(unit, self.estimate)
+
+    def next(self):
+        if len(self.pending) > 0:
+            return self.pending.pop()
+        while self.pos <= self.end and self.pos in self.completed:
+            self.pos += 1
+            self.ndone += 1
+        if self.pos > self.end:
+            return None
+
+        lo = self.pos
+        hi = lo
+        if not self.adaptive:
+            while hi < min(lo + self.chunk - 1, self.end) and hi + 1 not in self.completed:
+                hi += 1
+        else:
+            total = self._estimate(lo)
+            while hi < self.end and hi + 1 not in self.completed:
+                e = self._estimate(hi + 1)
+                if total + e > self.max_records:
+                    break
+                total += e
+                hi += 1
+
+        self.pos = hi + 1
+        return (lo, hi)
+
+    # Report a successful request with the number of records in its response
+    def done(self, lo, hi, nrecords):
+        self.ndone += hi - lo + 1
+        if not self.adaptive:
+            return
+
+        unknown = [u for u in range(lo, hi + 1) if u not in self.counts]
+        if len(unknown) == 0:
+            return
+        known = sum(self.counts[u] for u in range(lo, hi + 1) if u in self.counts)
+        observed = max(nrecords - known, 0) / len(unknown)
+        # Grow at most twice per request, but shrink at once
+        self.estimate = max(observed, self.estimate / 2, self.max_records / MAX_CHUNK)
+
+    # Report a range which is not requested (or whose response can't be used)
+    def skip(self, lo, hi):
+        self.ndone += hi - lo + 1
+
+    # Report a failed request. Return True if the range is split and will be requested again.
+    def failed(self, lo, hi):
+        if not self.adaptive or lo == hi:
+            self.skip(lo, hi)
+            return False
+
+        mid = (lo + hi) // 2
+        # The second half is requested after the first half
+        self.pending.append((mid + 1, hi))
+        self.pending.append((lo, mid))
+        # The response was probably too large for this number of units
+        self.estimate = max(self.estimate, self.max_records / (mid - lo + 1))
+        return True
+
+# Count occurrences of `marker` in a stream of chunks (a marker may straddle two chunks)
+class RecordCounter:
+
+    def __init__(self, marker = RECORD_MARKER):
+        self.marker = marker
+        self.reset()
+
+    def reset(self):
+        self.tail = b''
+        self.count = 0
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        buf = self.tail + data
+        self.count += buf.count(self.marker)
+        # Keep the bytes which may be the beginning of a marker (a complete marker can't be in them)
+        self.tail = buf[-(len(self.marker) - 1):] if len(buf) >= len(self.marker) else buf
+
+# Number of records per NORAD Catalog Number in an elset database
+def load_counts_by_id(dbfile, table, start, end):
+    with sqlite3.connect(dbfile) as con:
+        cur = con.execute('SELECT NORAD_CAT_ID, COUNT(*) FROM {} WHERE NORAD_CAT_ID BETWEEN ? AND ? GROUP BY NORAD_CAT_ID'.format(table),
+            (start, end))
+        return {int(norad_cat_id): count for norad_cat_id, count in cur}
+
+# Number of records per day (ordinal) in an elset database. column: EPOCH or CREATION_DATE
+def load_counts_by_date(dbfile, table, start, end, column = 'EPOCH'):
+    date1 = datetime.fromordinal(start)
+    date2 = datetime.fromordinal(end) + timedelta(days = 1)
+    with sqlite3.connect(dbfile) as con:
+        if elsetschema.is_compact(con, table):
+            # Microseconds since 1970
+            cur = con.execute('SELECT {2}, COUNT(*) FROM {0} WHERE {1} >= ? AND {1} < ? GROUP BY 1'.format(table, column, elsetschema.sql_day(column)),
+                (elsetschema.to_microseconds(date1), elsetschema.to_microseconds(date2)))
+            return {day + elsetschema.ORDINAL_1970: count for day, count in cur}
+        cur = con.execute('SELECT substr({1}, 1, 10), COUNT(*) FROM {0} WHERE {1} >= ? AND {1} < ? GROUP BY 1'.format(table, column),
+            (date1.strftime('%Y-%m-%d'), date2.strftime('%Y-%m-%d')))
+        return {datetime.strptime(day, '%Y-%m-%d').toordinal(): count for day, count in cur}
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import sqlite3
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+import json2sqlite3
+import elsetschema
+import asofindex
+
+# Converts an elset table of json2sqlite3.py to the compact layout of elsetschema.py (or back to the text layout).
+# The table is rebuilt in one transaction, so readers see either the old or the new table.
+def convert_table(con, table, revert, logger):
+    cur = con.cursor()
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if row is None:
+        raise ValueError('no table {}'.format(table))
+    clustered = 'WITHOUT ROWID' in row[0].upper()
+    columns = [row[1] for row in cur.execute('PRAGMA table_info({})'.format(table))]
+    with_tle = 'TLE_LINE1' in columns
+    if elsetschema.is_compact(con, table) != revert:
+        logger.info('table {} is already in the {} layout'.format(table, 'text' if revert else 'compact'))
+        return 0
+
+    convert = elsetschema.sql_to_text if revert else elsetschema.sql_to_microseconds
+    select = [convert(column) if column in elsetschema.TIMESTAMP_COLUMNS else column for column in columns]
+    new_table = table + '_compactdb'
+
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute('DROP TABLE IF EXISTS {}'.format(new_table))
+    cur.execute(json2sqlite3.create_table_statement(new_table, with_tle, clustered, not revert))
+    # Clustered tables are filled in the order of the primary key
+    order = ' ORDER BY NORAD_CAT_ID, EPOCH, GP_ID' if clustered else ''
+    cur.execute('INSERT INTO {} ({}) SELECT {} FROM {}{}'.format(new_table, ', '.join(columns), ', '.join(select), table, order))
+    nrows = cur.rowcount
+    cur.execute('DROP VIEW IF EXISTS {}_text'.format(table))
+    cur.execute('DROP TABLE {}'.format(table))
+    cur.execute('ALTER TABLE {} RENAME TO {}'.format(new_table, table))
+    # The indexes were dropped with the old table
+    json2sqlite3.prepare_table(cur, table, with_tle)
+    index_columns = json2sqlite3.columns_with_index
+    if clustered:
+        index_columns = [column for column in index_columns if column != 'NORAD_CAT_ID']
+    for column in index_columns:
+        cur.execute('CREATE INDEX IF NOT EXISTS index_{0}_{1} ON {0} ({1})'.format(table, column))
+    # The intervals of the as-of index are in the layout of EPOCH
+    if asofindex.has_index(con, table):
+        asofindex.rebuild(cur, table)
+    cur.execute('COMMIT')
+    return nrows
+
+def main():
+    logger = setup_logger('compactdb')
+    metrics = get_metrics('compactdb')
+
+    parser = argparse.ArgumentParser(description='Convert an elset table of json2sqlite3.py to the compact layout (timestamps as integer microseconds).')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 database file.')
+    parser.add_argument('TABLE', type=str, nargs='?', default='elset', help='Table name. Default: elset')
+    parser.add_argument('-r', '--revert', action='store_true', help='Convert a compact table back to the text layout')
+    parser.add_argument('--no_vacuum', action='store_true', help="Don't VACUUM the database after the conversion")
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.DATABASE):
+        logger.critical('error: {} not found'.format(args.DATABASE))
+        sys.exit(1)
+
+    size = os.path.getsize(args.DATABASE)
+    con = sqlite3.connect(args.DATABASE, isolation_level = None)
+    try:
+        with metrics.timer('convert'):
+            nrows = convert_table(con, args.TABLE, args.revert, logger)
+    except (ValueError, sqlite3.Error) as e:
+        logger.critical('error: {}: {}'.format(args.DATABASE, e))
+        sys.exit(1)
+    logger.info('{} records converted'.format(nrows))
+    metrics.inc('records', nrows)
+
+    if nrows > 0 and not args.no_vacuum:
+        # The pages of the old table are reused only after VACUUM
+        with metrics.timer('vacuum'):
+            con.execute('VACUUM')
+    con.close()
+    logger.info('{}: {} bytes -> {} bytes'.format(args.DATABASE, size, os.path.getsize(args.DATABASE)))
+    metrics.set('database_bytes', os.path.getsize(args.DATABASE))
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('compactdb', main)
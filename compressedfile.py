@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import lzma
+import os
+import subprocess
+from subprocess import PIPE
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compression codecs for downloaded data: extension and default level
+CODECS = {
+    'xz': ('.xz', 9),       # lzma module (single thread)
+    'xz-mt': ('.xz', 9),    # xz command with -T0 (multithread)
+    'zstd': ('.zst', 19),   # zstandard module (multithread)
+    'none': ('', None),
+}
+
+def compressed_filename(filename, codec = 'xz'):
+    return filename + CODECS[codec][0]
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# File writer that compresses data while it arrives.
+# Data is written to a temporary file in the same directory, which is renamed to
+# `filename` by commit(). abort() removes the temporary file. Used as a context manager,
+# it commits on success and aborts on an exception.
+class CompressedWriter:
+
+    def __init__(self, filename, codec = 'xz', level = None, logger = None):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: {}'.format(codec))
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError('zstandard module is required for zstd')
+
+        self.filename = filename
+        self.codec = codec
+        self.level = level if level is not None else CODECS[codec][1]
+        self.logger = logger
+        self.fp = None
+        self._open()
+
+    def _open(self):
+        dirname, basename = os.path.split(self.filename)
+        fd, self.tmpfile = tempfile.mkstemp(prefix = '.' + basename + '.', suffix = '.tmp', dir = dirname or '.')
+        self.fp = os.fdopen(fd, 'wb')
+        self.raw_bytes = 0
+        self.elapsed = 0.0
+        self.compressor = None
+        self.proc = None
+        self.stream = None
+
+        if self.codec == 'xz':
+            self.compressor = lzma.LZMACompressor(format = lzma.FORMAT_XZ, preset = self.level)
+        elif self.codec == 'xz-mt':
+            self.proc = subprocess.Popen(['xz', '-T0', '-{}'.format(self.level), '-c'],
+                stdin = PIPE, stdout = self.fp, stderr = PIPE)
+        elif self.codec == 'zstd':
+            cctx = zstandard.ZstdCompressor(level = self.level, threads = -1)
+            self.stream = cctx.stream_writer(self.fp, closefd = False)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        t = time.perf_counter()
+        if self.compressor is not None:
+            self.fp.write(self.compressor.compress(data))
+        elif self.proc is not None:
+            self.proc.stdin.write(data)
+        elif self.stream is not None:
+            self.stream.write(data)
+        else:
+            self.fp.write(data)
+        self.elapsed += time.perf_counter() - t
+        self.raw_bytes += len(data)
+
+    def _finish(self):
+        t = time.perf_counter()
+        if self.compressor is not None:
+            self.fp.write(self.compressor.flush())
+        elif self.proc is not None:
+            (stdout, stderr) = self.proc.communicate()
+            if self.proc.returncode != 0:
+                raise OSError('xz failed: ' + stderr.decode(errors = 'replace'))
+        elif self.stream is not None:
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.elapsed += time.perf_counter() - t
+
+    # Discard the data written so far and start over (e.g. before retrying a request)
+    def reset(self):
+        self.abort()
+        self._open()
+
+    def commit(self):
+        self._finish()
+        self.compressed_bytes = os.fstat(self.fp.fileno()).st_size
+        self.fp.close()
+        self.fp = None
+        # mkstemp creates the file with mode 0600
+        os.chmod(self.tmpfile, 0o666 & ~_umask())
+        os.replace(self.tmpfile, self.filename)
+
+        if self.logger is not None:
+            speed = self.raw_bytes / self.elapsed / 1e6 if self.elapsed > 0 else float('inf')
+            self.logger.info('Saved: {} ({} -> {} bytes, {}, {:.1f} MB/s)'.format(
+                self.filename, self.raw_bytes, self.compressed_bytes, self.codec, speed))
+
+    def abort(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.communicate()
+            self.proc = None
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if os.path.exists(self.tmpfile):
+            os.remove(self.tmpfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fp is None:
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
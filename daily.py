@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 毎日0:00UT時点での軌道要素データ (軌道長半径・近点・遠点) を線形補間で作成する (create_daily_data.ipynb の処理)。
+# 0:00UT時点での実際の衛星の位置ではない。
+#
+# 複数の EPOCH の時間間隔が1秒以下の時には、CREATION_DATE が新しいもの1つを残して、他は削除してから、補間を行う。
+# 全ての衛星のデータを1つの配列にまとめ、ソートとグループの境界を使って一度に処理する。
+
+import pandas as pd
+import numpy as np
+import sys
+import sqlite3
+import argparse
+from datetime import datetime
+from functools import partial
+from setup_logger import setup_logger
+from metrics import run
+from gpjson import imap_ordered
+
+# 地心重力定数 [km^3/s^2]
+MU = 398600.4418
+
+# 地球の赤道半径 [km]
+EARTH_RADIUS = 6378.135
+
+# EPOCH の間隔がこれ以下のレコードは同じグループとする [マイクロ秒]
+TOLERANCE = 1000000
+
+# 1日 [マイクロ秒]
+DAY = 86400 * 1000000
+
+# 補間するカラム
+COLUMNS = ['SEMIMAJOR_AXIS', 'PERIAPSIS', 'APOAPSIS']
+
+# 1つのプロセスで処理する衛星の数
+CHUNK_SIZE = 500
+
+# 軌道長半径・遠地点高度・近地点高度を MEAN_MOTION [rev/day] と ECCENTRICITY から再計算する
+def altitudes(mean_motion, eccentricity):
+    a = (MU / (mean_motion * 2 * np.pi / (24 * 3600)) ** 2) ** (1 / 3)
+    return a, a * (1 - eccentricity) - EARTH_RADIUS, a * (1 + eccentricity) - EARTH_RADIUS
+
+# 衛星ごとの範囲 [starts[i], ends[i]) の先頭のインデックス。ids はソート済み
+def boundaries(ids):
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    return starts, ends
+
+# EPOCH の間隔が tolerance 以下のレコードのグループから、CREATION_DATE が最も新しいものを残す。
+# epoch, creation は整数 (マイクロ秒)。残すレコードのインデックスを NORAD_CAT_ID, EPOCH 順で返す。
+def dedup(ids, epoch, creation, tolerance = TOLERANCE):
+    order = np.lexsort((creation, epoch, ids))
+    ids = ids[order]
+    epoch = epoch[order]
+    newgroup = np.r_[True, (ids[1:] != ids[:-1]) | (np.diff(epoch) > tolerance)]
+    group = np.cumsum(newgroup)
+    # グループ内を CREATION_DATE 順に並べて最後のものを残す (同じ時は EPOCH が遅いもの)
+    order2 = np.lexsort((creation[order], group))
+    last = np.r_[group[order2][1:] != group[order2][:-1], True]
+    return order[order2[last]]
+
+# 各衛星の最初の EPOCH 以降、最後の EPOCH 以前の毎日0:00の値を線形補間で求める。
+# ids, epoch (マイクロ秒) は NORAD_CAT_ID, EPOCH 順にソート済みで、同じ衛星の EPOCH は重複しないこと。
+# 返り値は各日の NORAD_CAT_ID, 日付 (1970-01-01からの日数), 補間した値のリスト
+def interpolate_daily(ids, epoch, values):
+    starts, ends = boundaries(ids)
+    first = -(-epoch[starts] // DAY)
+    last = epoch[ends - 1] // DAY
+    ndays = np.maximum(last - first + 1, 0)
+
+    # 出力する各日の衛星 (starts, ends のインデックス) と日付
+    obj = np.repeat(np.arange(len(starts)), ndays)
+    offset = np.arange(len(obj)) - np.repeat(np.cumsum(ndays) - ndays, ndays)
+    days = first[obj] + offset
+    t = days * DAY
+
+    # 全衛星の elset と出力する日を (衛星の番号, 時刻) の順にまとめてソートし、
+    # 各日の直前 (同時刻を含む) の elset のインデックスを累積最大値で求める
+    nin = len(epoch)
+    objects_in = np.repeat(np.arange(len(starts)), ends - starts)
+    is_out = np.r_[np.zeros(nin, dtype = bool), np.ones(len(t), dtype = bool)]
+    order = np.lexsort((is_out, np.r_[epoch, t], np.r_[objects_in, obj]))
+    prev = np.maximum.accumulate(np.where(order < nin, order, -1))
+    i0 = np.empty(len(t), dtype = 'int64')
+    i0[order[order >= nin] - nin] = prev[order >= nin]
+    i0 = np.clip(i0, starts[obj], ends[obj] - 1)
+    i1 = np.minimum(i0 + 1, ends[obj] - 1)
+    dt = (epoch[i1] - epoch[i0]).astype('float64')
+    w = np.divide((t - epoch[i0]).astype('float64'), dt, out = np.zeros(len(t)), where = dt > 0)
+    out = [v[i0] + (v[i1] - v[i0]) * w for v in values]
+    return ids[starts][obj], days, out
+
+# 読み込んだ elset から日々のデータを作成する。df は NORAD_CAT_ID, EPOCH, CREATION_DATE, MEAN_MOTION, ECCENTRICITY を含むこと
+def daily_from_elsets(df):
+    if len(df) == 0:
+        return pd.DataFrame(columns = ['NORAD_CAT_ID', 'DATE'] + COLUMNS + ['DOT_' + c for c in COLUMNS])
+
+    ids = df['NORAD_CAT_ID'].to_numpy(dtype = 'int64')
+    epoch = np.asarray(df['EPOCH'], dtype = 'datetime64[us]').astype('int64')
+    creation = np.asarray(df['CREATION_DATE'], dtype = 'datetime64[us]').astype('int64')
+    keep = dedup(ids, epoch, creation)
+
+    a, peri, apo = altitudes(df['MEAN_MOTION'].to_numpy(dtype = 'float64')[keep], df['ECCENTRICITY'].to_numpy(dtype = 'float64')[keep])
+    ids_out, days, (a, peri, apo) = interpolate_daily(ids[keep], epoch[keep], [a, peri, apo])
+
+    out = pd.DataFrame({'NORAD_CAT_ID': ids_out, 'DATE': days.astype('datetime64[D]'),
+        'SEMIMAJOR_AXIS': a, 'PERIAPSIS': peri, 'APOAPSIS': apo})
+    # 前日からの変化。各衛星の最初の日は NaN
+    newobj = np.r_[True, ids_out[1:] != ids_out[:-1]]
+    for column in COLUMNS:
+        dot = np.r_[np.nan, np.diff(out[column].to_numpy())]
+        dot[newobj] = np.nan
+        out['DOT_' + column] = dot
+    return out
+
+# NORAD_CAT_ID のリストの elset をデータベースから読み込む
+def load_elsets(dbfile, table, norad_cat_ids):
+    with sqlite3.connect(dbfile) as con:
+        # 古い SQLite3 の変数の数の上限 (999) を超えないように分けて読み込む
+        dfs = [pd.read_sql_query('SELECT NORAD_CAT_ID, EPOCH, CREATION_DATE, MEAN_MOTION, ECCENTRICITY FROM {} WHERE NORAD_CAT_ID IN ({})'.format(
+            table, ','.join('?' * len(ids))), con, params = ids)
+            for ids in (norad_cat_ids[i:i + 500] for i in range(0, len(norad_cat_ids), 500))]
+    return pd.concat(dfs, ignore_index = True) if len(dfs) > 0 else pd.DataFrame(columns = ['NORAD_CAT_ID', 'EPOCH', 'CREATION_DATE', 'MEAN_MOTION', 'ECCENTRICITY'])
+
+# 1つのプロセスの処理。衛星のリストのデータを読み込んで日々のデータを作成する
+def daily_from_db(norad_cat_ids, dbfile, table = 'elset'):
+    return daily_from_elsets(load_elsets(dbfile, table, norad_cat_ids))
+
+# 衛星のリストを chunk_size ずつ jobs 個のプロセスで処理し、NORAD_CAT_ID 順に1つの DataFrame にする
+def daily(dbfile, norad_cat_ids, table = 'elset', jobs = 1, chunk_size = CHUNK_SIZE):
+    norad_cat_ids = sorted(set(int(x) for x in norad_cat_ids))
+    chunks = [norad_cat_ids[i:i + chunk_size] for i in range(0, len(norad_cat_ids), chunk_size)]
+    dfs = list(imap_ordered(partial(daily_from_db, dbfile = dbfile, table = table), chunks, jobs))
+    if len(dfs) == 0:
+        return daily_from_elsets(pd.DataFrame())
+    return pd.concat(dfs, ignore_index = True)
+
+# start から end までの日付のデータのみを残す。cover が True の時は、期間全体のデータがある衛星のみを残す
+def select_period(df, start = None, end = None, cover = False):
+    if cover and (start is not None or end is not None):
+        first = df.groupby('NORAD_CAT_ID')['DATE'].transform('min')
+        last = df.groupby('NORAD_CAT_ID')['DATE'].transform('max')
+        mask = np.ones(len(df), dtype = bool)
+        if start is not None:
+            mask &= first <= start
+        if end is not None:
+            mask &= last >= end
+        df = df[mask]
+    if start is not None:
+        df = df[df['DATE'] >= start]
+    if end is not None:
+        df = df[df['DATE'] <= end]
+    return df.reset_index(drop = True)
+
+def main():
+    logger = setup_logger('daily')
+
+    parser = argparse.ArgumentParser(description='Create daily (00:00 UTC) semimajor axis, perigee and apogee by linear interpolation.')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 Database file created by json2sqlite3.py')
+    parser.add_argument('NORAD_CAT_ID', type=int, nargs='*', help='NORAD Catalog Numbers. Default: all objects in the table')
+    parser.add_argument('-t', '--table', type=str, default='elset', help='Table name. Default: elset')
+    parser.add_argument('-o', '--output', type=str, default='daily.csv', help='Output file (.csv or .parquet). Default: daily.csv')
+    parser.add_argument('-s', '--start', type=str, help='First date (YYYY-MM-DD) of the output')
+    parser.add_argument('-e', '--end', type=str, help='Last date (YYYY-MM-DD) of the output')
+    parser.add_argument('-c', '--cover', action='store_true', help='Output only objects whose data cover the whole period')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes. Default: 1')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of objects processed at once. Default: {}'.format(CHUNK_SIZE))
+
+    args = parser.parse_args()
+
+    start = np.datetime64(datetime.strptime(args.start, '%Y-%m-%d').date()) if args.start is not None else None
+    end = np.datetime64(datetime.strptime(args.end, '%Y-%m-%d').date()) if args.end is not None else None
+
+    norad_cat_ids = args.NORAD_CAT_ID
+    if len(norad_cat_ids) == 0:
+        with sqlite3.connect(args.DATABASE) as con:
+            norad_cat_ids = [x for (x,) in con.execute('SELECT DISTINCT NORAD_CAT_ID FROM {}'.format(args.table))]
+    logger.info('{} objects'.format(len(norad_cat_ids)))
+
+    starttime = datetime.now()
+    df = daily(args.DATABASE, norad_cat_ids, args.table, args.jobs, args.chunk_size)
+    df = select_period(df, start, end, args.cover)
+    logger.info('{} days of {} objects in {:.1f} sec'.format(len(df), df['NORAD_CAT_ID'].nunique(), (datetime.now() - starttime).total_seconds()))
+
+    logger.info('Output: {}'.format(args.output))
+    if args.output.endswith('.parquet'):
+        df.to_parquet(args.output, index = False)
+    else:
+        df.to_csv(args.output, index = False)
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('daily', main)
@@ -10,96 +10,229 @@ import sys
 import os
 import math
 import argparse
-import subprocess
-from subprocess import PIPE
+from functools import partial
 import requests
+import sqlite3
 from setup_logger import setup_logger
+from metrics import get_metrics, run
+from ratelimiter import RateLimiter
+from compressedfile import CODECS, CompressedWriter, compressed_filename
+from downloadpipeline import DownloadPipeline, BufferWriter, TeeWriter, JOBS
+from manifest import Manifest, MANIFEST_FILE
+from chunkplanner import ChunkPlanner, RecordCounter, MAX_RECORDS, load_counts_by_date
+import elsetschema
+import responsecache
 import spacetrackaccount
 
 MAX_ERROR = 3
 MAX_RETRY = 2
-# Limit API queries to less than 30 requests per minute / 300 requests per hour
+# Default overlap of incremental download (hours)
+OVERLAP = 6
+
+# Base interval of the retry backoff. The request rate itself is limited by RateLimiter
 MIN_INTERVAL = 12 # sec
 
-def getdata(st, epoch, date_type = 'EPOCH', logger = None):
-    for i in range(MAX_RETRY + 1):
+def getdata(st, epoch, writer, counter, date_type = 'EPOCH', retry = MAX_RETRY, limiter = None, logger = None, metrics = None, cache = None):
+    if date_type == 'EPOCH':
+        predicates = {'epoch': epoch}
+        orderby = ['norad_cat_id', 'epoch']
+    elif date_type =='CREATION_DATE':
+        predicates = {'creation_date': epoch}
+        orderby = ['norad_cat_id', 'creation_date']
+    else:
+        raise Exception('Unknown date_type')
+
+    entry = None
+    if cache is not None:
+        # A cached response is served without a request
+        query = responsecache.normalize_query('gp_history', predicates, orderby)
+        if cache.serve(query, writer, counter, metrics = metrics):
+            return responsecache.CACHED
+        if cache.offline:
+            return False
+        entry = cache.writer(query)
+        writer = TeeWriter(writer, entry)
+
+    for i in range(retry + 1):
         if i > 0:
-            logger.warning('Retry {}/{} for {}'.format(i, MAX_RETRY, epoch))
+            logger.warning('Retry {}/{} for {}'.format(i, retry, epoch))
             logger.debug('Sleep: %f secs', MIN_INTERVAL * 2 ** i)
             time.sleep(MIN_INTERVAL * 2 ** i)
-        elif getdata.lasttime > 0:
-            delta = time.monotonic() - getdata.lasttime
-            if delta < MIN_INTERVAL:
-                time.sleep(MIN_INTERVAL - delta)
+            if metrics is not None:
+                metrics.inc('retries')
+                metrics.observe('retry_sleep', MIN_INTERVAL * 2 ** i)
 
+        if limiter is not None:
+            # The budget is shared with the other download processes
+            slept = limiter.acquire()
+            if metrics is not None:
+                metrics.observe('ratelimit_sleep', slept)
         getdata.lasttime = time.monotonic()
 
         try:
-            if date_type == 'EPOCH':
-                data = st.gp_history(epoch=epoch, orderby=['norad_cat_id', 'epoch'], format='json')
-            elif date_type =='CREATION_DATE':
-                data = st.gp_history(creation_date=epoch, orderby=['norad_cat_id', 'creation_date'], format='json')
-            else:
-                raise Exception('Unknown date_type')
+            data = st.gp_history(**predicates, orderby=orderby, format='json', iter_content=True)
+
+            for chunk in data:
+                writer.write(chunk)
+                counter.feed(chunk)
 
         except requests.HTTPError as e:
             # Critical error. Don't retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'http_error')
             logger.error('HTTPError: ' + str(e))
             break
 
-        except (requests.ConnectionError, requests.Timeout) as e:
-            # Retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            logger.warning('ConnectionError: ' + str(e))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            # Retry. The connection may drop in the middle of the body, so discard the partial response
+            writer.reset()
+            counter.reset()
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'connection_error')
+            logger.warning('{}: {}'.format(type(e).__name__, e))
+
+        except OSError:
+            # The writer failed (e.g. disk full), not the request (requests' exceptions are OSError too). The caller aborts it
+            if entry is not None:
+                entry.abort()
+            raise
 
         else:
             # Success
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            return data 
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'ok')
+            if entry is not None:
+                entry.commit()
+            return responsecache.FETCHED
 
-    return None
+    if entry is not None:
+        entry.abort()
+    return False
 
 getdata.lasttime = 0
 
-def savedata(data, filename, compress = True, force = False, logger = None):
-    if os.path.exists(filename) and not force:
-        logger.error(filename + ' already exists')
-        return False
-
-    with open(filename, 'w') as fp:
-        fp.write(data)
-
-    if not compress:
-        return True
-
-    program = ['xz', '-9', filename]
-    if force:
-        program.insert(1, '-f')
-    proc = subprocess.Popen(program, stdout=PIPE, stderr=PIPE, text=True)
-    (stdout, stderr) = proc.communicate()
-    if stdout != '' or stderr != '':
-        logger.error(stdout + stderr)
-        return False
+# The newest CREATION_DATE in the database (None if the table is empty or doesn't exist)
+def load_watermark(dbfile, table):
+    if not os.path.isfile(dbfile):
+        return None
+    with sqlite3.connect(dbfile) as con:
+        try:
+            (mark,) = con.execute('SELECT MAX(CREATION_DATE) FROM {}'.format(table)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+    # Text or microseconds (compact layout)
+    return elsetschema.to_datetime(mark)
+
+# Download the records created after the watermarks of the databases (minus the overlap)
+def download_incremental(args, logger, metrics):
+    marks = [load_watermark(dbfile, args.table) for dbfile in args.incremental]
+    for dbfile, mark in zip(args.incremental, marks):
+        logger.info('Watermark of {}: {}'.format(dbfile, mark))
+    if None in marks:
+        logger.critical('error: No watermark. Download by date first')
+        sys.exit(1)
+    # How far the databases are behind (CREATION_DATE is UTC)
+    metrics.set('watermark_lag_seconds', (datetime.utcnow() - min(marks)).total_seconds())
+
+    # The oldest one, so that every database gets all the records it lacks
+    since = min(marks) - timedelta(hours = args.overlap)
+    logger.info('Since: {}'.format(since.strftime('%Y-%m-%d %H:%M:%S')))
+
+    if args.output is None:
+        filename = 'download/since-{:%Y%m%d%H%M%S}.json'.format(since)
     else:
-        return True
+        filename = args.output
+    filename = compressed_filename(filename, args.codec)
+    logger.info('Filename: {}'.format(filename))
+
+    if os.path.exists(filename) and not args.force:
+        logger.error(filename + ' already exists')
+        sys.exit(1)
+
+    st = SpaceTrackClient(spacetrackaccount.userid, spacetrackaccount.password)
+    limiter = RateLimiter(logger = logger)
+    cache = responsecache.from_arguments(args, logger)
+
+    starttime = time.monotonic()
+    epoch = op.greater_than(since.strftime('%Y-%m-%d %H:%M:%S'))
+    writer = CompressedWriter(filename, codec = args.codec, level = args.level, logger = logger)
+    counter = RecordCounter()
+    try:
+        if not getdata(st, epoch, writer, counter, date_type = 'CREATION_DATE', limiter = limiter, logger = logger, metrics = metrics, cache = cache):
+            writer.abort()
+            logger.error("Error: Fail to download data since {}".format(since))
+            metrics.inc('errors')
+            sys.exit(1)
+        writer.commit()
+    except OSError as e:
+        writer.abort()
+        logger.error(str(e))
+        logger.error("Error: Fail to save data since {}".format(since))
+        metrics.inc('errors')
+        sys.exit(1)
+    metrics.inc('files')
+    metrics.inc('records', counter.count)
+    metrics.inc('bytes', writer.raw_bytes)
+    metrics.inc('compressed_bytes', writer.compressed_bytes)
+    metrics.observe('compress', writer.elapsed)
+
+    logger.info("Downloaded: {} records, {} bytes in {} sec".format(counter.count, writer.raw_bytes, int(time.monotonic() - starttime)))
+    sys.exit(0)
 
 def main():
     logger = setup_logger('download_gp_date')
+    metrics = get_metrics('download_gp_date')
 
     parser = argparse.ArgumentParser(description='Download GP data of specified date.')
-    parser.add_argument('START', type=str, help='Start Date (YYYY-MM-DD).')
+    parser.add_argument('START', type=str, nargs='?', help='Start Date (YYYY-MM-DD). Not used with -i.')
     parser.add_argument('END', type=str, nargs='?', help='End Date (YYYY-MM-DD). Default: same as START')
     parser.add_argument('CHUNK', type=int, nargs='?', default=1, help='Chunk size (days). Default: 1')
     parser.add_argument('-c', '--creationdate', action='store_true', help='Use CREATION_DATE intead of EPOCH')
     parser.add_argument('-f', '--force', action='store_true', help='If the outpu file already exists, overwrite it.')
+    parser.add_argument('-z', '--codec', type=str, choices=list(CODECS), default='xz', help='Compression codec of the output file. Default: xz')
+    parser.add_argument('-l', '--level', type=int, help='Compression level. Default: 9 (xz, xz-mt), 19 (zstd)')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='Adapt the chunk size to the number of records. CHUNK is the initial chunk size.')
+    parser.add_argument('-m', '--max_records', type=int, default=MAX_RECORDS, help='Maximum number of records per request in adaptive mode. Default: {}'.format(MAX_RECORDS))
+    parser.add_argument('-d', '--database', type=str, help='SQLite3 database whose records are used to plan the chunks in adaptive mode.')
+    parser.add_argument('-t', '--table', type=str, default='elset', help='Table name of the databases of -d and -i. Default: elset')
+    parser.add_argument('-r', '--resume', action='store_true', help='Download only the ranges which are not completed yet according to the manifest.')
+    parser.add_argument('-v', '--verify', action='store_true', help='Check the manifest and the files for holes in the archive. No data is downloaded.')
+    parser.add_argument('--manifest', type=str, default=MANIFEST_FILE, help='Manifest file. Default: {}'.format(MANIFEST_FILE))
+    parser.add_argument('-i', '--incremental', type=str, action='append', metavar='DATABASE', help='Download the records created after the newest CREATION_DATE in the database. Can be specified more than once.')
+    parser.add_argument('--overlap', type=float, default=OVERLAP, help='Overlap of incremental download (hours). Default: {}'.format(OVERLAP))
+    parser.add_argument('-o', '--output', type=str, help='Output file of incremental download. Default: download/since-YYYYMMDDhhmmss.json')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='Compress and save the responses in worker threads while the next request waits for the rate limit.')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS, help='Number of worker threads in pipeline mode. Default: {}'.format(JOBS))
+    parser.add_argument('--ingest', type=str, metavar='DATABASE', help='In pipeline mode, load each saved file into the SQLite3 database by json2sqlite3.py (table of -t).')
+    responsecache.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.ingest is not None and not args.pipeline:
+        parser.error('--ingest requires -p')
+    if args.offline and args.no_cache:
+        parser.error('--offline requires the response cache')
+
+    if args.incremental is not None:
+        download_incremental(args, logger, metrics)
+
+    if args.START is None:
+        parser.error('START is required')
+
     start = dateutil.parser.parse(args.START, yearfirst=True)
     end = dateutil.parser.parse(args.END, yearfirst=True) if args.END is not None else start
     unit = args.CHUNK
     date_type = 'EPOCH' if not args.creationdate else 'CREATION_DATE'
     force = args.force
+    codec = args.codec
+    level = args.level
+    adaptive = args.adaptive
+    resume = args.resume
 
     start = datetime(start.year, start.month, start.day)
     end = datetime(end.year, end.month, end.day)
@@ -108,23 +241,81 @@ def main():
         start, end = end, start
 
     ndays = (end - start).days + 1
-    nfiles = math.ceil(ndays / unit)
 
     logger.info('Start: ' +  start.strftime('%Y-%m-%d'))
     logger.info('End: ' + end.strftime('%Y-%m-%d'))
     logger.info('Number of Days: {}'.format(str(ndays)))
-    logger.info('Number of Files: {}'.format(nfiles))
+    if not adaptive:
+        logger.info('Number of Files: {}'.format(math.ceil(ndays / unit)))
+
+    kind = 'gp_history/' + date_type
+    manifest = Manifest(args.manifest)
+
+    if args.verify:
+        holes, bad = manifest.verify(kind, start.toordinal(), end.toordinal())
+        for (lo, hi, filename, status, nbytes, records, sha256), reason in bad:
+            logger.error('{}: {}'.format(filename, reason))
+        for lo, hi in holes:
+            logger.error('Not downloaded: {}--{}'.format(datetime.fromordinal(lo).strftime('%Y-%m-%d'), datetime.fromordinal(hi).strftime('%Y-%m-%d')))
+        logger.info('{} holes, {} invalid files'.format(len(holes), len(bad)))
+        sys.exit(0 if len(holes) == 0 and len(bad) == 0 else 1)
+
+    completed = None
+    if resume:
+        completed = manifest.completed_units(kind, start.toordinal(), end.toordinal())
+        logger.info('Number of Completed Days: {}'.format(len(completed)))
+
+    counts = None
+    if adaptive and args.database is not None:
+        counts = load_counts_by_date(args.database, args.table, start.toordinal(), end.toordinal(), column = date_type)
+        logger.info('Number of Days in Database: {}'.format(len(counts)))
+
+    # Days are planned as ordinals
+    planner = ChunkPlanner(start.toordinal(), end.toordinal(), chunk = unit, adaptive = adaptive,
+        counts = counts, max_records = args.max_records, completed = completed)
 
     st = SpaceTrackClient(spacetrackaccount.userid, spacetrackaccount.password)
+    limiter = RateLimiter(logger = logger)
+    cache = responsecache.from_arguments(args, logger)
+
+    pipeline = None
+    if args.pipeline:
+        pipeline = DownloadPipeline(codec, level, jobs = args.jobs, ingest = args.ingest, table = args.table, logger = logger, metrics = metrics)
 
     starttime = time.monotonic()
     tsize = 0
     tfiles = 0
     error_count = 0
+    nrequests = 0
+
+    # Called when a file is committed (writer) or failed to be saved (error)
+    def saved(chunk, filename, epoch_to_show, records, writer, error):
+        nonlocal tsize, tfiles, error_count
+        if error is not None:
+            logger.error(str(error))
+            logger.error("Error: Fail to save data for {}".format(epoch_to_show))
+            error_count += 1
+            manifest.failed(kind, chunk[0], chunk[1], filename)
+            return
+        tsize += writer.raw_bytes
+        tfiles += 1
+        logger.debug('{}: {} records'.format(filename, records))
+        metrics.inc('records', records)
+        metrics.inc('compressed_bytes', writer.compressed_bytes)
+        metrics.observe('compress', writer.elapsed)
+        manifest.done(kind, chunk[0], chunk[1], filename, writer.compressed_bytes, records)
+
+    while True:
+        if pipeline is not None:
+            pipeline.poll()
+            if error_count >= MAX_ERROR:
+                break
 
-    for i in range(0, nfiles):
-        day1 = start + timedelta(days = i * unit)
-        day2 = min(day1 + timedelta(days = unit - 1), end)
+        chunk = planner.next()
+        if chunk is None:
+            break
+        day1 = datetime.fromordinal(chunk[0])
+        day2 = datetime.fromordinal(chunk[1])
         epoch = op.inclusive_range(day1.strftime('%Y-%m-%d'), (day2 + timedelta(days = 1)).strftime('%Y-%m-%d'))
 
         if day1 == day2:
@@ -134,32 +325,85 @@ def main():
             epoch_to_show = '{}--{}'.format(day1.strftime('%Y-%m-%d'), day2.strftime('%Y-%m-%d'))
             filename = 'download/{}-{}.json'.format(day1.strftime('%Y%m%d'), day2.strftime('%Y%m%d'))
 
-        logger.info('Downloading {} ({}/{})'.format(epoch_to_show, i + 1, nfiles))
+        filename = compressed_filename(filename, codec)
 
-        data = getdata(st, epoch, date_type = date_type, logger = logger)
-    
-        if data is None:
-            logger.error("Error: Fail to download data for " + epoch_to_show)
-            error_count += 1
-        else:
-            tsize += len(data)
-            tfiles += 1
-            result = savedata(data, filename, force = force, logger = logger)
-            if not result:
+        logger.info('Downloading {} ({}/{} days)'.format(epoch_to_show, planner.ndone + (day2 - day1).days + 1, ndays))
+
+        if os.path.exists(filename) and not force:
+            if resume:
+                # Downloaded before the manifest existed
+                logger.info(filename + ' already exists. Skipped')
+                manifest.done(kind, chunk[0], chunk[1], filename, os.path.getsize(filename))
+            else:
+                # Don't waste a request for data which can't be saved
+                logger.error(filename + ' already exists')
                 logger.error("Error: Fail to save data for {}".format(epoch_to_show))
                 error_count += 1
+            planner.skip(*chunk)
+        else:
+            if pipeline is not None:
+                writer = BufferWriter()
+            else:
+                writer = CompressedWriter(filename, codec = codec, level = level, logger = logger)
+            counter = RecordCounter()
+            # In adaptive mode, a failed multi-day request is split rather than retried
+            retry = MAX_RETRY if not adaptive or day1 == day2 else 0
+            try:
+                downloaded = getdata(st, epoch, writer, counter, date_type = date_type, retry = retry, limiter = limiter, logger = logger, metrics = metrics, cache = cache)
+            except OSError as e:
+                # The response can't be written (e.g. disk full). Counted as a failure to save, as in writer.commit() below
+                writer.abort()
+                saved(chunk, filename, epoch_to_show, counter.count, None, e)
+                planner.skip(*chunk)
+            else:
+                # Only the requests sent to Space-Track (none in offline mode), not the responses served from the cache
+                if downloaded != responsecache.CACHED and (cache is None or not cache.offline):
+                    nrequests += 1
+                if not downloaded:
+                    writer.abort()
+                    if planner.failed(*chunk):
+                        logger.warning('Split {} into two requests'.format(epoch_to_show))
+                    else:
+                        logger.error("Error: Fail to download data for " + epoch_to_show)
+                        error_count += 1
+                        manifest.failed(kind, chunk[0], chunk[1], filename)
+                elif pipeline is not None:
+                    # The chunk is planned by the downloaded records, and saved while the next request is sent
+                    planner.done(chunk[0], chunk[1], counter.count)
+                    pipeline.submit(filename, writer, partial(saved, chunk, filename, epoch_to_show, counter.count))
+                else:
+                    try:
+                        writer.commit()
+                    except OSError as e:
+                        writer.abort()
+                        saved(chunk, filename, epoch_to_show, counter.count, None, e)
+                        planner.skip(*chunk)
+                    else:
+                        planner.done(chunk[0], chunk[1], counter.count)
+                        saved(chunk, filename, epoch_to_show, counter.count, writer, None)
 
         if error_count >= MAX_ERROR:
             break
 
+    if pipeline is not None:
+        # Wait for the files being saved (and loaded)
+        pipeline.close()
+        if pipeline.ingest_errors > 0:
+            logger.error('{} files failed to be loaded into {}'.format(pipeline.ingest_errors, args.ingest))
+            error_count += pipeline.ingest_errors
+
     if error_count > 0:
         logger.error("The number of errors is {}".format(error_count))
     if error_count >= MAX_ERROR:
         logger.critical("The number of errors reaches its Maximum Error Count")
 
-    logger.info("Downloaded: {} files, {} bytes in {} sec".format(tfiles , tsize, int(time.monotonic() - starttime)))
+    logger.info("Downloaded: {} files, {} bytes in {} sec ({} requests)".format(tfiles , tsize, int(time.monotonic() - starttime), nrequests))
+    metrics.inc('requests', nrequests)
+    metrics.inc('files', tfiles)
+    metrics.inc('bytes', tsize)
+    metrics.inc('errors', error_count)
     sys.exit(0 if error_count == 0 else 1)
 
 if __name__ == '__main__':
-    main()
+    run('download_gp_date', main)
 
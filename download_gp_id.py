@@ -8,85 +8,132 @@ import sys
 import os
 import math
 import argparse
-import subprocess
-from subprocess import PIPE
+from functools import partial
 import requests
 from setup_logger import setup_logger
+from metrics import get_metrics, run
+from ratelimiter import RateLimiter
+from compressedfile import CODECS, CompressedWriter, compressed_filename
+from downloadpipeline import DownloadPipeline, BufferWriter, TeeWriter, JOBS
+from manifest import Manifest, MANIFEST_FILE
+from chunkplanner import ChunkPlanner, RecordCounter, MAX_RECORDS, load_counts_by_id
+import responsecache
 import spacetrackaccount
 
 MAX_ERROR = 3
 MAX_RETRY = 2
-# Limit API queries to less than 30 requests per minute / 300 requests per hour
+# Base interval of the retry backoff. The request rate itself is limited by RateLimiter
 MIN_INTERVAL = 12 # sec
 
-def getdata(st, norad_cat_id, logger = None):
-    for i in range(MAX_RETRY + 1):
+def getdata(st, norad_cat_id, writer, counter, retry = MAX_RETRY, limiter = None, logger = None, metrics = None, cache = None):
+    entry = None
+    if cache is not None:
+        # A cached response is served without a request
+        query = responsecache.normalize_query('gp_history', {'norad_cat_id': norad_cat_id}, ['norad_cat_id', 'epoch'])
+        if cache.serve(query, writer, counter, metrics = metrics):
+            return responsecache.CACHED
+        if cache.offline:
+            return False
+        entry = cache.writer(query)
+        writer = TeeWriter(writer, entry)
+
+    for i in range(retry + 1):
         if i > 0:
-            logger.warning('Retry {}/{} for NORAD Catalog Number {}'.format(i, MAX_RETRY, norad_cat_id))
+            logger.warning('Retry {}/{} for NORAD Catalog Number {}'.format(i, retry, norad_cat_id))
             logger.debug('Sleep: %f secs', MIN_INTERVAL * 2 ** i)
             time.sleep(MIN_INTERVAL * 2 ** i)
-        elif getdata.lasttime > 0:
-            delta = time.monotonic() - getdata.lasttime
-            if delta < MIN_INTERVAL:
-                time.sleep(MIN_INTERVAL - delta)
-
+            if metrics is not None:
+                metrics.inc('retries')
+                metrics.observe('retry_sleep', MIN_INTERVAL * 2 ** i)
+
+        if limiter is not None:
+            # The budget is shared with the other download processes
+            slept = limiter.acquire()
+            if metrics is not None:
+                metrics.observe('ratelimit_sleep', slept)
         getdata.lasttime = time.monotonic()
 
         try:
-            data = st.gp_history(norad_cat_id=norad_cat_id, orderby=['norad_cat_id', 'epoch'], format='json')
+            data = st.gp_history(norad_cat_id=norad_cat_id, orderby=['norad_cat_id', 'epoch'], format='json', iter_content=True)
+
+            for chunk in data:
+                writer.write(chunk)
+                counter.feed(chunk)
 
         except requests.HTTPError as e:
             # Critical error. Don't retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'http_error')
             logger.error('HTTPError: ' + str(e))
             break
 
-        except (requests.ConnectionError, requests.Timeout) as e:
-            # Retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            logger.warning('ConnectionError: ' + str(e))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            # Retry. The connection may drop in the middle of the body, so discard the partial response
+            writer.reset()
+            counter.reset()
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'connection_error')
+            logger.warning('{}: {}'.format(type(e).__name__, e))
+
+        except OSError:
+            # The writer failed (e.g. disk full), not the request (requests' exceptions are OSError too). The caller aborts it
+            if entry is not None:
+                entry.abort()
+            raise
 
         else:
             # Success
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            return data
-
-    return None
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'ok')
+            if entry is not None:
+                entry.commit()
+            return responsecache.FETCHED
+
+    if entry is not None:
+        entry.abort()
+    return False
 
 getdata.lasttime = 0
 
-def savedata(data, filename, compress = True, force = False, logger = None):
-    if os.path.exists(filename) and not force:
-        logger.error(filename + ' already exists')
-        return False
-
-    with open(filename, 'w') as fp:
-        fp.write(data)
-
-    if not compress:
-        return True
-
-    program = ['xz', '-9', filename]
-    if force:
-        program.insert(1, '-f')
-    proc = subprocess.Popen(program, stdout=PIPE, stderr=PIPE, text=True)
-    (stdout, stderr) = proc.communicate()
-    if stdout != '' or stderr != '':
-        logger.error(stdout + stderr)
-        return False
-    else:
-        return True
-
 def main():
     logger = setup_logger('download_gp_id')
+    metrics = get_metrics('download_gp_id')
 
     parser = argparse.ArgumentParser(description='Download GP data of specified NORAD Catalog Number.')
     parser.add_argument('START', type=int, help='Start Catalog Number.')
     parser.add_argument('END', type=int, nargs='?', help='End Catalog Number. Default: same as START')
     parser.add_argument('CHUNK', type=int, nargs='?', default=1, help='Chunk size. Default: 1')
     parser.add_argument('-f', '--force', action='store_true', help='If the outpu file already exists, overwrite it.')
+    parser.add_argument('-z', '--codec', type=str, choices=list(CODECS), default='xz', help='Compression codec of the output file. Default: xz')
+    parser.add_argument('-l', '--level', type=int, help='Compression level. Default: 9 (xz, xz-mt), 19 (zstd)')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='Adapt the chunk size to the number of records. CHUNK is the initial chunk size.')
+    parser.add_argument('-m', '--max_records', type=int, default=MAX_RECORDS, help='Maximum number of records per request in adaptive mode. Default: {}'.format(MAX_RECORDS))
+    parser.add_argument('-d', '--database', type=str, help='SQLite3 database whose records are used to plan the chunks in adaptive mode.')
+    parser.add_argument('-t', '--table', type=str, default='elset', help='Table name of the database. Default: elset')
+    parser.add_argument('-r', '--resume', action='store_true', help='Download only the ranges which are not completed yet according to the manifest.')
+    parser.add_argument('-v', '--verify', action='store_true', help='Check the manifest and the files for holes in the archive. No data is downloaded.')
+    parser.add_argument('--manifest', type=str, default=MANIFEST_FILE, help='Manifest file. Default: {}'.format(MANIFEST_FILE))
+    parser.add_argument('-p', '--pipeline', action='store_true', help='Compress and save the responses in worker threads while the next request waits for the rate limit.')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS, help='Number of worker threads in pipeline mode. Default: {}'.format(JOBS))
+    parser.add_argument('--ingest', type=str, metavar='DATABASE', help='In pipeline mode, load each saved file into the SQLite3 database by json2sqlite3.py (table of -t).')
+    responsecache.add_arguments(parser)
     args = parser.parse_args()
+
+    if args.ingest is not None and not args.pipeline:
+        parser.error('--ingest requires -p')
+    if args.offline and args.no_cache:
+        parser.error('--offline requires the response cache')
     force = args.force
+    codec = args.codec
+    level = args.level
+    adaptive = args.adaptive
+    resume = args.resume
 
     start = args.START
     end = args.END if args.END is not None else start
@@ -96,23 +143,79 @@ def main():
         start, end = end, start
 
     nsats = end - start + 1
-    nfiles = math.ceil(nsats / unit)
 
     logger.info('Start: {}'.format(start))
     logger.info('End: {}'.format(end))
     logger.info('Number of Satellites: {}'.format(nsats))
-    logger.info('Number of Files: {}'.format(nfiles))
+    if not adaptive:
+        logger.info('Number of Files: {}'.format(math.ceil(nsats / unit)))
+
+    kind = 'gp_history/NORAD_CAT_ID'
+    manifest = Manifest(args.manifest)
+
+    if args.verify:
+        holes, bad = manifest.verify(kind, start, end)
+        for (lo, hi, filename, status, nbytes, records, sha256), reason in bad:
+            logger.error('{}: {}'.format(filename, reason))
+        for lo, hi in holes:
+            logger.error('Not downloaded: {}--{}'.format(lo, hi))
+        logger.info('{} holes, {} invalid files'.format(len(holes), len(bad)))
+        sys.exit(0 if len(holes) == 0 and len(bad) == 0 else 1)
+
+    completed = None
+    if resume:
+        completed = manifest.completed_units(kind, start, end)
+        logger.info('Number of Completed Satellites: {}'.format(len(completed)))
+
+    counts = None
+    if adaptive and args.database is not None:
+        counts = load_counts_by_id(args.database, args.table, start, end)
+        logger.info('Number of Satellites in Database: {}'.format(len(counts)))
+
+    planner = ChunkPlanner(start, end, chunk = unit, adaptive = adaptive, counts = counts, max_records = args.max_records,
+        completed = completed)
 
     st = SpaceTrackClient(spacetrackaccount.userid, spacetrackaccount.password)
+    limiter = RateLimiter(logger = logger)
+    cache = responsecache.from_arguments(args, logger)
+
+    pipeline = None
+    if args.pipeline:
+        pipeline = DownloadPipeline(codec, level, jobs = args.jobs, ingest = args.ingest, table = args.table, logger = logger, metrics = metrics)
 
     starttime = time.monotonic()
     tsize = 0
     tfiles = 0
     error_count = 0
-
-    for i in range(0, nfiles):
-        id1 = start + i * unit
-        id2 = min(start + (i + 1) * unit - 1, end)
+    nrequests = 0
+
+    # Called when a file is committed (writer) or failed to be saved (error)
+    def saved(chunk, filename, norad_cat_id, records, writer, error):
+        nonlocal tsize, tfiles, error_count
+        if error is not None:
+            logger.error(str(error))
+            logger.error("Error: Fail to save data for NORAD Catalog Number {}".format(norad_cat_id))
+            error_count += 1
+            manifest.failed(kind, chunk[0], chunk[1], filename)
+            return
+        tsize += writer.raw_bytes
+        tfiles += 1
+        logger.debug('{}: {} records'.format(filename, records))
+        metrics.inc('records', records)
+        metrics.inc('compressed_bytes', writer.compressed_bytes)
+        metrics.observe('compress', writer.elapsed)
+        manifest.done(kind, chunk[0], chunk[1], filename, writer.compressed_bytes, records)
+
+    while True:
+        if pipeline is not None:
+            pipeline.poll()
+            if error_count >= MAX_ERROR:
+                break
+
+        chunk = planner.next()
+        if chunk is None:
+            break
+        id1, id2 = chunk
 
         if id1 == id2:
             norad_cat_id = id1
@@ -121,32 +224,85 @@ def main():
             norad_cat_id = op.inclusive_range(id1, id2)
             filename = 'download/{}-{}.json'.format(id1, id2)
 
-        logger.info('Downloading NORAD Catalog Number {} ({}/{})'.format(norad_cat_id, i + 1, nfiles))
+        filename = compressed_filename(filename, codec)
 
-        data = getdata(st, norad_cat_id, logger=logger)
+        logger.info('Downloading NORAD Catalog Number {} ({}/{} satellites)'.format(norad_cat_id, planner.ndone + id2 - id1 + 1, nsats))
 
-        if data is None:
-            logger.error("Error: Fail to download data for NORAD Catalog Number {}".format(norad_cat_id))
-            error_count += 1
-        else:
-            tsize += len(data)
-            tfiles += 1
-            result = savedata(data, filename, force = force, logger = logger)
-            if not result:
+        if os.path.exists(filename) and not force:
+            if resume:
+                # Downloaded before the manifest existed
+                logger.info(filename + ' already exists. Skipped')
+                manifest.done(kind, chunk[0], chunk[1], filename, os.path.getsize(filename))
+            else:
+                # Don't waste a request for data which can't be saved
+                logger.error(filename + ' already exists')
                 logger.error("Error: Fail to save data for NORAD Catalog Number {}".format(norad_cat_id))
                 error_count += 1
+            planner.skip(*chunk)
+        else:
+            if pipeline is not None:
+                writer = BufferWriter()
+            else:
+                writer = CompressedWriter(filename, codec = codec, level = level, logger = logger)
+            counter = RecordCounter()
+            # In adaptive mode, a failed request of multiple satellites is split rather than retried
+            retry = MAX_RETRY if not adaptive or id1 == id2 else 0
+            try:
+                downloaded = getdata(st, norad_cat_id, writer, counter, retry=retry, limiter=limiter, logger=logger, metrics=metrics, cache=cache)
+            except OSError as e:
+                # The response can't be written (e.g. disk full). Counted as a failure to save, as in writer.commit() below
+                writer.abort()
+                saved(chunk, filename, norad_cat_id, counter.count, None, e)
+                planner.skip(*chunk)
+            else:
+                # Only the requests sent to Space-Track (none in offline mode), not the responses served from the cache
+                if downloaded != responsecache.CACHED and (cache is None or not cache.offline):
+                    nrequests += 1
+                if not downloaded:
+                    writer.abort()
+                    if planner.failed(*chunk):
+                        logger.warning('Split NORAD Catalog Number {} into two requests'.format(norad_cat_id))
+                    else:
+                        logger.error("Error: Fail to download data for NORAD Catalog Number {}".format(norad_cat_id))
+                        error_count += 1
+                        manifest.failed(kind, chunk[0], chunk[1], filename)
+                elif pipeline is not None:
+                    # The chunk is planned by the downloaded records, and saved while the next request is sent
+                    planner.done(chunk[0], chunk[1], counter.count)
+                    pipeline.submit(filename, writer, partial(saved, chunk, filename, norad_cat_id, counter.count))
+                else:
+                    try:
+                        writer.commit()
+                    except OSError as e:
+                        writer.abort()
+                        saved(chunk, filename, norad_cat_id, counter.count, None, e)
+                        planner.skip(*chunk)
+                    else:
+                        planner.done(chunk[0], chunk[1], counter.count)
+                        saved(chunk, filename, norad_cat_id, counter.count, writer, None)
 
         if error_count >= MAX_ERROR:
             break
 
+    if pipeline is not None:
+        # Wait for the files being saved (and loaded)
+        pipeline.close()
+        if pipeline.ingest_errors > 0:
+            logger.error('{} files failed to be loaded into {}'.format(pipeline.ingest_errors, args.ingest))
+            error_count += pipeline.ingest_errors
+
     if error_count > 0:
         logger.error("The number of errors is {}".format(error_count))
     if error_count >= MAX_ERROR:
         logger.critical("The number of errors reaches its Maximum Error Count")
 
-    logger.info("Downloaded: {} files, {} bytes in {} sec".format(tfiles , tsize, int(time.monotonic() - starttime)))
+    logger.info("Downloaded: {} files, {} bytes in {} sec ({} requests)".format(tfiles , tsize, int(time.monotonic() - starttime), nrequests))
+    metrics.inc('requests', nrequests)
+    metrics.inc('files', tfiles)
+    metrics.inc('bytes', tsize)
+    metrics.inc('errors', error_count)
     sys.exit(0 if error_count == 0 else 1)
 
 if __name__ == '__main__':
-    main()
+    run('download_gp_id', main)
 
@@ -9,85 +9,114 @@ import sys
 import os
 import math
 import argparse
-import subprocess
-from subprocess import PIPE
 import requests
 from setup_logger import setup_logger
+from metrics import get_metrics, run
+from ratelimiter import RateLimiter
+from compressedfile import CODECS, CompressedWriter, compressed_filename
+from downloadpipeline import TeeWriter
+import responsecache
 import spacetrackaccount
 
 MAX_RETRY = 2
-# Limit API queries to less than 30 requests per minute / 300 requests per hour
+# Base interval of the retry backoff. The request rate itself is limited by RateLimiter
 MIN_INTERVAL = 12 # sec
 
-def getdata(st, norad_cat_id = None, logger = None):
+def getdata(st, writer, norad_cat_id = None, limiter = None, logger = None, metrics = None, cache = None):
+    predicates = {}
+    if norad_cat_id is not None and len(norad_cat_id) > 0:
+        predicates['norad_cat_id'] = norad_cat_id
+
+    entry = None
+    if cache is not None:
+        # A cached response is served without a request
+        query = responsecache.normalize_query('satcat', predicates, ['norad_cat_id'])
+        if cache.serve(query, writer, metrics = metrics):
+            return responsecache.CACHED
+        if cache.offline:
+            return False
+        entry = cache.writer(query)
+        writer = TeeWriter(writer, entry)
+
     for i in range(MAX_RETRY + 1):
         if i > 0:
             logger.warning('Retry {}/{}'.format(i, MAX_RETRY))
             logger.debug('Sleep: %f secs', MIN_INTERVAL * 2 ** i)
             time.sleep(MIN_INTERVAL * 2 ** i)
-        elif getdata.lasttime > 0:
-            delta = time.monotonic() - getdata.lasttime
-            if delta < MIN_INTERVAL:
-                time.sleep(MIN_INTERVAL - delta)
-
+            if metrics is not None:
+                metrics.inc('retries')
+                metrics.observe('retry_sleep', MIN_INTERVAL * 2 ** i)
+
+        if limiter is not None:
+            # The budget is shared with the other download processes
+            slept = limiter.acquire()
+            if metrics is not None:
+                metrics.observe('ratelimit_sleep', slept)
         getdata.lasttime = time.monotonic()
 
         try:
-            if norad_cat_id is None or len(norad_cat_id) == 0:
-                data = st.satcat(orderby=['norad_cat_id'], format='json')
-            else:
-                data = st.satcat(norad_cat_id=norad_cat_id, orderby=['norad_cat_id'], format='json')
+            data = st.satcat(**predicates, orderby=['norad_cat_id'], format='json', iter_content=True)
+
+            for chunk in data:
+                writer.write(chunk)
 
         except requests.HTTPError as e:
             # Critical error. Don't retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'http_error')
             logger.error('HTTPError: ' + str(e))
             break
 
-        except (requests.ConnectionError, requests.Timeout) as e:
-            # Retry
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            logger.warning('ConnectionError: ' + str(e))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            # Retry. The connection may drop in the middle of the body, so discard the partial response
+            writer.reset()
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'connection_error')
+            logger.warning('{}: {}'.format(type(e).__name__, e))
+
+        except OSError:
+            # The writer failed (e.g. disk full), not the request (requests' exceptions are OSError too). The caller aborts it
+            if entry is not None:
+                entry.abort()
+            raise
 
         else:
             # Success
-            logger.debug('Response Time: %f secs', time.monotonic() - getdata.lasttime)
-            return data
-
-    return None
+            elapsed = time.monotonic() - getdata.lasttime
+            logger.debug('Response Time: %f secs', elapsed)
+            if metrics is not None:
+                metrics.observe('request', elapsed, result = 'ok')
+            if entry is not None:
+                entry.commit()
+            return responsecache.FETCHED
+
+    if entry is not None:
+        entry.abort()
+    return False
 
 getdata.lasttime = 0
 
-def savedata(data, filename, compress = True, force = False, logger = None):
-    if os.path.exists(filename) and not force:
-        logger.error(filename + ' already exists')
-        return False
-
-    with open(filename, 'w') as fp:
-        fp.write(data)
-
-    if not compress:
-        return True
-    program = ['xz', '-9', filename]
-    if force:
-        program.insert(1, '-f')
-    proc = subprocess.Popen(program, stdout=PIPE, stderr=PIPE, text=True)
-    (stdout, stderr) = proc.communicate()
-    if stdout != '' or stderr != '':
-        logger.error(stdout + stderr)
-        return False
-    else:
-        return True
-
 def main():
     logger = setup_logger('download_satcat')
+    metrics = get_metrics('download_satcat')
 
     parser = argparse.ArgumentParser(description='Download SATCAT data of specified NORAD Catalog Number.')
     parser.add_argument('CAT_ID', type=str, nargs='*', help='NORAD Catalog Number.')
     parser.add_argument('-o', '--output', type=str, help='Output file.')
     parser.add_argument('-f', '--force', action='store_true', help='If the outpu file already exists, overwrite it.')
+    parser.add_argument('-z', '--codec', type=str, choices=list(CODECS), default='xz', help='Compression codec of the output file. Default: xz')
+    parser.add_argument('-l', '--level', type=int, help='Compression level. Default: 9 (xz, xz-mt), 19 (zstd)')
+    responsecache.add_arguments(parser)
     args = parser.parse_args()
+    if args.offline and args.no_cache:
+        parser.error('--offline requires the response cache')
     force = args.force
+    codec = args.codec
+    level = args.level
 
     norad_cat_id = op._stringify_predicate_value(args.CAT_ID)
 
@@ -100,25 +129,40 @@ def main():
         filename = 'download/satcat-{:%Y%m%d%H%M%S}.json'.format(datetime.now())
     else:
         filename = args.output
+    filename = compressed_filename(filename, codec)
     logger.info('Filename: {}'.format(filename))
 
     st = SpaceTrackClient(spacetrackaccount.userid, spacetrackaccount.password)
+    limiter = RateLimiter(logger = logger)
+    cache = responsecache.from_arguments(args, logger)
 
     starttime = time.monotonic()
     tsize = 0
     tfiles = 0
     error_count = 0
 
-    data = getdata(st, norad_cat_id, logger=logger)
-
-    if data is None:
-        logger.error("Error: Fail to download data")
+    if os.path.exists(filename) and not force:
+        # Don't waste a request for data which can't be saved
+        logger.error(filename + ' already exists')
+        logger.error("Error: Fail to save data")
         error_count += 1
     else:
-        tsize += len(data)
-        tfiles += 1
-        result = savedata(data, filename, force = force, logger = logger)
-        if not result:
+        writer = CompressedWriter(filename, codec = codec, level = level, logger = logger)
+        try:
+            if not getdata(st, writer, norad_cat_id, limiter=limiter, logger=logger, metrics=metrics, cache=cache):
+                writer.abort()
+                logger.error("Error: Fail to download data")
+                error_count += 1
+            else:
+                writer.commit()
+                tsize += writer.raw_bytes
+                tfiles += 1
+                metrics.inc('compressed_bytes', writer.compressed_bytes)
+                metrics.observe('compress', writer.elapsed)
+        except OSError as e:
+            # The response can't be written (e.g. disk full)
+            writer.abort()
+            logger.error(str(e))
             logger.error("Error: Fail to save data")
             error_count += 1
 
@@ -126,8 +170,11 @@ def main():
         logger.error("The number of errors is {}".format(error_count))
 
     logger.info("Downloaded: {} files, {} bytes in {} sec".format(tfiles , tsize, int(time.monotonic() - starttime)))
+    metrics.inc('files', tfiles)
+    metrics.inc('bytes', tsize)
+    metrics.inc('errors', error_count)
     sys.exit(0 if error_count == 0 else 1)
 
 if __name__ == '__main__':
-    main()
+    run('download_satcat', main)
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from compressedfile import CompressedWriter
+
+# Default number of threads compressing and saving responses
+JOBS = 2
+
+# Keeps a response in memory (as bytes) until it is handed to DownloadPipeline. Used in place of CompressedWriter by getdata().
+class BufferWriter:
+
+    def __init__(self):
+        self.chunks = []
+        self.raw_bytes = 0
+
+    def write(self, data):
+        # The chunks of spacetrack are str. Kept as bytes, so that b''.join(chunks) is the response
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+        self.raw_bytes += len(data)
+
+    def reset(self):
+        self.chunks = []
+        self.raw_bytes = 0
+
+    def abort(self):
+        self.reset()
+
+# Writes a response to several writers, e.g. to a BufferWriter for processing and to a CompressedWriter for the archive
+class TeeWriter:
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def write(self, data):
+        for writer in self.writers:
+            writer.write(data)
+
+    def reset(self):
+        for writer in self.writers:
+            writer.reset()
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+# Pipelined download. The main thread only waits for the rate limiter and receives the responses,
+# and worker threads compress and save them (lzma, zstandard and the xz process don't hold the GIL),
+# so the compression and the disk I/O of a chunk are hidden in the rate-limit wait for the next one.
+# Optionally the saved files are loaded into a database by json2sqlite3.py, one at a time in download order.
+#
+# submit() blocks while 2 * jobs responses are waiting, so at most that many responses are held in memory.
+# The callback of submit() is called in the main thread (from submit(), poll() or close()) in submission order,
+# with the committed CompressedWriter, or with the OSError raised while saving.
+class DownloadPipeline:
+
+    def __init__(self, codec = 'xz', level = None, jobs = JOBS, ingest = None, table = 'elset', logger = None, metrics = None):
+        self.codec = codec
+        self.level = level
+        self.jobs = jobs
+        self.logger = logger
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers = jobs)
+        self.pending = collections.deque()
+        self.ingest = ingest
+        self.table = table
+        self.ingest_executor = ThreadPoolExecutor(max_workers = 1) if ingest is not None else None
+        self.ingests = []
+        self.ingest_errors = 0
+
+    def _save(self, filename, chunks):
+        writer = CompressedWriter(filename, codec = self.codec, level = self.level, logger = self.logger)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        return writer
+
+    def _load(self, filename):
+        starttime = time.monotonic()
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json2sqlite3.py')
+        proc = subprocess.run([sys.executable, script, filename, self.ingest, self.table],
+            stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+        return filename, proc.returncode, proc.stderr.decode(errors = 'replace'), time.monotonic() - starttime
+
+    def submit(self, filename, buffer, callback):
+        while len(self.pending) >= 2 * self.jobs:
+            self._complete(self.pending.popleft())
+        self.pending.append((self.executor.submit(self._save, filename, buffer.chunks), filename, callback))
+
+    def _complete(self, item):
+        future, filename, callback = item
+        t = time.monotonic()
+        try:
+            writer = future.result()
+        except OSError as e:
+            callback(None, e)
+            return
+        finally:
+            if self.metrics is not None:
+                # Time the main thread waited for the workers (0 if they keep up with the requests)
+                self.metrics.observe('pipeline_wait', time.monotonic() - t)
+        callback(writer, None)
+        if self.ingest_executor is not None:
+            self.ingests.append(self.ingest_executor.submit(self._load, filename))
+
+    # Process the saved responses without blocking
+    def poll(self):
+        while len(self.pending) > 0 and self.pending[0][0].done():
+            self._complete(self.pending.popleft())
+
+    # Wait for all responses to be saved (and loaded)
+    def close(self):
+        while len(self.pending) > 0:
+            self._complete(self.pending.popleft())
+        self.executor.shutdown()
+        if self.ingest_executor is not None:
+            for future in self.ingests:
+                filename, returncode, stderr, elapsed = future.result()
+                if self.metrics is not None:
+                    self.metrics.observe('ingest', elapsed)
+                if returncode != 0:
+                    self.ingest_errors += 1
+                    if self.logger is not None:
+                        self.logger.error('Failed to load {} into {}: {}'.format(filename, self.ingest, (stderr.strip().splitlines() or ['exit code {}'.format(returncode)])[-1]))
+            self.ingest_executor.shutdown()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import collections
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from gpjson import is_parquet
+import elsetschema
+import tlestore
+import asofindex
+
+# Upper limit of the memory used by the cache of ElsetDB (bytes)
+CACHE_BYTES = 1024 * 1024 * 1024
+
+# Columns always returned (the key of the cache and the order of the results)
+KEY_COLUMNS = ['NORAD_CAT_ID', 'EPOCH', 'GP_ID']
+
+# Timestamp columns of the elset table (text in SQLite, timestamp in Parquet)
+TIMESTAMP_COLUMNS = ['EPOCH', 'CREATION_DATE', 'LAUNCH_DATE', 'DECAY_DATE']
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return pd.Timestamp(value).to_pydatetime()
+
+# Elsets in a SQLite3 database created by json2sqlite3.py (text or compact timestamps)
+class SQLiteSource:
+
+    def __init__(self, filename, table = 'elset'):
+        self.con = sqlite3.connect(filename)
+        self.table = table
+        self.columns = [row[1] for row in self.con.execute('PRAGMA table_info({})'.format(table))]
+        if len(self.columns) == 0:
+            raise ValueError('{}: no table {}'.format(filename, table))
+        self.compact = elsetschema.is_compact(self.con, table)
+        # TLE lines stored in TABLE_tle (json2sqlite3.py -s) are joined only when they are requested
+        self.tle = None
+        if 'TLE_LINE1' not in self.columns and tlestore.has_store(self.con, table):
+            self.tle = tlestore.TLEReader(self.con, table)
+        self.asof = asofindex.has_index(self.con, table)
+
+    def close(self):
+        self.con.close()
+
+    # Columns of the query and the TLE columns joined after the query
+    def _split(self, columns):
+        tle = [c for c in columns if c in tlestore.TLE_COLUMNS] if self.tle is not None else []
+        if len(tle) == 0:
+            return columns, tle
+        return [c for c in columns if c not in tle] + [c for c in tlestore.READ_COLUMNS if c not in columns], tle
+
+    def _join_lines(self, df, columns, tle):
+        if len(tle) == 0:
+            return df
+        return self.tle.add_lines(df, tle)[columns]
+
+    # The IDs are passed in a temporary table, so that any number of objects is read in one query.
+    # The INSERT starts a transaction in sqlite3, which is committed at once: otherwise the connection keeps
+    # the database locked and writers (json2sqlite3.py, update.py) fail with "database is locked".
+    def _where(self, norad_cat_ids, start, end):
+        conditions = []
+        params = []
+        if norad_cat_ids is not None:
+            self.con.execute('CREATE TEMP TABLE IF NOT EXISTS query_id (NORAD_CAT_ID integer primary key)')
+            self.con.execute('DELETE FROM temp.query_id')
+            self.con.executemany('INSERT OR IGNORE INTO temp.query_id VALUES (?)', ((int(x),) for x in norad_cat_ids))
+            self.con.commit()
+            conditions.append('NORAD_CAT_ID IN (SELECT NORAD_CAT_ID FROM temp.query_id)')
+        if start is not None:
+            conditions.append('EPOCH >= ?')
+            params.append(elsetschema.to_param(start, self.compact))
+        if end is not None:
+            conditions.append('EPOCH < ?')
+            params.append(elsetschema.to_param(end, self.compact))
+        return (' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''), params
+
+    def read(self, columns, norad_cat_ids = None, start = None, end = None):
+        select, tle = self._split(columns)
+        where, params = self._where(norad_cat_ids, start, end)
+        sql = 'SELECT {} FROM {}{}'.format(', '.join(select), self.table, where)
+        return self._join_lines(pd.read_sql_query(sql, self.con, params = params), columns, tle)
+
+    # The newest elset of each object with EPOCH <= t (and EPOCH >= start)
+    def latest(self, columns, t, norad_cat_ids = None, start = None):
+        select, tle = self._split(columns)
+        if self.asof:
+            return self._join_lines(self._latest_asof(select, t, norad_cat_ids, start), columns, tle)
+        where, params = self._where(norad_cat_ids, start, None)
+        where += (' AND ' if where != '' else ' WHERE ') + 'EPOCH <= ?'
+        params.append(elsetschema.to_param(t, self.compact))
+        sql = '''SELECT {0} FROM {1} JOIN (SELECT NORAD_CAT_ID, MAX(EPOCH) AS EPOCH FROM {1}{2} GROUP BY NORAD_CAT_ID)
+            USING (NORAD_CAT_ID, EPOCH)'''.format(', '.join('{}.{}'.format(self.table, c) for c in select), self.table, where)
+        return self._join_lines(pd.read_sql_query(sql, self.con, params = params), columns, tle)
+
+    # latest() with the as-of index (asofindex.py): one probe per object instead of a GROUP BY over the table
+    def _latest_asof(self, columns, t, norad_cat_ids, start):
+        objects = None
+        if norad_cat_ids is not None:
+            self._where(norad_cat_ids, None, None)
+            objects = 'SELECT NORAD_CAT_ID AS n FROM temp.query_id'
+        sql = 'SELECT {} FROM ({}) s JOIN {} USING (GP_ID)'.format(', '.join('{}.{}'.format(self.table, c) for c in columns),
+            asofindex.snapshot_query(self.table, objects), self.table)
+        params = [elsetschema.to_param(t, self.compact)]
+        if start is not None:
+            sql += ' WHERE {}.EPOCH >= ?'.format(self.table)
+            params.append(elsetschema.to_param(start, self.compact))
+        return pd.read_sql_query(sql, self.con, params = params)
+
+# Elsets in a Parquet file or a partitioned dataset created by json2parquet.py
+class ParquetSource:
+
+    def __init__(self, filename):
+        import pyarrow.dataset as ds
+        self.ds = ds
+        self.dataset = ds.dataset(filename, format = 'parquet', partitioning = 'hive' if os.path.isdir(filename) else None)
+        self.columns = [c for c in self.dataset.schema.names if c not in ('EPOCH_YEAR', 'EPOCH_MONTH')]
+        self.partitioned = 'EPOCH_YEAR' in self.dataset.schema.names
+
+    def close(self):
+        pass
+
+    def _filter(self, norad_cat_ids, start, end):
+        import pyarrow as pa
+        field = self.ds.field
+        conditions = []
+        if norad_cat_ids is not None:
+            conditions.append(field('NORAD_CAT_ID').isin(pa.array([int(x) for x in norad_cat_ids], type = pa.uint32())))
+        for value, op in ((start, '>='), (end, '<')):
+            if value is None:
+                continue
+            scalar = pa.scalar(value, type = pa.timestamp('ns'))
+            conditions.append(field('EPOCH') >= scalar if op == '>=' else field('EPOCH') < scalar)
+            # Skip the partitions by their paths
+            if self.partitioned:
+                conditions.append(field('EPOCH_YEAR') >= value.year if op == '>=' else field('EPOCH_YEAR') <= value.year)
+        if len(conditions) == 0:
+            return None
+        expr = conditions[0]
+        for c in conditions[1:]:
+            expr = expr & c
+        return expr
+
+    def read(self, columns, norad_cat_ids = None, start = None, end = None):
+        return self.dataset.to_table(columns = columns, filter = self._filter(norad_cat_ids, start, end)).to_pandas()
+
+    def latest(self, columns, t, norad_cat_ids = None, start = None):
+        df = self.read(columns, norad_cat_ids, start, t + timedelta(microseconds = 1))
+        return df.sort_values(['NORAD_CAT_ID', 'EPOCH']).drop_duplicates('NORAD_CAT_ID', keep = 'last')
+
+# Query elsets of the database created by json2sqlite3.py or the Parquet output of json2parquet.py.
+#
+#   db = ElsetDB('db/elset.sqlite3', satcat = 'db/satcat.sqlite3')
+#   df = db.get_elsets([25544, 43013], '2020-01-01', '2020-07-01', ['SEMIMAJOR_AXIS', 'ECCENTRICITY'])
+#   df = db.latest_as_of('2020-10-10', lookback = 30)
+#   df = db.join_satcat('INCLINATION BETWEEN 80 AND 100 AND APOGEE BETWEEN 600 AND 750', start = '2013-06-30')
+#
+# The IDs, the EPOCH range and the columns are passed to SQLite / Arrow, so only the requested data is read,
+# and the objects of a query are read at once. The results of get_elsets() are cached per object,
+# and the least recently used objects are dropped when the cache exceeds cache_bytes.
+# Timestamps are returned as datetime64, and rows are sorted by NORAD_CAT_ID and EPOCH.
+# If the TLE lines are stored in TABLE_tle (json2sqlite3.py -s), TLE_LINE0-2 are returned only when they are in `columns`.
+class ElsetDB:
+
+    def __init__(self, filename, table = 'elset', satcat = None, satcat_table = 'satcat', cache_bytes = CACHE_BYTES):
+        if is_parquet(filename):
+            self.source = ParquetSource(filename)
+        else:
+            self.source = SQLiteSource(filename, table)
+        self.satcat_file = satcat
+        self.satcat_table = satcat_table
+        self.cache_bytes = cache_bytes
+        # (NORAD_CAT_ID, columns) -> (start, end, DataFrame)
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.source.close()
+
+    @property
+    def columns(self):
+        return self.source.columns
+
+    def _columns(self, columns):
+        if columns is None:
+            return list(self.source.columns)
+        return KEY_COLUMNS + [c for c in columns if c not in KEY_COLUMNS]
+
+    @staticmethod
+    def _normalize(df):
+        for column in TIMESTAMP_COLUMNS:
+            if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = pd.Series(np.asarray(df[column].to_numpy(dtype = object), dtype = 'datetime64[us]'), index = df.index)
+        return df.sort_values(['NORAD_CAT_ID', 'EPOCH']).reset_index(drop = True)
+
+    def _cache_get(self, key, start, end):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        (start1, end1, df) = entry
+        if (start1 is not None and (start is None or start < start1)) or (end1 is not None and (end is None or end > end1)):
+            return None
+        self.cache.move_to_end(key)
+        if start is not None:
+            df = df[df['EPOCH'] >= start]
+        if end is not None:
+            df = df[df['EPOCH'] < end]
+        return df
+
+    def _cache_put(self, key, start, end, df):
+        if key in self.cache:
+            self.cached_bytes -= self.cache.pop(key)[2].memory_usage(deep = True).sum()
+        nbytes = df.memory_usage(deep = True).sum()
+        if nbytes > self.cache_bytes:
+            return
+        self.cache[key] = (start, end, df)
+        self.cached_bytes += nbytes
+        while self.cached_bytes > self.cache_bytes:
+            self.cached_bytes -= self.cache.popitem(last = False)[1][2].memory_usage(deep = True).sum()
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cached_bytes = 0
+
+    # Elsets of the objects with start <= EPOCH < end. norad_cat_ids: list of NORAD Catalog Numbers (None: all objects).
+    # start, end: datetime or str (None: unbounded). columns: list of columns (None: all columns).
+    def get_elsets(self, norad_cat_ids = None, start = None, end = None, columns = None):
+        start = _to_datetime(start)
+        end = _to_datetime(end)
+        columns = self._columns(columns)
+        if norad_cat_ids is None:
+            return self._normalize(self.source.read(columns, None, start, end))
+
+        key_columns = tuple(columns)
+        norad_cat_ids = sorted(set(int(x) for x in norad_cat_ids))
+        dfs = {}
+        missing = []
+        for norad_cat_id in norad_cat_ids:
+            df = self._cache_get((norad_cat_id, key_columns), start, end)
+            if df is None:
+                missing.append(norad_cat_id)
+            else:
+                dfs[norad_cat_id] = df
+        self.hits += len(dfs)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            # The objects not in the cache are read in one query
+            df = self._normalize(self.source.read(columns, missing, start, end))
+            ids = df['NORAD_CAT_ID'].to_numpy()
+            bounds = np.searchsorted(ids, missing + [np.iinfo('int64').max])
+            for i, norad_cat_id in enumerate(missing):
+                part = df.iloc[bounds[i]:bounds[i + 1]].reset_index(drop = True)
+                self._cache_put((norad_cat_id, key_columns), start, end, part)
+                dfs[norad_cat_id] = part
+
+        result = pd.concat([dfs[x] for x in norad_cat_ids], ignore_index = True) if len(norad_cat_ids) > 0 else pd.DataFrame(columns = columns)
+        return result
+
+    # The newest elset of each object with EPOCH <= t. Objects whose newest elset is older than
+    # `lookback` days are omitted (None: no limit, which reads the whole history).
+    def latest_as_of(self, t, norad_cat_ids = None, columns = None, lookback = None):
+        t = _to_datetime(t)
+        start = t - timedelta(days = lookback) if lookback is not None else None
+        df = self._normalize(self.source.latest(self._columns(columns), t, norad_cat_ids, start))
+        # Elsets with the same EPOCH: the one published last
+        return df.sort_values(['NORAD_CAT_ID', 'EPOCH', 'GP_ID']).drop_duplicates('NORAD_CAT_ID', keep = 'last').reset_index(drop = True)
+
+    # Rows of the SATCAT database created by satcat2sqlite3.py. where: SQL condition (e.g. "OBJECT_TYPE = 'PAYLOAD'")
+    def satcat(self, where = None, params = (), columns = None):
+        if self.satcat_file is None:
+            raise ValueError('SATCAT database is not specified')
+        sql = 'SELECT {} FROM {}'.format(', '.join(columns) if columns is not None else '*', self.satcat_table)
+        if where is not None:
+            sql += ' WHERE ' + where
+        with sqlite3.connect(self.satcat_file) as con:
+            return pd.read_sql_query(sql + ' ORDER BY NORAD_CAT_ID', con, params = params)
+
+    # Elsets of the objects selected by a condition on SATCAT, with the SATCAT columns
+    # (suffixed with _SATCAT if they conflict with the elset columns)
+    def join_satcat(self, where = None, params = (), start = None, end = None, columns = None, satcat_columns = None):
+        if satcat_columns is not None and 'NORAD_CAT_ID' not in satcat_columns:
+            satcat_columns = ['NORAD_CAT_ID'] + list(satcat_columns)
+        satcat = self.satcat(where, params, satcat_columns)
+        elsets = self.get_elsets(satcat['NORAD_CAT_ID'].tolist(), start, end, columns)
+        return elsets.merge(satcat, on = 'NORAD_CAT_ID', how = 'left', suffixes = ('', '_SATCAT'))
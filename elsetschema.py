@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, date, timedelta
+
+# Compact layout of the elset tables of json2sqlite3.py (--compact, or converted by compactdb.py).
+# CREATION_DATE and EPOCH are stored as integers, microseconds since 1970-01-01 00:00:00 UTC,
+# instead of the text 'YYYY-MM-DD HH:MM:SS.ffffff' (26 bytes). An integer takes at most 8 bytes in a record
+# and in an index, and compares as a number, so the range scans on EPOCH and CREATION_DATE are faster.
+# The view <table>_text returns the table in the text layout, with EPOCH_JD (Julian date of EPOCH, as sgp4 uses).
+#
+# The layout of a table is told by the declared type of EPOCH (integer), so the scripts work with both layouts.
+
+# Columns stored as microseconds in the compact layout
+TIMESTAMP_COLUMNS = ['CREATION_DATE', 'EPOCH']
+
+# Microseconds of a day
+DAY = 86400 * 1000000
+
+# Julian date of 1970-01-01 00:00:00
+JD_1970 = 2440587.5
+
+# date.toordinal() of 1970-01-01
+ORDINAL_1970 = 719163
+
+_DATETIME_1970 = datetime(1970, 1, 1)
+
+# True if the table is in the compact layout (False if it doesn't exist)
+def is_compact(con, table):
+    for row in con.execute('PRAGMA table_info({})'.format(table)):
+        if row[1] == 'EPOCH':
+            return 'INT' in row[2].upper()
+    return False
+
+# Text of a timestamp ('2020-10-10T05:12:34.123456', '2020-10-10 05:12:34' or '2020-10-10') or datetime to microseconds
+def to_microseconds(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return (value - _DATETIME_1970) // timedelta(microseconds = 1)
+    # Parsed by hand, as strptime() is slow for millions of records
+    days = date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - ORDINAL_1970
+    seconds = days * 86400
+    if len(value) > 10:
+        seconds += int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+    fraction = value[20:26]
+    return seconds * 1000000 + (int(fraction.ljust(6, '0')) if fraction != '' else 0)
+
+def from_microseconds(value):
+    if value is None:
+        return None
+    return _DATETIME_1970 + timedelta(microseconds = value)
+
+# A timestamp read from a table of either layout to datetime
+def to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return from_microseconds(value if isinstance(value, int) else to_microseconds(value))
+
+# Value to compare with a timestamp column in a query (datetime -> text or microseconds)
+def to_param(value, compact):
+    if compact:
+        return to_microseconds(value)
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+# Convert the timestamps of rows (tuples) of the given columns to microseconds
+def compact_rows(rows, columns):
+    index = [i for i, column in enumerate(columns) if column in TIMESTAMP_COLUMNS]
+    for row in rows:
+        row = list(row)
+        for i in index:
+            row[i] = to_microseconds(row[i])
+        yield row
+
+# SQL expression converting a text timestamp column to microseconds (exact, unlike julianday())
+def sql_to_microseconds(column):
+    return "(CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 + CAST(substr({0} || '000000', 21, 6) AS INTEGER))".format(column)
+
+# SQL expression converting a microseconds column to the text 'YYYY-MM-DD HH:MM:SS.ffffff' (also before 1970)
+def sql_to_text(column):
+    return "(strftime('%Y-%m-%d %H:%M:%S', {0} / 1000000 - ({0} % 1000000 < 0), 'unixepoch') || printf('.%06d', ({0} % 1000000 + 1000000) % 1000000))".format(column)
+
+# SQL expression of the day (days since 1970-01-01) of a microseconds column
+def sql_day(column):
+    return '(({0} - ({0} % {1} + {1}) % {1}) / {1})'.format(column, DAY)
+
+# View <table>_text of a compact table, with the columns of the text layout and EPOCH_JD
+def create_text_view(cur, table):
+    columns = [row[1] for row in cur.execute('PRAGMA table_info({})'.format(table))]
+    select = [sql_to_text(column) + ' AS ' + column if column in TIMESTAMP_COLUMNS else column for column in columns]
+    select.append('{} + EPOCH / {}.0 AS EPOCH_JD'.format(JD_1970, DAY))
+    cur.execute('DROP VIEW IF EXISTS {}_text'.format(table))
+    cur.execute('CREATE VIEW {0}_text AS SELECT {1} FROM {0}'.format(table, ', '.join(select)))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Generate synthetic gp / gp_history JSON in the format of Space-Track API (all values are strings),
+# with the columns of the `dtype` schema of json2sqlite3.py, duplicated records and nulls.
+# Used by benchmark.py, so that the benchmarks don't depend on a local download archive.
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from compressedfile import CompressedWriter
+from tleformat import tle_checksum, tle_exponent, catalog_number
+
+# Earth's gravitational parameter [km^3/s^2] and equatorial radius [km]
+MU = 398600.4418
+EARTH_RADIUS = 6378.135
+
+DAY_US = 86400 * 1000000
+
+# Round x to the 5 significant digits of the TLE
+def tle_round(x):
+    if x == 0:
+        return 0.0
+    e = int(np.floor(np.log10(abs(x)))) + 1
+    return round(x / 10.0 ** e, 5) * 10.0 ** e
+
+# Synthetic records as a dict of numpy arrays, in the order they are published (GP_ID order).
+# A fraction `duplicates` of the records appears again a little later with the same GP_ID.
+def generate(rows, objects = 1000, start = '2000-01-01', days = 3650, duplicates = 0.05, nulls = 0.02, seed = 0,
+        first_gp_id = 1000000, first_norad_cat_id = 1):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(start, 'us').astype('int64')
+
+    # Objects: 70% LEO, 10% MEO, 10% GEO, 10% HEO
+    kind = rng.choice(4, objects, p = [0.7, 0.1, 0.1, 0.1])
+    peri = np.choose(kind, [rng.uniform(250, 1500, objects), rng.uniform(19000, 23000, objects),
+        rng.uniform(35700, 35800, objects), rng.uniform(250, 1000, objects)])
+    apo = np.choose(kind, [peri + rng.exponential(20, objects), peri + rng.uniform(0, 100, objects),
+        peri + rng.uniform(0, 80, objects), rng.uniform(35000, 40000, objects)])
+    a0 = (peri + apo) / 2 + EARTH_RADIUS
+    ecc0 = (apo - peri) / (apo + peri + 2 * EARTH_RADIUS)
+    inc = np.choose(kind, [rng.uniform(0, 100, objects), rng.uniform(50, 65, objects),
+        rng.uniform(0, 15, objects), rng.uniform(60, 65, objects)])
+    raan0 = rng.uniform(0, 360, objects)
+    argp0 = rng.uniform(0, 360, objects)
+    bstar = np.where(kind == 0, rng.lognormal(np.log(1e-4), 1.0, objects), 0.0)
+    # Semimajor axis decays by up to 2% over the period (LEO only)
+    decay = np.where(kind == 0, rng.uniform(0, 0.02, objects), 0.0)
+    launch = start - rng.integers(0, 20 * 365, objects) * DAY_US
+    launch -= launch % DAY_US
+    launch_year = launch.astype('datetime64[us]').astype('datetime64[Y]').astype('int64') + 1970
+    launch_no = rng.integers(1, 200, objects)
+    piece = np.array(list('ABCDEFGH'))[rng.integers(0, 8, objects)]
+    objtype = np.array(['PAYLOAD', 'ROCKET BODY', 'DEBRIS', 'UNKNOWN'])[rng.choice(4, objects, p = [0.4, 0.1, 0.45, 0.05])]
+    rcs = np.array(['SMALL', 'MEDIUM', 'LARGE'])[rng.integers(0, 3, objects)]
+    country = np.array(['US', 'CIS', 'PRC', 'JPN', 'FR', 'ESA'])[rng.integers(0, 6, objects)]
+    site = np.array(['AFETR', 'TYMSC', 'JSC', 'TNSTA', 'FRGUI', 'AFWTR'])[rng.integers(0, 6, objects)]
+    isnull = rng.random(objects) < nulls
+
+    # Records: published at a constant rate, each EPOCH 1-36 hours before CREATION_DATE
+    obj = rng.integers(0, objects, rows)
+    creation = start + (np.arange(rows) * (days * DAY_US / max(rows, 1))).astype('int64') + DAY_US
+    creation -= creation % 1000000
+    epoch = creation - rng.integers(3600, 36 * 3600, rows) * 1000000
+    # EPOCH with the resolution of the TLE (1e-8 day)
+    epoch = (np.round(epoch / (DAY_US * 1e-8)) * (DAY_US * 1e-8)).astype('int64')
+    frac = (epoch - start) / (days * DAY_US)
+    a = a0[obj] * (1 - decay[obj] * frac)
+    ecc = np.round(ecc0[obj], 7)
+    mean_motion = np.round(np.sqrt(MU / a ** 3) * 86400 / (2 * np.pi), 8)
+    a = (MU / (mean_motion * 2 * np.pi / 86400) ** 2) ** (1 / 3)
+    elapsed_days = (epoch - start) / DAY_US
+    raan = np.round((raan0[obj] - 5.0 * elapsed_days * np.cos(np.radians(inc[obj]))) % 360, 4)
+    argp = np.round((argp0[obj] + 3.0 * elapsed_days) % 360, 4)
+    mean_anomaly = np.round(rng.uniform(0, 360, rows), 4)
+    mean_motion_dot = np.round(np.where(kind[obj] == 0, decay[obj] * mean_motion * 1.5 / days / 2, 0.0), 8)
+    rev = ((epoch - launch[obj]) / DAY_US * mean_motion).astype('int64') % 100000
+
+    # ELEMENT_SET_NO: count of the elsets of the object
+    order = np.argsort(obj, kind = 'stable')
+    starts = np.flatnonzero(np.r_[True, obj[order][1:] != obj[order][:-1]])
+    rank = np.arange(rows) - np.repeat(starts, np.diff(np.r_[starts, rows]))
+    element_set_no = np.empty(rows, dtype = 'int64')
+    element_set_no[order] = rank % 999 + 1
+
+    # Duplicates: a copy of a record is inserted up to 1000 records later
+    ndup = int(rows * duplicates)
+    dup = rng.choice(rows, ndup) if ndup > 0 and rows > 0 else np.zeros(0, dtype = 'int64')
+    index = np.r_[np.arange(rows), dup]
+    position = np.r_[np.arange(rows), dup + rng.integers(1, 1000, ndup)].astype('float64')
+    position[rows:] += 0.5
+    index = index[np.argsort(position, kind = 'stable')]
+
+    # DECAY_DATE: some objects decayed a day after their last EPOCH
+    last = np.full(objects, np.iinfo('int64').min)
+    np.maximum.at(last, obj, epoch)
+    decayed = (rng.random(objects) < 0.1) & (last > start)
+    decay_date = np.where(decayed, last - last % DAY_US + DAY_US, 0)
+
+    return {'index': index, 'obj': obj, 'creation': creation, 'epoch': epoch, 'mean_motion': mean_motion, 'ecc': ecc,
+        'inc': np.round(inc, 4), 'raan': raan, 'argp': argp, 'mean_anomaly': mean_anomaly, 'bstar': bstar,
+        'mean_motion_dot': mean_motion_dot, 'a': a, 'rev': rev, 'element_set_no': element_set_no,
+        'gp_id': first_gp_id + np.arange(rows), 'file': 2000000 + (creation - start) // (3600 * 1000000),
+        'norad_cat_id': first_norad_cat_id + np.arange(objects), 'launch': launch, 'launch_year': launch_year,
+        'launch_no': launch_no, 'piece': piece, 'objtype': objtype, 'rcs': rcs, 'country': country, 'site': site,
+        'isnull': isnull, 'decayed': decayed, 'decay_date': decay_date}
+
+# Records (dicts of strings) of data['index'][begin:end]
+def iter_records(data, begin = 0, end = None):
+    index = data['index'][begin:end]
+    creation = np.datetime_as_string(data['creation'][index].astype('datetime64[us]'), unit = 's')
+    epoch = data['epoch'][index].astype('datetime64[us]')
+    epoch_text = np.datetime_as_string(epoch, unit = 'us')
+    year = epoch.astype('datetime64[Y]')
+    doy = (epoch - year).astype('int64') / DAY_US + 1
+    yy = (year.astype('int64') + 1970) % 100
+    for k, i in enumerate(index.tolist()):
+        j = int(data['obj'][i])
+        isnull = data['isnull'][j]
+        norad_cat_id = int(data['norad_cat_id'][j])
+        object_id = '{}-{:03d}{}'.format(data['launch_year'][j], data['launch_no'][j], data['piece'][j])
+        mean_motion = float(data['mean_motion'][i])
+        ecc = float(data['ecc'][i])
+        a = float(data['a'][i])
+        bstar = tle_round(float(data['bstar'][j]))
+        ndot = float(data['mean_motion_dot'][i])
+        line0 = '0 SAT {}'.format(norad_cat_id)
+        line1 = '1 {}U {:<8} {:02d}{:012.8f} {}{} {} {} 0 {:4d}'.format(
+            catalog_number(norad_cat_id), '' if isnull else '{:02d}{:03d}{}'.format(data['launch_year'][j] % 100, data['launch_no'][j], data['piece'][j]),
+            yy[k], doy[k], '-' if ndot < 0 else ' ', '{:.8f}'.format(abs(ndot))[1:], tle_exponent(0.0), tle_exponent(bstar),
+            data['element_set_no'][i])
+        line2 = '2 {} {:8.4f} {:8.4f} {:07d} {:8.4f} {:8.4f} {:11.8f}{:5d}'.format(
+            catalog_number(norad_cat_id), data['inc'][j], data['raan'][i], int(round(ecc * 1e7)), data['argp'][i], data['mean_anomaly'][i],
+            mean_motion, data['rev'][i])
+        yield {'CCSDS_OMM_VERS': '2.0', 'COMMENT': 'GENERATED VIA SPACE-TRACK.ORG API', 'CREATION_DATE': creation[k],
+            'ORIGINATOR': '18 SPCS', 'OBJECT_NAME': 'SAT {}'.format(norad_cat_id), 'OBJECT_ID': None if isnull else object_id,
+            'CENTER_NAME': 'EARTH', 'REF_FRAME': 'TEME', 'TIME_SYSTEM': 'UTC', 'MEAN_ELEMENT_THEORY': 'SGP4',
+            'EPOCH': epoch_text[k], 'MEAN_MOTION': '{:.8f}'.format(mean_motion), 'ECCENTRICITY': '{:.7f}'.format(ecc),
+            'INCLINATION': '{:.4f}'.format(data['inc'][j]), 'RA_OF_ASC_NODE': '{:.4f}'.format(data['raan'][i]),
+            'ARG_OF_PERICENTER': '{:.4f}'.format(data['argp'][i]), 'MEAN_ANOMALY': '{:.4f}'.format(data['mean_anomaly'][i]),
+            'EPHEMERIS_TYPE': '0', 'CLASSIFICATION_TYPE': 'U', 'NORAD_CAT_ID': str(norad_cat_id),
+            'ELEMENT_SET_NO': str(data['element_set_no'][i]), 'REV_AT_EPOCH': str(data['rev'][i]), 'BSTAR': '{:.4e}'.format(bstar),
+            'MEAN_MOTION_DOT': '{:.8f}'.format(ndot), 'MEAN_MOTION_DDOT': '0.0000000000000',
+            'SEMIMAJOR_AXIS': '{:.3f}'.format(a), 'PERIOD': '{:.3f}'.format(1440 / mean_motion),
+            'APOAPSIS': '{:.3f}'.format(a * (1 + ecc) - EARTH_RADIUS), 'PERIAPSIS': '{:.3f}'.format(a * (1 - ecc) - EARTH_RADIUS),
+            'OBJECT_TYPE': None if isnull else str(data['objtype'][j]), 'RCS_SIZE': None if isnull else str(data['rcs'][j]),
+            'COUNTRY_CODE': None if isnull else str(data['country'][j]),
+            'LAUNCH_DATE': None if isnull else str(data['launch'][j].astype('datetime64[us]').astype('datetime64[D]')),
+            'SITE': None if isnull else str(data['site'][j]),
+            'DECAY_DATE': str(data['decay_date'][j].astype('datetime64[us]').astype('datetime64[D]')) if data['decayed'][j] else None,
+            'FILE': str(data['file'][i]), 'GP_ID': str(data['gp_id'][i]),
+            'TLE_LINE0': line0, 'TLE_LINE1': line1 + str(tle_checksum(line1)), 'TLE_LINE2': line2 + str(tle_checksum(line2))}
+
+# Only the newest record of each object, like the gp (latest) class
+def latest(data):
+    index = data['index']
+    obj = data['obj'][index]
+    order = np.lexsort((data['epoch'][index], obj))
+    last = np.r_[obj[order][1:] != obj[order][:-1], True]
+    data = dict(data)
+    data['index'] = np.sort(index[order[last]])
+    return data
+
+# Write records data['index'][begin:end] as a JSON array. Compressed by the extension (.xz, .zst).
+def write_json(filename, data, begin = 0, end = None, level = None):
+    codec = 'xz' if filename.endswith('.xz') else 'zstd' if filename.endswith('.zst') else 'none'
+    n = 0
+    with CompressedWriter(filename, codec, level) as writer:
+        writer.write('[')
+        batch = []
+        for record in iter_records(data, begin, end):
+            batch.append(json.dumps(record, separators = (',', ':')))
+            if len(batch) >= 10000:
+                writer.write((',' if n > 0 else '') + ','.join(batch))
+                n += len(batch)
+                batch = []
+        if len(batch) > 0:
+            writer.write((',' if n > 0 else '') + ','.join(batch))
+            n += len(batch)
+        writer.write(']')
+    return n
+
+# Ranges [begin, end) of the records of `files` files. Consecutive files share a fraction `overlap`
+# of their records, like overlapping downloads.
+def split(total, files, overlap = 0.0):
+    step = -(-total // files)
+    return [(k * step, min(int((k + 1 + overlap) * step), total)) for k in range(files)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic gp / gp_history JSON.')
+    parser.add_argument('OUTPUT', type=str, help='Output JSON file (compressed if it ends with .xz or .zst)')
+    parser.add_argument('-n', '--rows', type=int, default=100000, help='Number of records (without duplicates). Default: 100000')
+    parser.add_argument('--objects', type=int, default=1000, help='Number of objects. Default: 1000')
+    parser.add_argument('-s', '--start', type=str, default='2000-01-01', help='First date. Default: 2000-01-01')
+    parser.add_argument('--days', type=int, default=3650, help='Number of days. Default: 3650')
+    parser.add_argument('-d', '--duplicates', type=float, default=0.05, help='Fraction of duplicated records. Default: 0.05')
+    parser.add_argument('--nulls', type=float, default=0.02, help='Fraction of objects with null OBJECT_ID, LAUNCH_DATE etc. Default: 0.02')
+    parser.add_argument('-f', '--files', type=int, default=1, help='Number of output files (OUTPUT-000.json, OUTPUT-001.json, ...). Default: 1')
+    parser.add_argument('--overlap', type=float, default=0.0, help='Fraction of the records shared by consecutive files. Default: 0')
+    parser.add_argument('--latest', action='store_true', help='Only the newest record of each object (gp class)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. Default: 0')
+    parser.add_argument('-l', '--level', type=int, help='Compression level')
+
+    args = parser.parse_args()
+
+    data = generate(args.rows, args.objects, args.start, args.days, args.duplicates, args.nulls, args.seed)
+    if args.latest:
+        data = latest(data)
+    if args.files == 1:
+        n = write_json(args.OUTPUT, data, level = args.level)
+        print('{}: {} records'.format(args.OUTPUT, n))
+    else:
+        # 'out.json.xz' -> 'out-000.json.xz'. Only the basename is split, as the directory may have a dot
+        dirname, basename = os.path.split(args.OUTPUT)
+        stem, ext = basename.split('.', 1) if '.' in basename else (basename, 'json')
+        for k, (begin, end) in enumerate(split(len(data['index']), args.files, args.overlap)):
+            filename = os.path.join(dirname, '{}-{:03d}.{}'.format(stem, k, ext))
+            n = write_json(filename, data, begin, end, level = args.level)
+            print('{}: {} records'.format(filename, n))
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import numpy as np
+
+# Set of GP_IDs as a bitmap (1 bit per ID). GP_IDs are dense unsigned integers,
+# so the whole gp_history (about 250 million IDs) takes about 32 MB, however many records are read.
+class GPIDSet:
+
+    def __init__(self):
+        self.bits = np.zeros(0, dtype = 'uint8')
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self, maxid):
+        size = int(maxid) // 8 + 1
+        if size > len(self.bits):
+            # Grow by at least 1/4 to avoid copying the bitmap for every batch
+            bits = np.zeros(max(size, len(self.bits) * 5 // 4), dtype = 'uint8')
+            bits[:len(self.bits)] = self.bits
+            self.bits = bits
+
+    # Boolean array, True for the IDs in the set
+    def contains(self, ids):
+        ids = np.asarray(ids, dtype = 'int64')
+        inside = (ids >= 0) & (ids < len(self.bits) * 8)
+        result = np.zeros(len(ids), dtype = bool)
+        result[inside] = (self.bits[ids[inside] >> 3] >> (ids[inside] & 7).astype('uint8')) & 1 == 1
+        return result
+
+    # Add the IDs, and return a boolean array which is True for the first occurrence of each new ID
+    def add(self, ids):
+        ids = np.asarray(ids, dtype = 'int64')
+        mask = np.zeros(len(ids), dtype = bool)
+        if len(ids) == 0:
+            return mask
+        if ids.min() < 0:
+            raise ValueError('negative GP_ID')
+        self._grow(ids.max())
+        uniq, first = np.unique(ids, return_index = True)
+        new = ~self.contains(uniq)
+        mask[first[new]] = True
+        uniq = uniq[new]
+        if len(uniq) > 0:
+            # uniq is sorted, so the bits of the same byte are adjacent
+            index = uniq >> 3
+            starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+            self.bits[index[starts]] |= np.bitwise_or.reduceat((1 << (uniq & 7)).astype('uint8'), starts)
+            self.count += len(uniq)
+        return mask
+
+# Removes the records whose GP_ID was already read (the first one is kept),
+# and counts the records and the duplicates of each input file.
+class Deduplicator:
+
+    def __init__(self):
+        self.ids = GPIDSet()
+        # file name -> [records, duplicates]
+        self.files = collections.OrderedDict()
+
+    # Add the IDs of the records already stored (e.g. in the database) without counting them
+    def seed(self, ids):
+        self.ids.add(ids)
+
+    # Boolean array, True for the records to keep. May be called several times for the batches of a file.
+    def filter(self, name, ids):
+        mask = self.ids.add(ids)
+        counts = self.files.setdefault(name, [0, 0])
+        counts[0] += len(mask)
+        counts[1] += len(mask) - int(mask.sum())
+        return mask
+
+    @property
+    def duplicates(self):
+        return sum(d for (n, d) in self.files.values())
+
+    # Lines of the report, for the files with duplicates
+    def report(self):
+        return ['{}: {} duplicates in {} records'.format(name, d, n) for name, (n, d) in self.files.items() if d > 0]
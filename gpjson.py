@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import io
+import os
+import lzma
+import gzip
+import bz2
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Faster JSON parser, used by iter_records() if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Size of the text read at once by iter_records()
+READ_SIZE = 1024 * 1024
+
+# Open a (compressed) file as text, or as bytes with mode 'rb'. Compression is inferred from the extension, like pandas.
+def open_compressed(filename, mode = 'rt'):
+    encoding = None if 'b' in mode else 'utf-8'
+    if filename.endswith('.xz') or filename.endswith('.lzma'):
+        return lzma.open(filename, mode, encoding = encoding)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, encoding = encoding)
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, mode, encoding = encoding)
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('zstandard module is required for ' + filename)
+        fp = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd = True)
+    elif filename.endswith('.zip'):
+        import zipfile
+        zf = zipfile.ZipFile(filename)
+        fp = zf.open(zf.namelist()[0])
+    else:
+        return open(filename, mode, encoding = encoding)
+    return fp if encoding is None else io.TextIOWrapper(fp, encoding = encoding)
+
+# A Parquet file, or a directory of a (partitioned) Parquet dataset
+def is_parquet(filename):
+    if os.path.isdir(filename):
+        return True
+    with open(filename, 'rb') as fp:
+        return fp.read(4) == b'PAR1'
+
+# Yield the records of a JSON array (the format of Space-Track API) one by one,
+# without reading the whole file into memory.
+def iter_records(filename):
+    if orjson is not None:
+        return _iter_records_orjson(filename)
+    return _iter_records_json(filename)
+
+# iter_records() with the json module
+def _iter_records_json(filename):
+    decoder = json.JSONDecoder()
+    whitespace = ' \t\n\r'
+    with open_compressed(filename) as fp:
+        buf = ''
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            if not eof:
+                chunk = fp.read(READ_SIZE)
+                eof = chunk == ''
+                buf = buf[pos:] + chunk
+                pos = 0
+
+            while True:
+                while pos < len(buf) and (buf[pos] in whitespace or (started and buf[pos] == ',')):
+                    pos += 1
+                if pos >= len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError('{}: not a JSON array'.format(filename))
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == ']':
+                    return
+                try:
+                    record, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # The record continues in the next chunk
+                    break
+                yield record
+                pos = end
+
+            if eof:
+                if not started:
+                    # Empty file
+                    return
+                raise ValueError('{}: unexpected end of file'.format(filename))
+
+# iter_records() with orjson. Each chunk is cut after its last '}' and parsed as an array at once.
+# If the cut is inside a string, the piece isn't valid JSON (the string is not closed), and it is
+# parsed again with the next chunk.
+def _iter_records_orjson(filename):
+    with open_compressed(filename, 'rb') as fp:
+        buf = b''
+        started = False
+        while True:
+            chunk = fp.read(READ_SIZE)
+            eof = chunk == b''
+            # buf starts at the beginning of the file or at the end of a record
+            buf = (buf + chunk).lstrip()
+            if not started:
+                if buf == b'':
+                    if eof:
+                        # Empty file
+                        return
+                    continue
+                if buf[:1] != b'[':
+                    raise ValueError('{}: not a JSON array'.format(filename))
+                started = True
+                buf = buf[1:].lstrip()
+            if buf[:1] == b',':
+                buf = buf[1:]
+            elif buf[:1] == b']':
+                return
+
+            cut = buf.rfind(b'}') + 1
+            if cut > 0:
+                try:
+                    records = orjson.loads(b'[' + buf[:cut] + b']')
+                except orjson.JSONDecodeError:
+                    records = None
+                if records is not None:
+                    yield from records
+                    buf = buf[cut:]
+                    continue
+
+            if eof:
+                # Let the json module report the error
+                yield from json.loads('[' + buf.decode('utf-8'))
+                return
+
+# Parse a whole JSON array in memory (e.g. a response of Space-Track API) into a list of records
+def parse_records(data):
+    if len(data.strip()) == 0:
+        return []
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Convert a JSON value (all values are strings in Space-Track JSON) to the type of the column
+def to_timestamp(value):
+    # Same text as str(pandas.Timestamp): '2020-10-10 05:12:34.123456'
+    return value.replace('T', ' ') if value is not None and value != '' else None
+
+def to_real(value):
+    return float(value) if value is not None and value != '' else None
+
+def to_integer(value):
+    return int(value) if value is not None and value != '' else None
+
+def to_text(value):
+    return value
+
+# Types of the columns of gp / gp_history (https://www.space-track.org/basicspacedata/modeldef/class/gp/format/html)
+GP_CONVERTERS = {
+    'CCSDS_OMM_VERS': to_text, 'COMMENT': to_text, 'CREATION_DATE': to_timestamp, 'ORIGINATOR': to_text,
+    'OBJECT_NAME': to_text, 'OBJECT_ID': to_text, 'CENTER_NAME': to_text, 'REF_FRAME': to_text,
+    'TIME_SYSTEM': to_text, 'MEAN_ELEMENT_THEORY': to_text, 'EPOCH': to_timestamp, 'MEAN_MOTION': to_real,
+    'ECCENTRICITY': to_real, 'INCLINATION': to_real, 'RA_OF_ASC_NODE': to_real,
+    'ARG_OF_PERICENTER': to_real, 'MEAN_ANOMALY': to_real, 'EPHEMERIS_TYPE': to_integer,
+    'CLASSIFICATION_TYPE': to_text, 'NORAD_CAT_ID': to_integer, 'ELEMENT_SET_NO': to_integer,
+    'REV_AT_EPOCH': to_integer, 'BSTAR': to_real, 'MEAN_MOTION_DOT': to_real, 'MEAN_MOTION_DDOT': to_real,
+    'SEMIMAJOR_AXIS': to_real, 'PERIOD': to_real, 'APOAPSIS': to_real, 'PERIAPSIS': to_real, 'OBJECT_TYPE': to_text,
+    'RCS_SIZE': to_text, 'COUNTRY_CODE': to_text, 'LAUNCH_DATE': to_timestamp, 'SITE': to_text, 'DECAY_DATE': to_timestamp,
+    'FILE': to_integer, 'GP_ID': to_integer, 'TLE_LINE0': to_text, 'TLE_LINE1': to_text, 'TLE_LINE2': to_text}
+
+# Yield lists of at most batch_size tuples of the given columns.
+# source: a JSON file, or the records already parsed (e.g. by parse_records())
+def iter_batches(source, columns, batch_size = 10000, converters = GP_CONVERTERS):
+    convs = [(column, converters[column]) for column in columns]
+    batch = []
+    for record in (iter_records(source) if isinstance(source, str) else source):
+        batch.append(tuple(conv(record.get(column)) for column, conv in convs))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Read the whole file into lists of values, one list per column (None for a Parquet file).
+# Used by worker processes, as columns are cheaper to pass between processes than records.
+def read_columns(filename, columns, converters = GP_CONVERTERS):
+    if is_parquet(filename):
+        return None
+    values = [[] for column in columns]
+    convs = [(column, converters[column], values[i]) for i, column in enumerate(columns)]
+    for record in iter_records(filename):
+        for column, conv, v in convs:
+            v.append(conv(record.get(column)))
+    return values
+
+# Yield func(item) for each item in order, computed by `jobs` worker processes.
+# At most 2 * jobs results are held at a time, so a slow consumer doesn't fill the memory.
+def imap_ordered(func, items, jobs = 1):
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # Imported here, as it takes a while and most runs don't need it
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= 2 * jobs:
+                yield futures.popleft().result()
+        while len(futures) > 0:
+            yield futures.popleft().result()
@@ -1,28 +1,88 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pandas as pd
-import json
 import csv
+import io
 import sys
 import re
+import argparse
+from functools import partial
+from gpjson import iter_records, imap_ordered
+from compressedfile import CODECS, CompressedWriter, compressed_filename
 
-if len(sys.argv) < 2:
-    print('Invalid number of arguments!')
-    sys.exit(1)
+p = re.compile(r'(?:\.json)?(?:\.gz|\.bz2|\.xz|\.zip|\.zst)?$')
 
-p = re.compile(r'(?:\.json)?(?:\.gz|\.bz2|\.xz|\.zip)?$')
+# Number of records written at once
+BATCH_SIZE = 10000
 
-for jsonfile in sys.argv[1:]: 
-    print('Input:', jsonfile)
-    csvfile = p.sub('', jsonfile) + '.csv'
-    df = pd.read_json(jsonfile, orient='records', dtype='object')
-    print(len(df), 'records read')
-    if len(df) == 0:
-        print('No output')
+# Yield lists of at most BATCH_SIZE records (dict)
+def iter_record_batches(jsonfile):
+    batch = []
+    for record in iter_records(jsonfile):
+        batch.append(record)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Convert a file. Run in worker processes with -j. Return the messages to print.
+# The columns are the keys of the first record (all records of Space-Track API have the same keys).
+def convert(jsonfile, codec = 'none', level = None, use_pandas = False):
+    messages = ['Input: ' + jsonfile]
+    csvfile = compressed_filename(p.sub('', jsonfile) + '.csv', codec)
+    writer = None
+    n = 0
+    buf = io.StringIO()
+    try:
+        if use_pandas:
+            # The whole file in memory (the former implementation, kept for comparison)
+            import pandas as pd
+            df = pd.read_json(jsonfile, orient='records', dtype='object')
+            if len(df) > 0:
+                writer = CompressedWriter(csvfile, codec, level)
+                writer.write(df.to_csv(index=False, quoting=csv.QUOTE_NONNUMERIC))
+            n = len(df)
+        else:
+            for batch in iter_record_batches(jsonfile):
+                # The output file is created when the first record is read
+                if writer is None:
+                    writer = CompressedWriter(csvfile, codec, level)
+                    fieldnames = list(batch[0].keys())
+                    csvwriter = csv.DictWriter(buf, fieldnames, extrasaction='ignore', quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+                    csvwriter.writeheader()
+                csvwriter.writerows(batch)
+                writer.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+                n += len(batch)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    messages.append('{} records read'.format(n))
+    if writer is None:
+        messages.append('No output')
     else:
-        print('Output:', csvfile)
-        df.to_csv(csvfile, index=False, quoting=csv.QUOTE_NONNUMERIC)
+        writer.commit()
+        messages.append('Output: ' + csvfile)
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert JSON to CSV.')
+    parser.add_argument('JSON_file', type=str, nargs='+', help='Input JSON files.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes. Default: 1')
+    parser.add_argument('-z', '--codec', type=str, choices=CODECS.keys(), default='none', help='Compression of the output. Default: none')
+    parser.add_argument('-l', '--level', type=int, help='Compression level')
+    parser.add_argument('-p', '--pandas', action='store_true', help='Read JSON files with pandas (the whole file is read into memory)')
+    args = parser.parse_args()
+
+    func = partial(convert, codec = args.codec, level = args.level, use_pandas = args.pandas)
+    for messages in imap_ordered(func, args.JSON_file, args.jobs):
+        print('\n'.join(messages))
 
-sys.exit(0)
+    sys.exit(0)
 
+if __name__ == '__main__':
+    main()
@@ -2,69 +2,201 @@
 # -*- coding: utf-8 -*-
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 import sys
 import argparse
-
-parser = argparse.ArgumentParser(description='Convert JSON to Parquet.')
-
-parser.add_argument('JSON_file', type=str, nargs='+', help='Input JSON files.')
-parser.add_argument('Parquet_file', type=str, nargs=1, help='Output Parquet file.')
-parser.add_argument('-c', '--compression', type=str, default='zstd', help='Name of the compression to use. Use None for no compression. Default: zstd')
-
-args = parser.parse_args()
-
-jsonfiles = args.JSON_file
-parquetfile = args.Parquet_file[0]
-compression = args.compression
-
-if os.path.isfile(parquetfile):
-    print('error: {} already exists'.format(parquetfile), file=sys.stderr)
-    sys.exit(1)
-
-dtype = {'CCSDS_OMM_VERS': object,  'COMMENT': object,  'CREATION_DATE': 'datetime64[ns]',  'ORIGINATOR': object, 
-       'OBJECT_NAME': object,  'OBJECT_ID': object,  'CENTER_NAME': object,  'REF_FRAME': object, 
-       'TIME_SYSTEM': object,  'MEAN_ELEMENT_THEORY': object,  'EPOCH': 'datetime64[ns]',  'MEAN_MOTION': 'float64', 
-       'ECCENTRICITY': 'float64',  'INCLINATION': 'float64',  'RA_OF_ASC_NODE': 'float64', 
-       'ARG_OF_PERICENTER': 'float64',  'MEAN_ANOMALY': 'float64',  'EPHEMERIS_TYPE': 'int8', 
-       'CLASSIFICATION_TYPE': object,  'NORAD_CAT_ID': 'uint32',  'ELEMENT_SET_NO': 'uint16', 
-       'REV_AT_EPOCH': 'uint32',  'BSTAR': 'float64',  'MEAN_MOTION_DOT': 'float64',  'MEAN_MOTION_DDOT': 'float64', 
-       'SEMIMAJOR_AXIS': 'float64',  'PERIOD': 'float64',  'APOAPSIS': 'float64',  'PERIAPSIS': 'float64',  'OBJECT_TYPE': object, 
-       'RCS_SIZE': object,  'COUNTRY_CODE': object,  'LAUNCH_DATE': 'datetime64[ns]',  'SITE': object,  'DECAY_DATE': 'datetime64[ns]', 
+from gpjson import imap_ordered
+from gpdedup import Deduplicator
+
+dtype = {'CCSDS_OMM_VERS': object,  'COMMENT': object,  'CREATION_DATE': 'datetime64[ns]',  'ORIGINATOR': object,
+       'OBJECT_NAME': object,  'OBJECT_ID': object,  'CENTER_NAME': object,  'REF_FRAME': object,
+       'TIME_SYSTEM': object,  'MEAN_ELEMENT_THEORY': object,  'EPOCH': 'datetime64[ns]',  'MEAN_MOTION': 'float64',
+       'ECCENTRICITY': 'float64',  'INCLINATION': 'float64',  'RA_OF_ASC_NODE': 'float64',
+       'ARG_OF_PERICENTER': 'float64',  'MEAN_ANOMALY': 'float64',  'EPHEMERIS_TYPE': 'int8',
+       'CLASSIFICATION_TYPE': object,  'NORAD_CAT_ID': 'uint32',  'ELEMENT_SET_NO': 'uint16',
+       'REV_AT_EPOCH': 'uint32',  'BSTAR': 'float64',  'MEAN_MOTION_DOT': 'float64',  'MEAN_MOTION_DDOT': 'float64',
+       'SEMIMAJOR_AXIS': 'float64',  'PERIOD': 'float64',  'APOAPSIS': 'float64',  'PERIAPSIS': 'float64',  'OBJECT_TYPE': object,
+       'RCS_SIZE': object,  'COUNTRY_CODE': object,  'LAUNCH_DATE': 'datetime64[ns]',  'SITE': object,  'DECAY_DATE': 'datetime64[ns]',
        'FILE': 'uint64',  'GP_ID': 'uint32',  'TLE_LINE0': object,  'TLE_LINE1': object,  'TLE_LINE2': object}
 
 convert_dates = ['EPOCH', 'CREATION_DATE', 'LAUNCH_DATE', 'DECAY_DATE']
 
-df_list = []
+# Schema of the output (fixed, so that every file and every row group has the same schema)
+def arrow_type(t):
+    if t is object:
+        return pa.string()
+    if t == 'datetime64[ns]':
+        return pa.timestamp('ns')
+    return pa.from_numpy_dtype(np.dtype(t))
+
+schema = pa.schema([(column, arrow_type(t)) for column, t in dtype.items()])
+
+# Default number of rows of a row group
+ROW_GROUP_SIZE = 1000000
+
+# Default upper limit of the rows buffered in all the partitions of PartitionedWriter
+MAX_BUFFERED_ROWS = 4000000
+
+# Read a JSON file into an Arrow table. Run in worker processes with -j.
+# Duplicates of GP_ID are removed by the main process, across all files.
+def read_table(jsonfile):
+    df = pd.read_json(jsonfile, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records')
+    df = df.reindex(columns = schema.names)
+    return pa.Table.from_pandas(df, schema = schema, preserve_index = False)
+
+# Arrow table of the rows converted by gpjson.iter_batches() with the columns of the schema.
+# Timestamps are the text of gpjson.to_timestamp(), which Arrow parses.
+def rows_to_table(rows):
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_timestamp(field.type):
+            arrays.append(pa.array(values, type = pa.string()).cast(field.type))
+        else:
+            arrays.append(pa.array(values, type = field.type))
+    return pa.Table.from_arrays(arrays, schema = schema)
+
+# Writes row groups to a single Parquet file
+class SingleWriter:
+
+    def __init__(self, parquetfile, compression, row_group_size = ROW_GROUP_SIZE):
+        self.writer = pq.ParquetWriter(parquetfile, schema, compression = compression)
+        self.row_group_size = row_group_size
+
+    def write(self, table):
+        self.writer.write_table(table, row_group_size = self.row_group_size)
+
+    def close(self):
+        self.writer.close()
+
+# Sorts a table by NORAD_CAT_ID and EPOCH (stable, so duplicates keep the order they were written in)
+def sort_table(table):
+    order = np.lexsort((table.column('EPOCH').to_numpy().astype('int64'), table.column('NORAD_CAT_ID').to_numpy()))
+    return table.take(pa.array(order))
+
+# Writes a Hive-partitioned dataset (EPOCH_YEAR=YYYY/EPOCH_MONTH=MM/part-0.parquet).
+# Rows are buffered per partition and written in sorted chunks when the partition has row_group_size rows.
+# When all the partitions have more than max_buffered_rows, the largest ones are written first,
+# so the memory doesn't grow with the number of partitions (e.g. files by NORAD_CAT_ID covering every month).
+# close() rewrites a file written in more than one chunk sorted by NORAD_CAT_ID and EPOCH as a whole (one partition
+# in memory at a time), so that readers can skip partitions by path and row groups by statistics.
+# Files are added to an existing dataset with another basename.
+class PartitionedWriter:
+
+    def __init__(self, directory, compression, row_group_size = ROW_GROUP_SIZE, basename = 'part-0.parquet',
+            max_buffered_rows = MAX_BUFFERED_ROWS):
+        self.directory = directory
+        self.basename = basename
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.writers = {}
+        self.buffers = {}
+        # Rows buffered per partition and in all, and chunks written per partition
+        self.nrows = {}
+        self.nbuffered = 0
+        self.nchunks = {}
+
+    def write(self, table):
+        epoch = table.column('EPOCH').to_numpy()
+        keys = epoch.astype('datetime64[M]').astype('int64')
+        for key in np.unique(keys):
+            part = table.take(pa.array(np.nonzero(keys == key)[0]))
+            key = (int(key) // 12 + 1970, int(key) % 12 + 1)
+            self.buffers.setdefault(key, []).append(part)
+            self.nrows[key] = self.nrows.get(key, 0) + part.num_rows
+            self.nbuffered += part.num_rows
+            if self.nrows[key] >= self.row_group_size:
+                self._flush(key)
+        while self.nbuffered > self.max_buffered_rows:
+            self._flush(max(self.nrows, key = self.nrows.get))
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'EPOCH_YEAR={}'.format(key[0]), 'EPOCH_MONTH={}'.format(key[1]), self.basename)
+
+    def _flush(self, key):
+        table = sort_table(pa.concat_tables(self.buffers.pop(key)))
+        self.nbuffered -= self.nrows.pop(key)
+        if key not in self.writers:
+            os.makedirs(os.path.dirname(self._path(key)), exist_ok = True)
+            self.writers[key] = pq.ParquetWriter(self._path(key), schema, compression = self.compression)
+        self.writers[key].write_table(table, row_group_size = self.row_group_size)
+        self.nchunks[key] = self.nchunks.get(key, 0) + 1
+
+    # Rewrite the file of the partition sorted as a whole. The temporary file starts with '.', so readers of the dataset ignore it
+    def _sort(self, key):
+        path = self._path(key)
+        table = sort_table(pq.ParquetFile(path).read())
+        tmpfile = os.path.join(os.path.dirname(path), '.' + self.basename + '.tmp')
+        pq.write_table(table, tmpfile, compression = self.compression, row_group_size = self.row_group_size)
+        os.replace(tmpfile, path)
+
+    def close(self):
+        for key in list(self.buffers):
+            self._flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        for key, nchunks in self.nchunks.items():
+            if nchunks > 1:
+                self._sort(key)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert JSON to Parquet.')
+
+    parser.add_argument('JSON_file', type=str, nargs='+', help='Input JSON files.')
+    parser.add_argument('Parquet_file', type=str, nargs=1, help='Output Parquet file (or directory with -p).')
+    parser.add_argument('-c', '--compression', type=str, default='zstd', help='Name of the compression to use. Use None for no compression. Default: zstd')
+    parser.add_argument('-p', '--partition', action='store_true', help='Write a dataset partitioned by year and month of EPOCH')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to read JSON files. Default: 1')
+    parser.add_argument('-g', '--row_group_size', type=int, default=ROW_GROUP_SIZE, help='Number of rows of a row group. Default: {}'.format(ROW_GROUP_SIZE))
+    parser.add_argument('-m', '--max_buffered_rows', type=int, default=MAX_BUFFERED_ROWS, help='Maximum number of rows buffered in all the partitions with -p. Default: {}'.format(MAX_BUFFERED_ROWS))
+
+    args = parser.parse_args()
+
+    jsonfiles = args.JSON_file
+    parquetfile = args.Parquet_file[0]
+    compression = args.compression if args.compression != 'None' else None
+
+    if os.path.exists(parquetfile):
+        print('error: {} already exists'.format(parquetfile), file=sys.stderr)
+        sys.exit(1)
+
+    for jsonfile in jsonfiles:
+        if not os.path.isfile(jsonfile):
+            print('error: {} not found'.format(jsonfile), file=sys.stderr)
+            sys.exit(1)
 
-n = len(jsonfiles)
+    print('Output: {}'.format(parquetfile))
+    if args.partition:
+        writer = PartitionedWriter(parquetfile, compression, args.row_group_size, max_buffered_rows = args.max_buffered_rows)
+    else:
+        writer = SingleWriter(parquetfile, compression, args.row_group_size)
 
-for i, jsonfile in enumerate(jsonfiles): 
-    print('Input({}/{}): {}'.format(i + 1, n, jsonfile))
-    if not os.path.isfile(jsonfile):
-        print('error: {} not found'.format(jsonfile), file=sys.stderr)
-        sys.exit(1)
+    # GP_ID of the records already written (a bitmap, so the memory doesn't grow with the number of files)
+    dedup = Deduplicator()
 
-    df_list.append(
-        pd.read_json(
-            jsonfile, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records'
-        
-        )
-    )
+    n = len(jsonfiles)
 
-df = pd.concat(df_list)
-len1 = len(df)
-df.drop_duplicates(subset = ['GP_ID'], ignore_index = True, inplace=True)
-len2 = len(df)
-if len1 != len2:
-    print('{} duplicated records removed'.format(len1 - len2))
+    # Files are parsed in parallel with -j, and written in the order of the arguments
+    for i, (jsonfile, table) in enumerate(zip(jsonfiles, imap_ordered(read_table, jsonfiles, args.jobs))):
+        print('Input({}/{}): {}'.format(i + 1, n, jsonfile))
+        mask = dedup.filter(jsonfile, table.column('GP_ID').to_numpy())
+        if not mask.all():
+            table = table.filter(pa.array(mask))
+        if table.num_rows == 0:
+            continue
+        writer.write(table)
 
-print('Output: {}'.format(parquetfile))
+    writer.close()
 
-if compression == "None":
-    df.to_parquet(parquetfile, compression=None)
-else:
-    df.to_parquet(parquetfile, compression=compression)
+    if dedup.duplicates > 0:
+        for line in dedup.report():
+            print(line)
+        print('{} duplicated records removed'.format(dedup.duplicates))
 
-sys.exit(0)
+    sys.exit(0)
 
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,112 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pandas as pd
 import os
 import sys
+import time
 import argparse
+from functools import partial
+from itertools import compress
+from operator import itemgetter
 import sqlite3
 from setup_logger import setup_logger
+from metrics import get_metrics, run
+from gpjson import iter_batches, is_parquet, read_columns, imap_ordered
+from gpdedup import Deduplicator
+import elsetschema
+import tlestore
+import asofindex
+
+# --bulk: 一時テーブルに溜めるレコード数の上限 (超えたら本テーブルにマージする)
+STAGE_SIZE = 1000000
+
+# --bulk: ロード中の接続の設定。ジャーナルなしで書き込むため、ロード中に異常終了した場合はDBファイルが壊れる
+BULK_PRAGMAS = ['journal_mode = OFF', 'synchronous = OFF', 'cache_size = -262144', 'temp_store = MEMORY', 'locking_mode = EXCLUSIVE']
+
+# DBに保存するカラム名 (TLEなし)
+columns_out_without_tle = ['CREATION_DATE', 'EPOCH', 'OBJECT_ID', 'MEAN_MOTION', 'ECCENTRICITY', 'INCLINATION', 'RA_OF_ASC_NODE',
+    'ARG_OF_PERICENTER', 'MEAN_ANOMALY', 'NORAD_CAT_ID', 'REV_AT_EPOCH', 'BSTAR', 'SEMIMAJOR_AXIS',
+    'PERIOD', 'APOAPSIS', 'PERIAPSIS', 'GP_ID']
+
+# DBに保存するカラム名 (TLEつき)
+columns_out_with_tle = columns_out_without_tle + ['TLE_LINE0', 'TLE_LINE1', 'TLE_LINE2']
+
+# テーブル作成 (テーブル名は後で入れる)
+create_table_without_tle = '''CREATE TABLE IF NOT EXISTS {} (
+    CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
+    MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
+    NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
+    GP_ID integer primary key)'''
+create_table_with_tle = '''CREATE TABLE IF NOT EXISTS {} (
+    CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
+    MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
+    NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
+    GP_ID integer  primary key, TLE_LINE0 text, TLE_LINE1 text, TLE_LINE2 text)'''
+
+# テーブル作成 (--clustered)。レコードを NORAD_CAT_ID, EPOCH 順に格納し、GP_ID の重複はUNIQUEインデックスで防ぐ
+create_table_clustered_without_tle = '''CREATE TABLE IF NOT EXISTS {} (
+    CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
+    MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
+    NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
+    GP_ID integer, PRIMARY KEY (NORAD_CAT_ID, EPOCH, GP_ID)) WITHOUT ROWID'''
+create_table_clustered_with_tle = '''CREATE TABLE IF NOT EXISTS {} (
+    CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
+    MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
+    NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
+    GP_ID integer, TLE_LINE0 text, TLE_LINE1 text, TLE_LINE2 text, PRIMARY KEY (NORAD_CAT_ID, EPOCH, GP_ID)) WITHOUT ROWID'''
+create_index_gp_id = '''CREATE UNIQUE INDEX IF NOT EXISTS index_{0}_GP_ID ON {0} (GP_ID)'''
+
+# レコード追加 (テーブル名は後で入れる)
+insert_record_without_tle = '''INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(GP_ID) DO NOTHING'''
+insert_record_with_tle = '''INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(GP_ID) DO NOTHING'''
+insert_record_without_tle_compat = '''REPLACE INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
+insert_record_with_tle_compat = '''REPLACE INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
+
+# indexをつけるカラム
+columns_with_index = ['CREATION_DATE', 'EPOCH', 'NORAD_CAT_ID']
+
+# テーブル作成の文。compact では CREATION_DATE, EPOCH を整数 (1970-01-01 からのマイクロ秒) で格納する (elsetschema.py)
+def create_table_statement(table, with_tle, clustered = False, compact = False):
+    if clustered:
+        create_table = create_table_clustered_with_tle if with_tle else create_table_clustered_without_tle
+    else:
+        create_table = create_table_with_tle if with_tle else create_table_without_tle
+    if compact:
+        create_table = create_table.replace('CREATION_DATE timestamp, EPOCH timestamp', 'CREATION_DATE integer, EPOCH integer')
+    return create_table.format(table)
+
+# テーブルを作成する (既にあればそのまま)。既存のテーブルのレイアウトに従い、clustered かどうか、compact かどうかと
+# インデックスをつけるカラムを返す
+def prepare_table(cur, table, with_tle, clustered = False, compact = False):
+    cur.execute(create_table_statement(table, with_tle, clustered, compact))
+
+    sql = cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    clustered = 'WITHOUT ROWID' in sql.upper()
+    index_columns = columns_with_index
+    if clustered:
+        # UPSERT の ON CONFLICT(GP_ID) に必要。NORAD_CAT_ID のインデックスは PRIMARY KEY で代用できる
+        cur.execute(create_index_gp_id.format(table))
+        index_columns = [column for column in columns_with_index if column != 'NORAD_CAT_ID']
+    compact = elsetschema.is_compact(cur, table)
+    if compact:
+        # 日時を文字列で返すビュー (TABLE_text)
+        elsetschema.create_text_view(cur, table)
+    return clustered, compact, index_columns
+
+# レコード追加の文
+def insert_statement(table, with_tle, replace_record = False, logger = None):
+    version = sqlite3.sqlite_version.split('.')
+    if not replace_record and (int(version[0]) > 3 or (int(version[0]) == 3 and int(version[1]) >=24)):
+        # SQLite3 3.24以降ではUPSERT (ON CONFLICT句) を使う
+        return insert_record_with_tle.format(table) if with_tle else insert_record_without_tle.format(table)
+    # 古い SQLite3 の場合と、--replace_record が指定された場合にはREPLACEを使う
+    if not replace_record and logger is not None:
+        logger.warning("SQLite3 version {} doesn't support UPSERT. REPLACE is used.".format(sqlite3.sqlite_version))
+    return insert_record_with_tle_compat.format(table) if with_tle else insert_record_without_tle_compat.format(table)
 
 def main():
     logger = setup_logger('json2sqlite3')
+    metrics = get_metrics('json2sqlite3')
 
     # JSONの各カラムの型
     dtype = {'CCSDS_OMM_VERS': object,  'COMMENT': object,  'CREATION_DATE': 'datetime64[ns]',  'ORIGINATOR': object, 
@@ -26,44 +123,24 @@ def main():
     # JSONで日時として扱うカラム
     convert_dates = ['EPOCH', 'CREATION_DATE', 'LAUNCH_DATE', 'DECAY_DATE']
 
-    # DBに保存するカラム名 (TLEなし)
-    columns_out_without_tle = ['CREATION_DATE', 'EPOCH', 'OBJECT_ID', 'MEAN_MOTION', 'ECCENTRICITY', 'INCLINATION', 'RA_OF_ASC_NODE',
-        'ARG_OF_PERICENTER', 'MEAN_ANOMALY', 'NORAD_CAT_ID', 'REV_AT_EPOCH', 'BSTAR', 'SEMIMAJOR_AXIS',
-        'PERIOD', 'APOAPSIS', 'PERIAPSIS', 'GP_ID']
-
-    # DBに保存するカラム名 (TLEつき)
-    columns_out_with_tle = columns_out_without_tle + ['TLE_LINE0', 'TLE_LINE1', 'TLE_LINE2']
-
-    # テーブル作成 (テーブル名は後で入れる)
-    create_table_without_tle = '''CREATE TABLE IF NOT EXISTS {} (
-        CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
-        MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
-        NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
-        GP_ID integer primary key)'''
-    create_table_with_tle = '''CREATE TABLE IF NOT EXISTS {} (
-        CREATION_DATE timestamp, EPOCH timestamp, OBJECT_ID text,
-        MEAN_MOTION real, ECCENTRICITY real, INCLINATION real, RA_OF_ASC_NODE real, ARG_OF_PERICENTER real, MEAN_ANOMALY real,
-        NORAD_CAT_ID integer, REV_AT_EPOCH integer, BSTAR real, SEMIMAJOR_AXIS real, PERIOD real, APOAPSIS real, PERIAPSIS real,
-        GP_ID integer  primary key, TLE_LINE0 text, TLE_LINE1 text, TLE_LINE2 text)'''
-
-    # レコード追加 (テーブル名は後で入れる)
-    insert_record_without_tle = '''INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(GP_ID) DO NOTHING'''
-    insert_record_with_tle = '''INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT(GP_ID) DO NOTHING'''
-    insert_record_without_tle_compat = '''REPLACE INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
-    insert_record_with_tle_compat = '''REPLACE INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
-
-    # indexをつけるカラム
-    columns_with_index = ['CREATION_DATE', 'EPOCH', 'NORAD_CAT_ID']
-
     parser = argparse.ArgumentParser(description='Convert JSON or Parquet to SQLite3.')
 
-    parser.add_argument('FILE', type=str, nargs='+', help='Input JSON / Parquet files.')
+    parser.add_argument('FILE', type=str, nargs='+', help='Input JSON / Parquet files (or directories of partitioned Parquet datasets).')
     parser.add_argument('DATABASE', type=str, help='SQLite3 Database file.')
     parser.add_argument('TABLE', type=str, help='Table name.')
     parser.add_argument('-t', '--with_tle', action='store_true', help='Include TLE lines')
     parser.add_argument('-d', '--drop_table', action='store_true', help='Drop table if exists')
     parser.add_argument('-i', '--drop_index', action='store_true', help='Drop index temporarily before insert records')
     parser.add_argument('-r', '--replace_record', action='store_true', help='Use REPLACE statment instead of UPSERT')
+    parser.add_argument('-b', '--batch_size', type=int, default=10000, help='Number of records converted and inserted at once. Default: 10000')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to read JSON files. Default: 1')
+    parser.add_argument('-c', '--clustered', action='store_true', help='Create the table clustered by (NORAD_CAT_ID, EPOCH, GP_ID)')
+    parser.add_argument('--bulk', action='store_true', help='Bulk-load mode for initial and archive loads (no journal, records are merged in GP_ID order, indexes are built afterwards)')
+    parser.add_argument('--dedup', action='store_true', help='Skip records whose GP_ID is already in the table or in the previous files, and report duplicates per file')
+    parser.add_argument('-p', '--pandas', action='store_true', help='Read JSON files with pandas (the whole file is read into memory)')
+    parser.add_argument('-s', '--tle_store', action='store_true', help='Store TLE lines in TABLE_tle as compressed blocks instead of TLE columns (see tlestore.py)')
+    parser.add_argument('--asof', action='store_true', help='Create the as-of index TABLE_asof (see asofindex.py). Once created, it is kept up to date without this option')
+    parser.add_argument('--compact', action='store_true', help='Create the table with CREATION_DATE and EPOCH as integers (microseconds since 1970), and the view TABLE_text with text timestamps')
 
     args = parser.parse_args()
 
@@ -74,19 +151,27 @@ def main():
     drop_table = args.drop_table
     drop_index = args.drop_index
     replace_record = args.replace_record
+    batch_size = args.batch_size
+
+    if with_tle and args.tle_store:
+        logger.critical('error: --tle_store cannot be used with --with_tle')
+        sys.exit(1)
+    if replace_record and args.tle_store:
+        # REPLACE ではテーブルのレコードが置き換わるが、TABLE_tle には新しい GP_ID しか格納しないため、TLE が古いまま残る
+        logger.critical('error: --tle_store cannot be used with --replace_record')
+        sys.exit(1)
 
     columns_out = columns_out_with_tle if with_tle else columns_out_without_tle
-    create_table = create_table_with_tle.format(table) if with_tle else create_table_without_tle.format(table)
+    insert_record = insert_statement(table, with_tle, replace_record, logger)
+    # 読み込むカラム (--tle_store では TABLE_tle に格納するカラムも読む)
+    columns_read = columns_out
+    if args.tle_store:
+        columns_read = columns_out + [column for column in tlestore.COLUMNS if column not in columns_out]
+        tle_getter = itemgetter(*[columns_read.index(column) for column in tlestore.COLUMNS])
+        out_getter = itemgetter(*[columns_read.index(column) for column in columns_out])
 
-    version = sqlite3.sqlite_version.split('.')
-    if not replace_record and (int(version[0]) > 3 or (int(version[0]) == 3 and int(version[1]) >=24)):
-        # SQLite3 3.24以降ではUPSERT (ON CONFLICT句) を使う
-        insert_record = insert_record_with_tle.format(table) if with_tle else insert_record_without_tle.format(table)
-    else:
-        # 古い SQLite3 の場合と、--replace_record が指定された場合にはREPLACEを使う
-        if not replace_record:
-            logger.warning("SQLite3 version {} doesn't support UPSERT. REPLACE is used.".format(sqlite3.sqlite_version))
-        insert_record = insert_record_with_tle_compat.format(table) if with_tle else insert_record_without_tle_compat.format(table)
+    # cron は2つのデータベースに格納するため、データベースごとに記録する
+    metrics.instance = os.path.splitext(os.path.basename(dbfile))[0]
 
     logger.debug("connecting to {}".format(dbfile))
     con = sqlite3.connect(dbfile)
@@ -94,42 +179,225 @@ def main():
 
     if drop_table:
         cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+        cur.execute('DROP TABLE IF EXISTS {}_tle'.format(table))
+        cur.execute('DROP TABLE IF EXISTS {}_asof'.format(table))
         logger.debug("table {} is dropped".format(table))
 
-    cur.execute(create_table)
+    if args.bulk:
+        for pragma in BULK_PRAGMAS:
+            cur.execute('PRAGMA ' + pragma)
+        # インデックスは最後にまとめて作る
+        drop_index = True
+
+    clustered, compact, columns_with_index = prepare_table(cur, table, with_tle, args.clustered, args.compact)
+    if args.clustered and not clustered:
+        logger.warning('table {} already exists and is not clustered. Use -d to recreate it'.format(table))
+    if args.compact and not compact:
+        logger.warning('table {} already exists and is not compact. Use compactdb.py to convert it'.format(table))
 
     if drop_index:
         for column in columns_with_index:
             cur.execute('DROP INDEX IF EXISTS index_{0}_{1}'.format(table, column))
 
-    n = len(infiles)
+    tle_writer = tlestore.TLEWriter(cur, table) if args.tle_store else None
 
-    for i, infile in enumerate(infiles): 
-        logger.info('Input({}/{}): {}'.format(i + 1, n, infile))
-        if not os.path.isfile(infile):
+    # as-of インデックス (--asof で作成し、既にあれば更新する)。--bulk では最後に作り直す
+    asof = args.asof or asofindex.has_index(cur, table)
+    if args.asof and not asofindex.has_index(cur, table):
+        asofindex.rebuild(cur, table)
+    asof_getter = itemgetter(*[columns_read.index(column) for column in asofindex.COLUMNS])
+
+    for infile in infiles:
+        if not os.path.exists(infile):
             logger.critical('error: {} not found'.format(infile))
             sys.exit(1)
-        try:
-            df = pd.read_parquet(infile, columns = columns_out)
-        except OSError as e:
-            df = pd.read_json(infile, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records')
-            if len(df) != 0:
-                df = df[columns_out]
-
-        logger.debug('{} records read'.format(len(df)))
-        if len(df) == 0:
-            continue
-        df['CREATION_DATE'] = df['CREATION_DATE'].astype(str)
-        df['EPOCH'] = df['EPOCH'].astype(str)
-        cur.executemany(insert_record, df.values.tolist())
 
+    dedup = None
+    if args.dedup:
+        if replace_record:
+            # REPLACE では後に読んだレコードが残るため、先に読んだものを残す重複除去とは両立しない
+            logger.critical('error: --dedup cannot be used with --replace_record')
+            sys.exit(1)
+        # 既にテーブルにある GP_ID をビットマップに読み込む
+        import numpy as np
+        dedup = Deduplicator()
+        cur.execute('SELECT GP_ID FROM {}'.format(table))
+        while True:
+            rows = cur.fetchmany(1000000)
+            if len(rows) == 0:
+                break
+            dedup.seed(np.array(rows, dtype = 'int64').ravel())
+        logger.debug('{} GP_IDs in table {}'.format(len(dedup.ids), table))
+        gp_id_index = columns_out.index('GP_ID')
+
+    n = len(infiles)
+    starttime = time.monotonic()
+    nrecords = 0
+    ninserted = 0
+
+    if args.bulk:
+        # レコードは一時テーブルに追記するだけにして、重複の解決は GP_ID 順のマージでまとめて行う
+        if tle_writer is None:
+            cur.execute('CREATE TEMP TABLE staging AS SELECT * FROM {} WHERE 0'.format(table))
+        else:
+            cur.execute('CREATE TEMP TABLE staging ({})'.format(', '.join(columns_read)))
+        merge_into = 'INSERT OR REPLACE INTO' if replace_record else 'INSERT INTO'
+        # 同じ GP_ID のレコードは、UPSERTでは先に読んだもの、REPLACEでは後に読んだものが残る (従来と同じ)
+        # clustered の場合はテーブルの格納順にマージする
+        order = 'NORAD_CAT_ID, EPOCH, GP_ID' if clustered else 'GP_ID'
+        merge = '{} {} SELECT {} FROM temp.staging WHERE 1 ORDER BY {}, rowid{}'.format(
+            merge_into, table, ', '.join(columns_out), order, '' if replace_record else ' ON CONFLICT(GP_ID) DO NOTHING')
+        insert_record = 'INSERT INTO temp.staging VALUES ({})'.format(','.join('?' * len(columns_read)))
+        # 最後にマージした時点までに読み込んだレコード数
+        nmerged = 0
+
+    def merge_staging(nstaged):
+        if tle_writer is not None:
+            # テーブルにない GP_ID のレコードの TLE を GP_ID 順に格納する (同じ GP_ID のレコードは先に読んだもの)
+            staged = con.execute('SELECT {} FROM temp.staging WHERE GP_ID NOT IN (SELECT GP_ID FROM main.{}) ORDER BY GP_ID, rowid'.format(
+                ', '.join(tlestore.COLUMNS), table))
+            last = None
+            while True:
+                rows = staged.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                new = []
+                for row in rows:
+                    if row[0] != last:
+                        new.append(row)
+                        last = row[0]
+                tle_writer.write(new)
+        cur.execute(merge)
+        inserted = cur.rowcount
+        cur.execute('DELETE FROM temp.staging')
+        logger.debug('{} records merged, {} inserted'.format(nstaged, inserted))
+        return inserted
+
+    # --tle_store: TLE は TABLE_tle に、それ以外のカラムはテーブルに格納する (--bulk では一時テーブルにそのまま溜める)
+    # as-of インデックスがあれば読み込んだ elset を加える (重複したレコードは無視される)
+    def insert_rows(rows):
+        nonlocal ninserted
+        if args.bulk:
+            cur.executemany(insert_record, rows)
+            return
+        if tle_writer is not None or asof:
+            rows = list(rows)
+        if tle_writer is not None:
+            tle_writer.write(tlestore.new_records(cur, table, [tle_getter(row) for row in rows]))
+        if asof:
+            asofindex.update(cur, table, [asof_getter(row) for row in rows])
+        cur.executemany(insert_record, rows if tle_writer is None else map(out_getter, rows))
+        ninserted += cur.rowcount
+
+    if args.jobs > 1 and not args.pandas:
+        # 複数のプロセスでJSONファイルを並列に読み込み、引数の順にINSERTする
+        loaded = imap_ordered(partial(read_columns, columns = columns_read), infiles, args.jobs)
+    else:
+        loaded = (None for infile in infiles)
+
+    for i, (infile, values) in enumerate(zip(infiles, loaded)):
+        logger.info('Input({}/{}): {}'.format(i + 1, n, infile))
+
+        if values is not None:
+            nread = len(values[0])
+            if compact:
+                for k, column in enumerate(columns_read):
+                    if column in elsetschema.TIMESTAMP_COLUMNS:
+                        values[k] = [elsetschema.to_microseconds(x) for x in values[k]]
+            for k in range(0, nread, batch_size):
+                rows = zip(*(v[k:k + batch_size] for v in values))
+                if dedup is not None:
+                    rows = compress(rows, dedup.filter(infile, values[gp_id_index][k:k + batch_size]))
+                insert_rows(rows)
+            logger.debug('{} records read'.format(nread))
+            nrecords += nread
+        elif args.pandas or is_parquet(infile):
+            # pandas はParquetファイルの読み込みと、比較のため (--pandas) にのみ使う
+            import pandas as pd
+            if is_parquet(infile):
+                df = pd.read_parquet(infile, columns = columns_read)
+            else:
+                df = pd.read_json(infile, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records')
+                if len(df) != 0:
+                    df = df[columns_read]
+
+            logger.debug('{} records read'.format(len(df)))
+            if len(df) == 0:
+                continue
+            for column in elsetschema.TIMESTAMP_COLUMNS:
+                if compact:
+                    # 1970-01-01 からのマイクロ秒 (欠損値は NULL)
+                    us = pd.Series(df[column].to_numpy().astype('datetime64[us]').astype('int64'), index = df.index, dtype = object)
+                    df[column] = us.where(df[column].notna(), None)
+                else:
+                    df[column] = df[column].astype(str)
+            nrecords += len(df)
+            if dedup is not None:
+                df = df[dedup.filter(infile, df['GP_ID'].to_numpy())]
+            insert_rows(df.values.tolist())
+        else:
+            # JSONファイルは少しずつ読み込み、batch_size レコードずつ変換してINSERTする
+            nread = 0
+            for batch in iter_batches(infile, columns_read, batch_size):
+                nread += len(batch)
+                if dedup is not None:
+                    batch = compress(batch, dedup.filter(infile, [row[gp_id_index] for row in batch]))
+                if compact:
+                    batch = elsetschema.compact_rows(batch, columns_read)
+                insert_rows(batch)
+            logger.debug('{} records read'.format(nread))
+            nrecords += nread
+
+        if dedup is not None and infile in dedup.files:
+            logger.debug('{} duplicates'.format(dedup.files[infile][1]))
+
+        if args.bulk and nrecords - nmerged >= STAGE_SIZE:
+            ninserted += merge_staging(nrecords - nmerged)
+            nmerged = nrecords
+
+    if args.bulk:
+        if nrecords > nmerged:
+            ninserted += merge_staging(nrecords - nmerged)
+        logger.info('{} records inserted in {:.1f} sec'.format(ninserted, time.monotonic() - starttime))
+
+    if dedup is not None and dedup.duplicates > 0:
+        for line in dedup.report():
+            logger.info(line)
+        logger.info('{} duplicated records skipped'.format(dedup.duplicates))
+
+    if tle_writer is not None:
+        tle_writer.close()
+        logger.info('{} TLEs stored in {}_tle ({} rebuilt from the elsets), {} bytes'.format(
+            tle_writer.records, table, tle_writer.exact, tle_writer.compressed_bytes))
+        metrics.inc('tle_records', tle_writer.records)
+
+    if asof and args.bulk:
+        asoftime = time.monotonic()
+        asofindex.rebuild(cur, table)
+        logger.info('As-of index built in {:.1f} sec'.format(time.monotonic() - asoftime))
+
+    indextime = time.monotonic()
+    metrics.observe('load', indextime - starttime)
     for column in columns_with_index:
         cur.execute('CREATE INDEX IF NOT EXISTS index_{0}_{1} ON {0} ({1})'.format(table, column))
 
     con.commit()
+    if args.bulk:
+        logger.info('Indexes built in {:.1f} sec'.format(time.monotonic() - indextime))
+    metrics.observe('index', time.monotonic() - indextime)
+    metrics.inc('records_inserted', ninserted)
     con.close()
 
+    elapsed = time.monotonic() - starttime
+    logger.info('{} records in {:.1f} sec ({:.0f} records/sec)'.format(nrecords, elapsed, nrecords / elapsed if elapsed > 0 else 0))
+    metrics.inc('files', n)
+    metrics.inc('records_read', nrecords)
+    if dedup is not None:
+        metrics.inc('duplicates', dedup.duplicates)
+    metrics.set('records_per_second', nrecords / elapsed if elapsed > 0 else 0)
+    metrics.set('database_bytes', os.path.getsize(dbfile))
+
     sys.exit(0)
 
 if __name__ == '__main__':
-    main()
+    run('json2sqlite3', main)
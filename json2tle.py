@@ -1,31 +1,77 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pandas as pd
-import json
 import sys
 import re
+import argparse
+from functools import partial
+from gpjson import iter_records, imap_ordered
+from compressedfile import CODECS, CompressedWriter, compressed_filename
 
-if len(sys.argv) < 2:
-    print('Invalid number of arguments!')
-    sys.exit(1)
+p = re.compile(r'(?:\.json)?(?:\.gz|\.bz2|\.xz|\.zip|\.zst)?$')
 
-p = re.compile(r'(?:\.json)?(?:\.gz|\.bz2|\.xz|\.zip)?$')
+# Number of records written at once
+BATCH_SIZE = 10000
 
-for jsonfile in sys.argv[1:]: 
-    print('Input:', jsonfile)
-    tlefile = p.sub('', jsonfile) + '.tle'
-    df = pd.read_json(jsonfile, orient='records', dtype='object')
-    print(len(df), 'records read')
-    if len(df) == 0:
-        print('No output')
+# Yield lists of (TLE_LINE0, TLE_LINE1, TLE_LINE2) of at most BATCH_SIZE records
+def iter_tles(jsonfile, use_pandas = False):
+    if use_pandas:
+        # The whole file in memory (the former implementation, kept for comparison)
+        import pandas as pd
+        df = pd.read_json(jsonfile, orient='records', dtype='object')
+        if len(df) > 0:
+            yield list(zip(df['TLE_LINE0'], df['TLE_LINE1'], df['TLE_LINE2']))
+        return
+
+    batch = []
+    for record in iter_records(jsonfile):
+        batch.append((record['TLE_LINE0'], record['TLE_LINE1'], record['TLE_LINE2']))
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+# Convert a file. Run in worker processes with -j. Return the messages to print.
+def convert(jsonfile, codec = 'none', level = None, use_pandas = False):
+    messages = ['Input: ' + jsonfile]
+    tlefile = compressed_filename(p.sub('', jsonfile) + '.tle', codec)
+    writer = None
+    n = 0
+    try:
+        for batch in iter_tles(jsonfile, use_pandas):
+            # The output file is created when the first record is read
+            if writer is None:
+                writer = CompressedWriter(tlefile, codec, level)
+            writer.write(''.join('{}\n{}\n{}\n'.format(*tle) for tle in batch))
+            n += len(batch)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    messages.append('{} records read'.format(n))
+    if writer is None:
+        messages.append('No output')
     else:
-        print('Output:', tlefile)
-        with open(tlefile, 'w') as fp:
-            for line0, line1, line2 in zip(df['TLE_LINE0'], df['TLE_LINE1'], df['TLE_LINE2']):
-                fp.write(line0 + "\n")
-                fp.write(line1 + "\n")
-                fp.write(line2 + "\n")
+        writer.commit()
+        messages.append('Output: ' + tlefile)
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract TLE from JSON.')
+    parser.add_argument('JSON_file', type=str, nargs='+', help='Input JSON files.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes. Default: 1')
+    parser.add_argument('-z', '--codec', type=str, choices=CODECS.keys(), default='none', help='Compression of the output. Default: none')
+    parser.add_argument('-l', '--level', type=int, help='Compression level')
+    parser.add_argument('-p', '--pandas', action='store_true', help='Read JSON files with pandas (the whole file is read into memory)')
+    args = parser.parse_args()
+
+    func = partial(convert, codec = args.codec, level = args.level, use_pandas = args.pandas)
+    for messages in imap_ordered(func, args.JSON_file, args.jobs):
+        print('\n'.join(messages))
 
-sys.exit(0)
+    sys.exit(0)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import hashlib
+import os
+from datetime import datetime
+
+MANIFEST_FILE = 'download/manifest.sqlite3'
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Merge sorted units into ranges [(lo, hi), ...]
+def units_to_ranges(units):
+    ranges = []
+    for u in sorted(units):
+        if len(ranges) > 0 and ranges[-1][1] == u - 1:
+            ranges[-1] = (ranges[-1][0], u)
+        else:
+            ranges.append((u, u))
+    return ranges
+
+# Record of the requested ranges and their results.
+# `kind` identifies the query (e.g. 'gp_history/EPOCH'), and a range [lo, hi] is in units of
+# the query (NORAD Catalog Numbers, or ordinals of days).
+class Manifest:
+
+    def __init__(self, filename = MANIFEST_FILE):
+        dirname = os.path.dirname(filename)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok = True)
+        self.con = sqlite3.connect(filename, timeout = 60)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS request (
+            kind text, lo integer, hi integer, filename text, status text,
+            bytes integer, records integer, sha256 text, updated timestamp,
+            PRIMARY KEY (kind, lo, hi))''')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def _set(self, kind, lo, hi, filename, status, nbytes = None, records = None, sha256 = None):
+        self.con.execute('REPLACE INTO request VALUES (?,?,?,?,?,?,?,?,?)',
+            (kind, lo, hi, filename, status, nbytes, records, sha256, datetime.utcnow().isoformat(' ')))
+        self.con.commit()
+
+    # records is None if unknown (e.g. a file downloaded before the manifest existed)
+    def done(self, kind, lo, hi, filename, nbytes, records = None):
+        # A completed range supersedes the failed ranges in it (e.g. after a split)
+        self.con.execute("DELETE FROM request WHERE kind = ? AND lo >= ? AND hi <= ? AND status != 'done'", (kind, lo, hi))
+        self._set(kind, lo, hi, filename, 'done', nbytes, records, file_sha256(filename))
+
+    def failed(self, kind, lo, hi, filename):
+        self._set(kind, lo, hi, filename, 'failed')
+
+    def entries(self, kind, lo, hi, status = None):
+        sql = 'SELECT lo, hi, filename, status, bytes, records, sha256 FROM request WHERE kind = ? AND hi >= ? AND lo <= ?'
+        params = [kind, lo, hi]
+        if status is not None:
+            sql += ' AND status = ?'
+            params.append(status)
+        return self.con.execute(sql + ' ORDER BY lo, hi', params).fetchall()
+
+    # Units in [lo, hi] covered by completed ranges whose files still exist
+    def completed_units(self, kind, lo, hi):
+        units = set()
+        for lo1, hi1, filename, status, nbytes, records, sha256 in self.entries(kind, lo, hi, 'done'):
+            if os.path.isfile(filename):
+                units.update(range(max(lo, lo1), min(hi, hi1) + 1))
+        return units
+
+    # Check the archive of [lo, hi]. Return the ranges which are not covered by valid files,
+    # and the completed entries whose files are missing or modified.
+    def verify(self, kind, lo, hi, checksum = True):
+        units = set()
+        bad = []
+        for entry in self.entries(kind, lo, hi, 'done'):
+            lo1, hi1, filename, status, nbytes, records, sha256 = entry
+            if not os.path.isfile(filename):
+                bad.append((entry, 'missing'))
+            elif checksum and file_sha256(filename) != sha256:
+                bad.append((entry, 'checksum mismatch'))
+            else:
+                units.update(range(max(lo, lo1), min(hi, hi1) + 1))
+        holes = units_to_ranges(set(range(lo, hi + 1)) - units)
+        return holes, bad
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import tempfile
+import collections
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Every run of a script appends one JSON line to this file
+METRICS_FILE = os.environ.get('METRICS_FILE', 'log/metrics.jsonl')
+
+# Directory of the Prometheus textfile collector (node_exporter --collector.textfile.directory).
+# Each script writes <directory>/spacetrack_<name>.prom, replaced at every run.
+TEXTFILE_DIR = os.environ.get('METRICS_TEXTFILE_DIR', 'log')
+
+# Prefix of the Prometheus metric names
+PREFIX = 'spacetrack_'
+
+_metrics = {}
+
+# Per-stage timings, counters and gauges of one run of a script.
+#
+#   metrics = get_metrics('download_gp_date')
+#   metrics.inc('requests', result = 'ok')
+#   with metrics.timer('insert'):
+#       ...
+#
+# The values are written by write() (called by run() when the script exits) as a JSON line
+# and as a textfile for Prometheus, with the start time, the duration and the exit code of the run.
+# `instance` distinguishes the runs of a script with different targets (e.g. the database of json2sqlite3.py),
+# whose textfiles would overwrite each other.
+class Metrics:
+
+    def __init__(self, name, filename = METRICS_FILE, textfile_dir = TEXTFILE_DIR):
+        self.name = name
+        self.instance = None
+        self.filename = filename
+        self.textfile_dir = textfile_dir
+        self.starttime = time.time()
+        # (metric name, labels) -> value
+        self.values = collections.OrderedDict()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    # Add to a counter (e.g. requests, records, bytes)
+    def inc(self, name, value = 1, **labels):
+        key = self._key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    # Set a gauge (e.g. size of the database)
+    def set(self, name, value, **labels):
+        self.values[self._key(name, labels)] = value
+
+    # Add a duration. Written as <name>_seconds_sum, <name>_seconds_count and <name>_seconds_max.
+    def observe(self, name, seconds, **labels):
+        self.inc(name + '_seconds_sum', seconds, **labels)
+        self.inc(name + '_seconds_count', 1, **labels)
+        key = self._key(name + '_seconds_max', labels)
+        self.values[key] = max(self.values.get(key, 0.0), seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - t, **labels)
+
+    def get(self, name, **labels):
+        return self.values.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def _series(name, labels):
+        if len(labels) == 0:
+            return name
+        return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels))
+
+    def write(self, exit_code = 0):
+        now = time.time()
+        record = {'name': self.name, 'instance': self.instance,
+            'start': datetime.fromtimestamp(self.starttime, timezone.utc).isoformat(timespec = 'seconds'),
+            'duration': round(now - self.starttime, 3), 'exit_code': exit_code,
+            'values': {self._series(name, labels): value for (name, labels), value in self.values.items()}}
+        if self.filename is not None:
+            dirname = os.path.dirname(self.filename)
+            if dirname != '':
+                os.makedirs(dirname, exist_ok = True)
+            with open(self.filename, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+
+        if self.textfile_dir is not None:
+            self._write_textfile(now, exit_code)
+
+    # All values are gauges of the last run, with the label script="<name>"
+    def _write_textfile(self, now, exit_code):
+        lines = []
+        job = (('script', self.name),) + ((('instance', self.instance),) if self.instance is not None else ())
+        values = [('last_run_timestamp_seconds', (), now), ('last_run_duration_seconds', (), now - self.starttime),
+            ('last_run_exit_code', (), exit_code)] + [(name, labels, value) for (name, labels), value in self.values.items()]
+        # The samples of a metric must be contiguous after its TYPE line. The sort is stable, so the series keep their order
+        values.sort(key = lambda x: x[0])
+        typed = set()
+        for name, labels, value in values:
+            if name not in typed:
+                lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+                typed.add(name)
+            lines.append('{} {}'.format(self._series(PREFIX + name, job + labels), float(value)))
+        os.makedirs(self.textfile_dir, exist_ok = True)
+        # The collector may read the file at any time, so it is replaced atomically
+        fd, tmpfile = tempfile.mkstemp(prefix = '.spacetrack_', suffix = '.tmp', dir = self.textfile_dir)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.chmod(tmpfile, 0o644)
+        basename = self.name if self.instance is None else '{}_{}'.format(self.name, self.instance)
+        os.replace(tmpfile, os.path.join(self.textfile_dir, '{}{}.prom'.format(PREFIX, basename)))
+
+# The Metrics of the script `name` (like logging.getLogger)
+def get_metrics(name):
+    if name not in _metrics:
+        _metrics[name] = Metrics(name)
+    return _metrics[name]
+
+# Run func (main() of a script) and write its metrics when it exits,
+# with the code given to sys.exit() (1 for an exception)
+def run(name, func):
+    metrics = get_metrics(name)
+    exit_code = 1
+    try:
+        func()
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        raise
+    finally:
+        try:
+            metrics.write(exit_code)
+        except OSError as e:
+            print('Failed to write metrics: {}'.format(e), file = sys.stderr)
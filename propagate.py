@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 多数の衛星の位置を共通の時刻の列で SGP4 により計算する。
+#
+# 各時刻には、その時刻以前で EPOCH が最も新しい elset を使う (最初の elset より前の時刻には最初の elset を使う)。
+# 時刻の列をブロックに分け、各ブロックで使われる elset をまとめて sgp4 の SatrecArray で計算する。
+# 位置・速度は TEME 座標系 [km], [km/s]。ALTITUDE は地心距離から地球の赤道半径を引いたもの。
+
+import pandas as pd
+import numpy as np
+import sys
+import sqlite3
+import argparse
+import collections
+from datetime import datetime, timedelta
+from functools import partial
+from sgp4.api import Satrec, SatrecArray, WGS72
+from setup_logger import setup_logger
+from metrics import run
+from gpjson import imap_ordered
+import elsetschema
+import tlestore
+
+# 地球の赤道半径 [km] (WGS72)
+EARTH_RADIUS = 6378.135
+
+# 1日 [マイクロ秒]
+DAY = 86400 * 1000000
+
+# sgp4init の EPOCH の基準 (1949-12-31 00:00 UT) のユリウス日
+JD_1949 = 2433281.5
+
+# 1970-01-01 00:00 UT のユリウス日
+JD_1970 = 2440587.5
+
+# 一度に計算する時刻の数
+BLOCK_SIZE = 60
+
+# 時刻の列の最初より前の elset を探す期間 [日]
+LOOKBACK = 30
+
+# 1つのプロセスで一度に計算する衛星の数
+CHUNK_SIZE = 2000
+
+# キャッシュする satrec の数
+CACHE_SIZE = 200000
+
+# elset から SGP4 の計算に使うカラム
+OMM_COLUMNS = ['GP_ID', 'NORAD_CAT_ID', 'EPOCH', 'MEAN_MOTION', 'ECCENTRICITY', 'INCLINATION', 'RA_OF_ASC_NODE',
+    'ARG_OF_PERICENTER', 'MEAN_ANOMALY', 'BSTAR']
+TLE_COLUMNS = ['TLE_LINE1', 'TLE_LINE2']
+
+# (GP_ID, TLEから作ったか) をキーとした satrec のキャッシュ (古いものから削除する)
+_satrec_cache = collections.OrderedDict()
+
+# OMM のフィールドから satrec を作る。MEAN_MOTION_DOT, MEAN_MOTION_DDOT は SGP4 の計算には使われないので 0 とする
+def satrec_from_omm(norad_cat_id, epoch_jd, mean_motion, eccentricity, inclination, ra_of_asc_node, arg_of_pericenter, mean_anomaly, bstar):
+    sat = Satrec()
+    sat.sgp4init(WGS72, 'i', int(norad_cat_id), epoch_jd - JD_1949, bstar, 0.0, 0.0, eccentricity,
+        np.radians(arg_of_pericenter), np.radians(inclination), np.radians(mean_anomaly),
+        mean_motion * 2 * np.pi / 1440, np.radians(ra_of_asc_node))
+    return sat
+
+# elset の DataFrame の各行の satrec のリスト。TLE があればTLEから、なければ OMM のフィールドから作る
+def get_satrecs(elsets, use_tle = True):
+    use_tle = use_tle and all(column in elsets.columns for column in TLE_COLUMNS)
+    epoch_jd = JD_1970 + to_microseconds(elsets['EPOCH']) / DAY
+    omm = zip(*(elsets[column].tolist() for column in OMM_COLUMNS[3:]))
+    tle = zip(elsets['TLE_LINE1'].tolist(), elsets['TLE_LINE2'].tolist()) if use_tle else ((None, None) for i in range(len(elsets)))
+    satrecs = []
+    for gp_id, norad_cat_id, jd, fields, (line1, line2) in zip(elsets['GP_ID'].tolist(), elsets['NORAD_CAT_ID'].tolist(), epoch_jd, omm, tle):
+        key = (gp_id, isinstance(line1, str) and isinstance(line2, str))
+        sat = _satrec_cache.get(key)
+        if sat is not None:
+            _satrec_cache.move_to_end(key)
+        else:
+            if key[1]:
+                sat = Satrec.twoline2rv(line1, line2, WGS72)
+            else:
+                sat = satrec_from_omm(norad_cat_id, jd, *fields)
+            _satrec_cache[key] = sat
+            if len(_satrec_cache) > CACHE_SIZE:
+                _satrec_cache.popitem(last = False)
+        satrecs.append(sat)
+    return satrecs
+
+# 日時 (文字列, datetime64, compact なテーブルの整数) の列を 1970-01-01 からのマイクロ秒にする
+def to_microseconds(values):
+    return np.asarray(values, dtype = 'datetime64[us]').astype('int64')
+
+# start から end まで step 秒ごとの時刻の列 (datetime64[us])
+def time_grid(start, end, step):
+    return np.arange(np.datetime64(start, 'us'), np.datetime64(end, 'us') + np.timedelta64(1, 'us'), np.timedelta64(int(step * 1000000), 'us'))
+
+# 時刻の列の最初から最後までの elset をデータベースから読み込む。extra_columns: OMM_COLUMNS 以外に読み込むカラム
+def load_elsets(dbfile, table, start, end, norad_cat_ids = None, lookback = LOOKBACK, use_tle = True, extra_columns = []):
+    with sqlite3.connect(dbfile) as con:
+        columns = [row[1] for row in con.execute('PRAGMA table_info({})'.format(table))]
+        select = OMM_COLUMNS + extra_columns + (TLE_COLUMNS if use_tle and all(column in columns for column in TLE_COLUMNS) else [])
+        # TLE が TABLE_tle にある場合 (json2sqlite3.py -s) は、読み込んだ elset の TLE を後で結合する
+        store = use_tle and 'TLE_LINE1' not in columns and tlestore.has_store(con, table)
+        if store:
+            select = OMM_COLUMNS + extra_columns + [column for column in tlestore.READ_COLUMNS if column not in OMM_COLUMNS + extra_columns]
+        sql = 'SELECT {} FROM {} WHERE EPOCH >= ? AND EPOCH <= ?'.format(', '.join(select), table)
+        # compact なテーブルでは EPOCH はマイクロ秒 (to_microseconds() はどちらの形式も扱える)
+        compact = elsetschema.is_compact(con, table)
+        params = [elsetschema.to_param(start - timedelta(days = lookback), compact), elsetschema.to_param(end, compact)]
+        if norad_cat_ids is not None:
+            sql += ' AND NORAD_CAT_ID IN ({})'.format(','.join(str(int(x)) for x in norad_cat_ids))
+        elsets = pd.read_sql_query(sql, con, params = params)
+        if store:
+            elsets = tlestore.TLEReader(con, table).add_lines(elsets, TLE_COLUMNS)[OMM_COLUMNS + extra_columns + TLE_COLUMNS]
+        return elsets
+
+# 時刻の列の各時刻に使う elset を決める。
+# 返り値: 衛星の NORAD_CAT_ID のリスト, 使う elset (elsets の行), その衛星の番号, 使い始める時刻と使い終わる時刻のインデックス
+def schedule(elsets, times):
+    ids = elsets['NORAD_CAT_ID'].to_numpy(dtype = 'int64')
+    epoch = to_microseconds(elsets['EPOCH'])
+    order = np.lexsort((epoch, ids))
+    ids = ids[order]
+    epoch = epoch[order]
+    t = times.astype('datetime64[us]').astype('int64')
+
+    newobj = np.r_[True, ids[1:] != ids[:-1]]
+    objects = np.cumsum(newobj) - 1
+    # 各 elset は EPOCH 以降の最初の時刻から、同じ衛星の次の elset を使い始める時刻の前まで使う
+    k_start = np.searchsorted(t, epoch, side = 'left')
+    k_start[newobj] = 0
+    k_end = np.r_[k_start[1:], len(t)]
+    k_end[np.r_[newobj[1:], True]] = len(t)
+    # 一度も使われない elset (時刻の列の前に次の elset があるもの、時刻の間に次の elset があるもの) は除く
+    used = k_start < k_end
+    return ids[newobj], order[used], objects[used], k_start[used], k_end[used]
+
+# 時刻の列の位置・速度を計算する。ブロックごとに (最初の時刻のインデックス, 位置, 速度) を返す。
+# 位置・速度の形は (衛星の数, ブロックの時刻の数, 3)。計算できなかった値は NaN。
+def propagate_blocks(elsets, times, block_size = BLOCK_SIZE, use_tle = True):
+    norad_cat_ids, rows, objects, k_start, k_end = schedule(elsets, times)
+    satrecs = get_satrecs(elsets.iloc[rows], use_tle)
+
+    t = times.astype('datetime64[us]').astype('int64')
+    days = t // DAY
+    jd = JD_1970 + days.astype('float64')
+    fr = (t - days * DAY) / DAY
+
+    for b0 in range(0, len(times), block_size):
+        b1 = min(b0 + block_size, len(times))
+        active = np.flatnonzero((k_start < b1) & (k_end > b0))
+        r = np.full((len(norad_cat_ids), b1 - b0, 3), np.nan)
+        v = np.full((len(norad_cat_ids), b1 - b0, 3), np.nan)
+        if len(active) > 0:
+            e, r1, v1 = SatrecArray([satrecs[i] for i in active]).sgp4(jd[b0:b1], fr[b0:b1])
+            # 各 elset を使う時刻のみを取り出す
+            k = np.arange(b0, b1)
+            mask = (k >= k_start[active, None]) & (k < k_end[active, None]) & (e == 0)
+            obj, col = np.nonzero(mask)
+            r[objects[active][obj], col] = r1[mask]
+            v[objects[active][obj], col] = v1[mask]
+        yield b0, r, v
+
+# 時刻の列の位置・速度を計算する。返り値は NORAD_CAT_ID のリストと、(衛星の数, 時刻の数, 3) の位置・速度
+def propagate(elsets, times, block_size = BLOCK_SIZE, use_tle = True):
+    norad_cat_ids = np.unique(elsets['NORAD_CAT_ID'].to_numpy(dtype = 'int64'))
+    r = np.full((len(norad_cat_ids), len(times), 3), np.nan)
+    v = np.full((len(norad_cat_ids), len(times), 3), np.nan)
+    for b0, r1, v1 in propagate_blocks(elsets, times, block_size, use_tle):
+        r[:, b0:b0 + r1.shape[1]] = r1
+        v[:, b0:b0 + v1.shape[1]] = v1
+    return norad_cat_ids, r, v
+
+# 衛星を chunk_size 個ずつに分けて jobs 個のプロセスで計算する。NORAD_CAT_ID 順に propagate() の返り値を返す
+def propagate_chunks(elsets, times, block_size = BLOCK_SIZE, use_tle = True, jobs = 1, chunk_size = CHUNK_SIZE):
+    ids = elsets['NORAD_CAT_ID'].to_numpy(dtype = 'int64')
+    order = np.argsort(ids, kind = 'stable')
+    starts = np.flatnonzero(np.r_[True, ids[order][1:] != ids[order][:-1]])
+    bounds = np.r_[starts[::chunk_size], len(ids)]
+    chunks = [elsets.iloc[order[bounds[i]:bounds[i + 1]]] for i in range(len(bounds) - 1)]
+    return imap_ordered(partial(propagate, times = times, block_size = block_size, use_tle = use_tle), chunks, jobs)
+
+def altitude(r):
+    return np.linalg.norm(r, axis = -1) - EARTH_RADIUS
+
+# Parquet ファイルに (NORAD_CAT_ID, TIME) の順で書き込む。衛星の chunk ごとに row group にする
+def write_parquet(filename, elsets, times, block_size = BLOCK_SIZE, use_tle = True, velocity = False, jobs = 1, chunk_size = CHUNK_SIZE):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    nrows = 0
+    for norad_cat_ids, r, v in propagate_chunks(elsets, times, block_size, use_tle, jobs, chunk_size):
+        columns = {'NORAD_CAT_ID': pa.array(np.repeat(norad_cat_ids, len(times))),
+            'TIME': pa.array(np.tile(times.astype('datetime64[us]'), len(norad_cat_ids)))}
+        r = r.reshape(-1, 3)
+        for i, axis in enumerate('XYZ'):
+            columns[axis] = pa.array(r[:, i])
+        if velocity:
+            v = v.reshape(-1, 3)
+            for i, axis in enumerate('XYZ'):
+                columns['V' + axis] = pa.array(v[:, i])
+        columns['ALTITUDE'] = pa.array(altitude(r))
+        table = pa.table(columns)
+        if writer is None:
+            writer = pq.ParquetWriter(filename, table.schema, compression = 'zstd')
+        writer.write_table(table, row_group_size = table.num_rows)
+        nrows += table.num_rows
+    if writer is not None:
+        writer.close()
+    return nrows
+
+def main():
+    logger = setup_logger('propagate')
+
+    parser = argparse.ArgumentParser(description='Propagate elsets of many objects on a time grid with SGP4.')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 Database file created by json2sqlite3.py')
+    parser.add_argument('START', type=str, help='Start time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC)')
+    parser.add_argument('END', type=str, help='End time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC)')
+    parser.add_argument('NORAD_CAT_ID', type=int, nargs='*', help='NORAD Catalog Numbers. Default: all objects')
+    parser.add_argument('-t', '--table', type=str, default='elset', help='Table name. Default: elset')
+    parser.add_argument('-s', '--step', type=float, default=60, help='Step of the time grid in seconds. Default: 60')
+    parser.add_argument('-o', '--output', type=str, default='propagate.parquet', help='Output file (.parquet or .npz). Default: propagate.parquet')
+    parser.add_argument('-v', '--velocity', action='store_true', help='Output velocities')
+    parser.add_argument('--omm', action='store_true', help='Use OMM fields instead of TLE lines even if the table has them')
+    parser.add_argument('--lookback', type=float, default=LOOKBACK, help='Days to look back for the elset at START. Default: {}'.format(LOOKBACK))
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes. Default: 1')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='Number of objects propagated at once by a process. Default: {}'.format(CHUNK_SIZE))
+    parser.add_argument('-b', '--block_size', type=int, default=BLOCK_SIZE, help='Number of times propagated at once. Default: {}'.format(BLOCK_SIZE))
+
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.START)
+    end = datetime.fromisoformat(args.END)
+    times = time_grid(start, end, args.step)
+    use_tle = not args.omm
+
+    starttime = datetime.now()
+    elsets = load_elsets(args.DATABASE, args.table, start, end, args.NORAD_CAT_ID if len(args.NORAD_CAT_ID) > 0 else None, args.lookback, use_tle)
+    logger.info('{} elsets of {} objects, {} times'.format(len(elsets), elsets['NORAD_CAT_ID'].nunique(), len(times)))
+    if len(elsets) == 0:
+        logger.error('No elsets')
+        sys.exit(1)
+
+    logger.info('Output: {}'.format(args.output))
+    if args.output.endswith('.npz'):
+        results = list(propagate_chunks(elsets, times, args.block_size, use_tle, args.jobs, args.chunk_size))
+        norad_cat_ids, r, v = (np.concatenate(x) for x in zip(*results))
+        arrays = {'time': times, 'norad_cat_id': norad_cat_ids, 'r': r, 'altitude': altitude(r)}
+        if args.velocity:
+            arrays['v'] = v
+        np.savez(args.output, **arrays)
+        nrows = r.shape[0] * r.shape[1]
+    else:
+        nrows = write_parquet(args.output, elsets, times, args.block_size, use_tle, args.velocity, args.jobs, args.chunk_size)
+
+    elapsed = (datetime.now() - starttime).total_seconds()
+    logger.info('{} positions in {:.1f} sec ({:.0f} positions/sec)'.format(nrows, elapsed, nrows / elapsed if elapsed > 0 else 0))
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('propagate', main)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import time
+import os
+
+# Limit API queries to less than 30 requests per minute / 300 requests per hour
+# (count, window in seconds)
+RATE_LIMITS = ((30, 60), (300, 3600))
+
+# Shared by all download scripts (and by all processes running them)
+RATELIMIT_FILE = 'db/ratelimit.sqlite3'
+
+# Extra seconds added to each window to absorb the latency between our clock and the server's
+MARGIN = 1.0
+
+# Sliding window rate limiter whose state lives in an SQLite file.
+# Every granted request is recorded with its time. A new request is granted only if fewer
+# than `count` requests were granted within the last `window` seconds for every (count, window)
+# in `limits`, so concurrent processes share the whole budget without exceeding it.
+# `clock` and `sleep` can be replaced by fake ones for testing.
+class RateLimiter:
+
+    def __init__(self, filename = RATELIMIT_FILE, limits = RATE_LIMITS, margin = MARGIN,
+            clock = time.time, sleep = time.sleep, logger = None):
+        self.filename = filename
+        self.limits = [(count, window + margin) for count, window in limits]
+        self.clock = clock
+        self.sleep = sleep
+        self.logger = logger
+
+        dirname = os.path.dirname(filename)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok = True)
+
+        # isolation_level = None: transactions are controlled explicitly by BEGIN IMMEDIATE
+        self.con = sqlite3.connect(filename, timeout = 60, isolation_level = None)
+        self.con.execute('CREATE TABLE IF NOT EXISTS request (time real NOT NULL)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS index_request_time ON request (time)')
+
+    def close(self):
+        self.con.close()
+
+    # Try to take a slot. Return 0 on success, otherwise the number of seconds to wait.
+    def reserve(self):
+        cur = self.con.cursor()
+        # BEGIN IMMEDIATE takes the write lock, so check-and-insert is atomic among processes
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            now = self.clock()
+            longest = max(window for count, window in self.limits)
+            cur.execute('DELETE FROM request WHERE time <= ?', (now - longest,))
+
+            wait = 0.0
+            for count, window in self.limits:
+                # The count-th newest request in the window decides when the next slot opens
+                cur.execute('SELECT time FROM request WHERE time > ? ORDER BY time DESC LIMIT 1 OFFSET ?',
+                    (now - window, count - 1))
+                row = cur.fetchone()
+                if row is not None:
+                    wait = max(wait, row[0] + window - now)
+
+            if wait <= 0:
+                cur.execute('INSERT INTO request (time) VALUES (?)', (now,))
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+
+        return wait
+
+    # Block until a slot is taken. Return the total time slept.
+    def acquire(self):
+        slept = 0.0
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return slept
+            if self.logger is not None:
+                self.logger.debug('Rate limit: sleep %f secs', wait)
+            self.sleep(wait)
+            slept += wait
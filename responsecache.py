@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import lzma
+import time
+import hashlib
+import sqlite3
+import argparse
+from datetime import datetime, date, timedelta
+import dateutil.parser
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+from compressedfile import CODECS, CompressedWriter, zstandard
+from gpjson import open_compressed
+
+# Directory of the cached responses. The index is CACHE_DIR/index.sqlite3
+CACHE_DIR = 'download/cache'
+
+# Upper limit of the compressed responses in the cache (bytes). The least recently used ones are evicted beyond it
+MAX_BYTES = 4 * 1024 ** 3
+
+# Expiry of a response by the age of the time range of its query, at the time it was fetched:
+# an EPOCH range which had ended HISTORY_AGE before is immutable (no more elsets are expected for it),
+# a CREATION_DATE range which had ended CREATION_AGE before is immutable (records are not created in the past),
+# other time ranges (recent or open-ended) expire after RECENT_TTL, and the other queries (e.g. satcat) after DEFAULT_TTL.
+HISTORY_AGE = timedelta(days = 30)
+CREATION_AGE = timedelta(days = 1)
+RECENT_TTL = 3600 # sec
+DEFAULT_TTL = 6 * 3600 # sec
+
+# Codec and level of the cached responses (fast, as every response fetched is compressed once more)
+CODEC = ('zstd', 3) if zstandard is not None else ('xz', 1)
+
+# Size of the blocks read from a cached response
+BLOCK_SIZE = 1024 * 1024
+
+# Results of getdata() of the download scripts when it succeeds (False when it fails):
+# the response was served from the cache without a request, or fetched from Space-Track
+CACHED = 'cached'
+FETCHED = 'fetched'
+
+# Errors of a missing or corrupted response file
+READ_ERRORS = (OSError, EOFError, ValueError, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def _stringify(value):
+    if isinstance(value, (list, tuple)):
+        return ','.join(_stringify(x) for x in value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return str(value).strip()
+
+# The query of a request as a canonical JSON string: the class, the predicates (name -> value as sent) and orderby.
+# Queries which differ only in the order or the case of the names, or in the default ' asc' of orderby, are the same
+def normalize_query(cls, predicates, orderby = ()):
+    orderby = [_stringify(x).lower() for x in orderby]
+    orderby = [x[:-len(' asc')] if x.endswith(' asc') else x for x in orderby]
+    return json.dumps({'class': cls.lower(), 'predicates': {name.lower(): _stringify(value) for name, value in predicates.items()},
+        'orderby': orderby}, sort_keys = True, separators = (',', ':'))
+
+def query_key(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+# The end of the time range of a predicate value ('A--B', '<B', or a date), or None if it is open-ended ('>A', '<>A')
+def range_end(value):
+    try:
+        if '--' in value:
+            return dateutil.parser.parse(value.split('--')[-1])
+        if value.startswith('<') and not value.startswith('<>'):
+            return dateutil.parser.parse(value[1:])
+        if value[:1].isdigit():
+            end = dateutil.parser.parse(value)
+            # A date without time matches the whole day
+            return end + timedelta(days = 1) if len(value) <= len('YYYY-MM-DD') else end
+    except (ValueError, OverflowError):
+        pass
+    return None
+
+# When a response of the query fetched at `fetched` (UNIX time) expires (UNIX time), or None if it never expires
+def expires_at(query, fetched):
+    predicates = json.loads(query)['predicates']
+    fetched_date = datetime.utcfromtimestamp(fetched)
+    for column, age in (('epoch', HISTORY_AGE), ('creation_date', CREATION_AGE)):
+        if column in predicates:
+            end = range_end(predicates[column])
+            if end is not None and end.replace(tzinfo = None) + age <= fetched_date:
+                return None
+            return fetched + RECENT_TTL
+    return fetched + DEFAULT_TTL
+
+# Writes a response to the cache while it is downloaded. Used with TeeWriter by getdata(),
+# and stored in the cache by commit() when the download succeeded.
+class CacheWriter:
+
+    def __init__(self, cache, query):
+        self.cache = cache
+        self.query = query
+        self.codec, level = CODEC
+        # Renamed to the name of its content by ResponseCache.store()
+        self.filename = os.path.join(cache.directory, '.{}.{}{}'.format(query_key(query), os.getpid(), CODECS[self.codec][0]))
+        self.writer = CompressedWriter(self.filename, codec = self.codec, level = level)
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.sha256.update(data)
+        self.writer.write(data)
+
+    def reset(self):
+        self.writer.reset()
+        self.sha256 = hashlib.sha256()
+
+    def abort(self):
+        self.writer.abort()
+
+    # A failure of the cache doesn't fail the download
+    def commit(self):
+        try:
+            self.writer.commit()
+            self.cache.store(self.query, self.filename, self.sha256.hexdigest(), self.writer.raw_bytes, self.writer.compressed_bytes)
+        except (OSError, sqlite3.Error) as e:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            if self.cache.logger is not None:
+                self.cache.logger.warning('Fail to cache the response: {}'.format(e))
+
+# Content-addressed cache of the responses of Space-Track, under getdata() of the download scripts.
+# A response is stored once under the SHA-256 of its content (DIRECTORY/ab/abcd....zst), and the table `response`
+# of the index maps the normalized query (see normalize_query()) to it, with the time it was fetched and its expiry (see expires_at()).
+# A query whose response is in the cache and not expired is served from the cache without a request,
+# so repeated and re-run downloads don't use the rate limit of the API. In offline mode, no request is sent at all
+# and expired responses are served too.
+# The total size of the responses is kept under max_bytes by evicting the expired ones first, then the least recently used ones.
+# `clock` can be replaced by a fake one for testing.
+class ResponseCache:
+
+    def __init__(self, directory = CACHE_DIR, max_bytes = MAX_BYTES, offline = False, clock = time.time, logger = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.clock = clock
+        self.logger = logger
+        os.makedirs(directory, exist_ok = True)
+        self.con = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), timeout = 60)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS response (
+            key text PRIMARY KEY, query text, filename text, sha256 text, bytes integer, compressed_bytes integer,
+            fetched real, expires real, last_used real)''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS index_response_filename ON response (filename)')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    # The cached response of the query: (filename, sha256, bytes, fetched), or None if not cached (or expired unless offline)
+    def lookup(self, query):
+        row = self.con.execute('SELECT filename, sha256, bytes, fetched, expires FROM response WHERE key = ?', (query_key(query),)).fetchone()
+        if row is None or (not self.offline and row[4] is not None and row[4] <= self.clock()):
+            return None
+        return row[:4]
+
+    # Write the cached response of the query to writer (and counter, as getdata() does). Return False if it is not cached
+    def serve(self, query, writer, counter = None, metrics = None):
+        row = self.lookup(query)
+        if row is None:
+            if self.offline and self.logger is not None:
+                self.logger.error('Not in the cache (offline): {}'.format(query))
+            if metrics is not None:
+                metrics.inc('cache', result = 'miss')
+            return False
+        filename, sha256, nbytes, fetched = row
+        # Only reading the cached file is guarded: an error of the writer (e.g. a full disk) is raised to the caller,
+        # and the response stays in the cache
+        h = hashlib.sha256()
+        try:
+            fp = open_compressed(os.path.join(self.directory, filename), 'rb')
+        except READ_ERRORS as e:
+            return self._broken(query, filename, e, writer, counter, metrics)
+        with fp:
+            while True:
+                try:
+                    block = fp.read(BLOCK_SIZE)
+                except READ_ERRORS as e:
+                    return self._broken(query, filename, e, writer, counter, metrics)
+                if not block:
+                    break
+                h.update(block)
+                writer.write(block)
+                if counter is not None:
+                    counter.feed(block)
+        if h.hexdigest() != sha256:
+            return self._broken(query, filename, 'checksum mismatch', writer, counter, metrics)
+        with self.con:
+            self.con.execute('UPDATE response SET last_used = ? WHERE key = ?', (self.clock(), query_key(query)))
+        if self.logger is not None:
+            self.logger.info('Served from the cache: {} bytes fetched at {:%Y-%m-%d %H:%M:%S}'.format(nbytes, datetime.utcfromtimestamp(fetched)))
+        if metrics is not None:
+            metrics.inc('cache', result = 'hit')
+            metrics.inc('cache_bytes', nbytes)
+        return True
+
+    # A broken response is deleted, to be downloaded again (unless offline)
+    def _broken(self, query, filename, error, writer, counter, metrics):
+        if self.logger is not None:
+            self.logger.warning('Broken response in the cache: {}: {}'.format(filename, error))
+        writer.reset()
+        if counter is not None:
+            counter.reset()
+        self.delete(query_key(query))
+        if metrics is not None:
+            metrics.inc('cache', result = 'broken')
+        return False
+
+    def writer(self, query):
+        return CacheWriter(self, query)
+
+    # Store the response of the query, written to tmpfile
+    def store(self, query, tmpfile, sha256, nbytes, compressed_bytes):
+        filename = os.path.join(sha256[:2], sha256 + os.path.splitext(tmpfile)[1])
+        os.makedirs(os.path.join(self.directory, sha256[:2]), exist_ok = True)
+        # If the same content is already there, the file is replaced by an identical one
+        os.replace(tmpfile, os.path.join(self.directory, filename))
+        now = self.clock()
+        with self.con:
+            old = self.con.execute('SELECT filename FROM response WHERE key = ?', (query_key(query),)).fetchone()
+            self.con.execute('REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (query_key(query), query, filename, sha256, nbytes, compressed_bytes, now, expires_at(query, now), now))
+        if old is not None and old[0] != filename:
+            self._remove_unused(old[0])
+        self.evict()
+
+    def _remove_unused(self, filename):
+        if self.con.execute('SELECT 1 FROM response WHERE filename = ?', (filename,)).fetchone() is None:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def delete(self, key):
+        row = self.con.execute('SELECT filename FROM response WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return
+        with self.con:
+            self.con.execute('DELETE FROM response WHERE key = ?', (key,))
+        self._remove_unused(row[0])
+
+    # Bytes of the response files (a file shared by several queries is counted once)
+    def total_bytes(self):
+        (total,) = self.con.execute('SELECT SUM(compressed_bytes) FROM (SELECT DISTINCT filename, compressed_bytes FROM response)').fetchone()
+        return total or 0
+
+    # Evict responses until the total size is under max_bytes: the expired ones first, then the least recently used ones
+    def evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return 0
+        keys = [key for (key,) in self.con.execute('SELECT key FROM response ORDER BY (expires IS NOT NULL AND expires <= ?) DESC, last_used',
+            (self.clock(),))]
+        nevicted = 0
+        for key in keys:
+            if total <= self.max_bytes:
+                break
+            self.delete(key)
+            nevicted += 1
+            total = self.total_bytes()
+        if self.logger is not None:
+            self.logger.info('Evicted {} responses from the cache ({} bytes)'.format(nevicted, total))
+        return nevicted
+
+    # Delete the expired responses
+    def purge(self):
+        keys = [key for (key,) in self.con.execute('SELECT key FROM response WHERE expires <= ?', (self.clock(),))]
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+# Options of the cache for the download scripts
+def add_arguments(parser):
+    parser.add_argument('--cache', type=str, default=CACHE_DIR, metavar='DIRECTORY', help='Directory of the response cache. Default: {}'.format(CACHE_DIR))
+    parser.add_argument('--cache_size', type=float, default=MAX_BYTES / 1024 ** 3, help='Maximum size of the response cache in GB. Default: {:g}'.format(MAX_BYTES / 1024 ** 3))
+    parser.add_argument('--no_cache', action='store_true', help="Don't use the response cache.")
+    parser.add_argument('--offline', action='store_true', help='Serve the queries only from the response cache, including expired responses. No request is sent.')
+
+# The cache of the options of add_arguments(), or None if it is not used
+def from_arguments(args, logger = None):
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache, int(args.cache_size * 1024 ** 3), args.offline, logger = logger)
+
+def main():
+    logger = setup_logger('responsecache')
+    metrics = get_metrics('responsecache')
+
+    parser = argparse.ArgumentParser(description='Show or clean the cache of Space-Track responses of the download scripts.')
+    parser.add_argument('DIRECTORY', type=str, nargs='?', default=CACHE_DIR, help='Directory of the cache. Default: {}'.format(CACHE_DIR))
+    parser.add_argument('-l', '--list', action='store_true', help='List the cached queries')
+    parser.add_argument('-p', '--purge', action='store_true', help='Delete the expired responses')
+    parser.add_argument('--clear', action='store_true', help='Delete all the responses')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.DIRECTORY, 'index.sqlite3')):
+        logger.critical('error: No cache in {}'.format(args.DIRECTORY))
+        sys.exit(1)
+
+    cache = ResponseCache(args.DIRECTORY, logger = logger)
+    now = cache.clock()
+    if args.clear:
+        keys = [key for (key,) in cache.con.execute('SELECT key FROM response')]
+        for key in keys:
+            cache.delete(key)
+        logger.info('{} responses deleted'.format(len(keys)))
+    elif args.purge:
+        logger.info('{} expired responses deleted'.format(cache.purge()))
+
+    if args.list:
+        for query, nbytes, fetched, expires in cache.con.execute('SELECT query, bytes, fetched, expires FROM response ORDER BY fetched'):
+            state = 'immutable' if expires is None else ('expired' if expires <= now else 'expires {:%Y-%m-%d %H:%M:%S}'.format(datetime.utcfromtimestamp(expires)))
+            print('{:%Y-%m-%d %H:%M:%S}\t{}\t{}\t{}'.format(datetime.utcfromtimestamp(fetched), nbytes, state, query))
+
+    (nresponses, nbytes) = cache.con.execute('SELECT COUNT(*), SUM(bytes) FROM response').fetchone()
+    logger.info('{} responses, {} bytes ({} bytes compressed)'.format(nresponses, nbytes or 0, cache.total_bytes()))
+    metrics.set('responses', nresponses)
+    metrics.set('cache_bytes', cache.total_bytes())
+    cache.close()
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('responsecache', main)
@@ -4,42 +4,140 @@
 import pandas as pd
 import os
 import sys
+import json
+import hashlib
 import argparse
 import sqlite3
+from datetime import datetime
 from setup_logger import setup_logger
+from metrics import get_metrics, run
+
+# レコードの内容のハッシュ (DBに格納されている値と、JSONから変換した値を比較する)
+def row_hash(row):
+    return hashlib.sha1(json.dumps(row).encode('utf-8')).hexdigest()
+
+# JSONの各カラムの型 (https://www.space-track.org/basicspacedata/modeldef/class/satcat/format/html)
+dtype = {'INTLDES': object, 'NORAD_CAT_ID': 'uint32', 'OBJECT_TYPE': object, 'SATNAME': object,
+    'COUNTRY': object, 'LAUNCH': 'datetime64[ns]', 'SITE': object, 'DECAY': 'datetime64[ns]',
+    'PERIOD': 'float64', 'INCLINATION': 'float64', 'APOGEE': 'uint64', 'PERIGEE': 'uint64',
+    'COMMENT': object, 'COMMENTCODE': 'uint8', 'RCSVALUE': 'int32', 'RCS_SIZE': object,
+    'FILE': 'uint16', 'LAUNCH_YEAR': 'uint16', 'LAUNCH_NUM': 'uint16', 'LAUNCH_PIECE': object,
+    'CURRENT': object, 'OBJECT_NAME': object, 'OBJECT_ID': object, 'OBJECT_NUMBER': 'uint32'}
+
+# JSONで日時として扱うカラム
+convert_dates = ['LAUNCH', 'DECAY']
+
+# DBで整数、実数として格納するカラム。欠損値があると dtype が効かずに文字列のままになるため、読み込み後に変換する
+# (DBに格納されている値と型が違うと、同じ値でもハッシュが一致しない)
+columns_integer = ['NORAD_CAT_ID', 'APOGEE', 'PERIGEE', 'RCSVALUE']
+columns_real = ['PERIOD', 'INCLINATION']
+
+# DBに保存するカラム名
+columns_out = ['NORAD_CAT_ID', 'OBJECT_TYPE', 'COUNTRY', 'LAUNCH', 'DECAY', 'PERIOD', 'INCLINATION',
+    'APOGEE', 'PERIGEE', 'COMMENT', 'RCSVALUE', 'RCS_SIZE', 'CURRENT', 'OBJECT_NAME', 'OBJECT_ID']
+
+# テーブル作成 (テーブル名は後で入れる)
+create_table = '''CREATE TABLE IF NOT EXISTS {} (
+    NORAD_CAT_ID integer primary key, OBJECT_TYPE text, COUNTRY text, LAUNCH timestamp, DECAY timestamp, 
+    PERIOD real, INCLINATION real, APOGEE integer, PERIGEE integer, COMMENT text, RCSVALUE integer, 
+    RCS_SIZE text, CURRENT text, OBJECT_NAME text, OBJECT_ID text)'''
+
+# indexをつけるカラム
+columns_with_index = ['OBJECT_TYPE', 'LAUNCH', 'DECAY', 'CURRENT']
+
+# 変更履歴のテーブル作成 (テーブル名は後で入れる)。ACTION は insert または update。update ではカラムごとに1行
+create_history_table = '''CREATE TABLE IF NOT EXISTS {0}_history (
+    NORAD_CAT_ID integer, CHANGED timestamp, ACTION text, COLUMN_NAME text, OLD_VALUE, NEW_VALUE)'''
+create_history_index = '''CREATE INDEX IF NOT EXISTS index_{0}_history_NORAD_CAT_ID ON {0}_history (NORAD_CAT_ID)'''
+
+# レコード追加 (テーブル名は後で入れる)
+insert_record = 'INSERT INTO {} VALUES (' + ','.join('?' * len(columns_out)) + ')'
+upsert_record = insert_record + ' ON CONFLICT(NORAD_CAT_ID) DO UPDATE SET ' + ', '.join('{0} = excluded.{0}'.format(column) for column in columns_out[1:])
+replace_record = 'REPLACE INTO {} VALUES (' + ','.join('?' * len(columns_out)) + ')'
+
+# JSON (ファイル名またはファイルオブジェクト) を読み込み、DBに格納する値のリストを返す
+def read_satcat(source):
+    df = pd.read_json(source, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records')
+    if len(df) == 0:
+        return []
+    # DBに格納する値 (to_sql と同じく日時は 'YYYY-MM-DD HH:MM:SS' の文字列、欠損値は NULL)
+    df = df[columns_out].copy()
+    for column in convert_dates:
+        df[column] = df[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+    for column in columns_integer:
+        df[column] = pd.to_numeric(df[column]).astype('Int64')
+    for column in columns_real:
+        df[column] = pd.to_numeric(df[column]).astype('float64')
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+# テーブルを作り直して格納する。update の場合は変更されたレコードのみを更新し、変更を TABLE_history に記録する
+def store_satcat(rows, dbfile, table, update, logger, metrics):
+    logger.debug("connecting to {}".format(dbfile))
+    # 全ての変更を1つのトランザクションで行い、読み込み中のプロセスからは変更前か変更後のテーブルが見えるようにする
+    con = sqlite3.connect(dbfile, isolation_level = None)
+    cur = con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+
+    if not update:
+        cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+        cur.execute(create_table.format(table))
+        cur.executemany(insert_record.format(table), rows)
+        logger.info('{} records inserted'.format(len(rows)))
+        metrics.inc('records_inserted', len(rows))
+    else:
+        cur.execute(create_table.format(table))
+        cur.execute(create_history_table.format(table))
+        cur.execute(create_history_index.format(table))
+
+        version = sqlite3.sqlite_version.split('.')
+        if int(version[0]) > 3 or (int(version[0]) == 3 and int(version[1]) >= 24):
+            upsert = upsert_record.format(table)
+        else:
+            upsert = replace_record.format(table)
+
+        # 既存のレコードのハッシュ
+        current = {row[0]: row_hash(list(row)) for row in cur.execute('SELECT {} FROM {}'.format(', '.join(columns_out), table))}
+
+        changed = [row for row in rows if current.get(row[0]) != row_hash(row)]
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        history = []
+        ninserted = 0
+        for row in changed:
+            if row[0] not in current:
+                history.append((row[0], now, 'insert', None, None, None))
+                ninserted += 1
+                continue
+            old = cur.execute('SELECT {} FROM {} WHERE NORAD_CAT_ID = ?'.format(', '.join(columns_out), table), (row[0],)).fetchone()
+            for column, old_value, new_value in zip(columns_out, old, row):
+                if old_value != new_value:
+                    history.append((row[0], now, 'update', column, old_value, new_value))
+
+        cur.executemany(upsert, changed)
+        cur.executemany('INSERT INTO {}_history VALUES (?,?,?,?,?,?)'.format(table), history)
+        logger.info('{} records inserted, {} records updated, {} records unchanged'.format(
+            ninserted, len(changed) - ninserted, len(rows) - len(changed)))
+        metrics.inc('records_inserted', ninserted)
+        metrics.inc('records_updated', len(changed) - ninserted)
+        metrics.inc('history_rows', len(history))
 
-def main():
-    logger = setup_logger('satcat2qlite3')
-
-    # JSONの各カラムの型 (https://www.space-track.org/basicspacedata/modeldef/class/satcat/format/html)
-    dtype = {'INTLDES': object, 'NORAD_CAT_ID': 'uint32', 'OBJECT_TYPE': object, 'SATNAME': object,
-        'COUNTRY': object, 'LAUNCH': 'datetime64[ns]', 'SITE': object, 'DECAY': 'datetime64[ns]',
-        'PERIOD': 'float64', 'INCLINATION': 'float64', 'APOGEE': 'uint64', 'PERIGEE': 'uint64',
-        'COMMENT': object, 'COMMENTCODE': 'uint8', 'RCSVALUE': 'int32', 'RCS_SIZE': object,
-        'FILE': 'uint16', 'LAUNCH_YEAR': 'uint16', 'LAUNCH_NUM': 'uint16', 'LAUNCH_PIECE': object,
-        'CURRENT': object, 'OBJECT_NAME': object, 'OBJECT_ID': object, 'OBJECT_NUMBER': 'uint32'}
-
-    # JSONで日時として扱うカラム
-    convert_dates = ['LAUNCH', 'DECAY']
-
-    # DBに保存するカラム名
-    columns_out = ['NORAD_CAT_ID', 'OBJECT_TYPE', 'COUNTRY', 'LAUNCH', 'DECAY', 'PERIOD', 'INCLINATION',
-        'APOGEE', 'PERIGEE', 'COMMENT', 'RCSVALUE', 'RCS_SIZE', 'CURRENT', 'OBJECT_NAME', 'OBJECT_ID']
+    for column in columns_with_index:
+        cur.execute('CREATE INDEX IF NOT EXISTS index_{0}_{1} ON {0} ({1})'.format(table, column))
 
-    # テーブル作成 (テーブル名は後で入れる)
-    create_table = '''CREATE TABLE IF NOT EXISTS {} (
-        NORAD_CAT_ID integer primary key, OBJECT_TYPE text, COUNTRY text, LAUNCH timestamp, DECAY timestamp, 
-        PERIOD real, INCLINATION real, APOGEE integer, PERIGEE integer, COMMENT text, RCSVALUE integer, 
-        RCS_SIZE text, CURRENT text, OBJECT_NAME text, OBJECT_ID text)'''
+    cur.execute('COMMIT')
+    con.close()
+    metrics.inc('records_read', len(rows))
+    metrics.set('database_bytes', os.path.getsize(dbfile))
 
-    # indexをつけるカラム
-    columns_with_index = ['OBJECT_TYPE', 'LAUNCH', 'DECAY', 'CURRENT']
+def main():
+    logger = setup_logger('satcat2qlite3')
+    metrics = get_metrics('satcat2sqlite3')
 
     parser = argparse.ArgumentParser(description='Convert SATCAT JSON to SQLite3.')
 
     parser.add_argument('FILE', type=str, help='Input JSON file.')
     parser.add_argument('DATABASE', type=str, help='SQLite3 Database file.')
     parser.add_argument('TABLE', type=str, help='Table name.')
+    parser.add_argument('-u', '--update', action='store_true', help='Update only changed records and record the changes in TABLE_history, instead of recreating the table')
 
     args = parser.parse_args()
 
@@ -52,29 +150,16 @@ def main():
     if not os.path.isfile(infile):
         logger.critical('error: {} not found'.format(infile))
         sys.exit(1)
-    df = pd.read_json(infile, convert_dates = convert_dates, dtype = dtype, precise_float = True, orient = 'records')
+    rows = read_satcat(infile)
 
-    if len(df) == 0:
+    if len(rows) == 0:
         logger.error('error: No valid data in {}'.format(infile))
         sys.exit(1)
 
-    logger.debug('{} records read'.format(len(df)))
-
-    logger.debug("connecting to {}".format(dbfile))
-    con = sqlite3.connect(dbfile)
-    cur = con.cursor()
-
-    cur.execute('DROP TABLE IF EXISTS {}'.format(table))
-    cur.execute(create_table.format(table))
-    df[columns_out].to_sql(table, con, if_exists='append', index=None)
-
-    for column in columns_with_index:
-        cur.execute('CREATE INDEX IF NOT EXISTS index_{0}_{1} ON {0} ({1})'.format(table, column))
-
-    con.commit()
-    con.close()
+    logger.debug('{} records read'.format(len(rows)))
+    store_satcat(rows, dbfile, table, args.update, logger, metrics)
 
     sys.exit(0)
 
 if __name__ == '__main__':
-    main()
+    run('satcat2sqlite3', main)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 多数の衛星の接近 (conjunction) を、SGP4 で計算した位置からスクリーニングする。
+#
+# 1. 粗い時刻の列 (-s, デフォルト 10秒) で、全衛星の位置・速度を propagate.py と同じ方法でブロックごとに計算する。
+# 2. 各時刻の位置を一辺 R の格子に分け、同じ格子か隣接する格子にある衛星の組のみを候補とする (全ての組は調べない)。
+#    R は、その時刻の前後 step/2 の間に距離 D 以内に近づく可能性のある組を全て含む大きさ (D + 最大の速さ * step + 加速度の分)。
+# 3. 候補の組を次のフィルタで絞る。
+#    - 近地点・遠地点: elset の PERIAPSIS, APOAPSIS (に --pad を加えたもの) の高度の範囲が D より離れている組を除く
+#    - 距離: |Δr| - |Δv| * step/2 - 加速度の分 > D の組を除く (前後 step/2 の間に D 以内に近づけない)
+#    - 軌道面: その時刻の位置・速度による接触軌道 (二体問題) で、2つの軌道面の交線付近の地心距離の範囲が D より離れている組を除く
+# 4. 残った組のみを細かい時刻の列 (--fine, デフォルト 1秒) で計算し、最も近づく時刻 (TCA) を相対運動の一次近似で求める。
+#
+# 衛星を指定した場合は、指定した衛星と他の全ての衛星の組を調べる。近地点・遠地点の範囲が指定した衛星のいずれとも重ならない衛星は計算しない。
+# 時刻の列を区間 (--segment) に分けて、-j で指定した数のプロセスで計算する。
+# 位置・速度は TEME 座標系 [km], [km/s]。
+
+import sys
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from functools import partial
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+from sgp4.api import SatrecArray
+from gpjson import imap_ordered
+import propagate
+
+# 地球の重力定数 [km^3/s^2] (WGS72)
+MU = 398600.8
+
+# 2つの衛星の加速度の差の上限 [km/s^2] (地表の重力加速度の2倍)
+MAX_ACCELERATION = 2 * MU / propagate.EARTH_RADIUS ** 2
+
+# 接近とみなす距離 [km]
+DISTANCE = 10.0
+
+# 粗い時刻の列の間隔 [秒]
+STEP = 10.0
+
+# 候補の組を計算する時刻の列の間隔 [秒]
+FINE = 1.0
+
+# PERIAPSIS, APOAPSIS (平均要素による高度) に加える余裕 [km]
+PAD = 50.0
+
+# 1つのプロセスで一度に計算する時間 [分]
+SEGMENT = 60.0
+
+# 格子の一辺の数の上限 (格子のキーが int64 に収まるように)
+MAX_CELLS = 100000
+
+# 隣接する格子の (x, y) の列 (自分を含む9個) と、組を1回ずつ数えるための半分。
+# 同じ列の z が -1, 0, 1 の格子はキーが連続するので、まとめて探す。半分の最後の列 (0, 0) は z が 1 の格子のみ
+COLUMNS_XY = [(x, y, -1, 1) for x in (-1, 0, 1) for y in (-1, 0, 1)]
+HALF_COLUMNS_XY = [(1, -1, -1, 1), (1, 0, -1, 1), (1, 1, -1, 1), (0, 1, -1, 1), (0, 0, 1, 1)]
+
+# 出力のカラム
+COLUMNS = ['NORAD_CAT_ID_1', 'NORAD_CAT_ID_2', 'TCA', 'MISS_DISTANCE', 'RELATIVE_SPEED']
+
+# 候補の組を数える段階
+STAGES = ['grid', 'apsis', 'distance', 'orbit']
+
+# src[i] を hi[i] - lo[i] 回ずつ繰り返したものと、lo[i] から hi[i] - 1 までの整数を並べたもの
+def _ranges(src, lo, hi):
+    n = hi - lo
+    first = np.repeat(lo - (np.cumsum(n) - n), n)
+    return np.repeat(src, n), first + np.arange(n.sum())
+
+# 同じ group (時刻) の点の組のうち、距離が cell 以下の組を全て含む候補 (i < j) を、一辺 cell の格子で求める。
+# query: 組の少なくとも一方が満たす点のマスク (None: 全ての組)
+def grid_pairs(points, group, cell, query = None):
+    lower = points.min(axis = 0)
+    cell = max(cell, (points.max(axis = 0) - lower).max() / MAX_CELLS)
+    # 隣接する格子のキーが他の軸や他の時刻と重ならないように、各軸の両端に1つずつ余裕をとる
+    c = np.floor((points - lower) / cell).astype('int64') + 1
+    dims = c.max(axis = 0) + 2
+    key = ((group.astype('int64') * dims[0] + c[:, 0]) * dims[1] + c[:, 1]) * dims[2] + c[:, 2]
+    order = np.argsort(key, kind = 'stable')
+    key = key[order]
+    # 点のある格子と、格子ごとの最初の点
+    new = np.r_[True, key[1:] != key[:-1]]
+    first = np.r_[np.flatnonzero(new), len(key)]
+    cells = key[first[:-1]]
+    cell_of = np.cumsum(new) - 1
+
+    pairs = []
+    if query is None:
+        # 同じ格子では、並べた順で後ろにある点との組
+        src = np.arange(len(key))
+        pairs.append(_ranges(src, src + 1, first[cell_of + 1]))
+        columns = HALF_COLUMNS_XY
+    else:
+        src = np.flatnonzero(query[order])
+        columns = COLUMNS_XY
+    # 隣接する格子は、点ごとではなく格子ごとに探す
+    src_cells, src_index = np.unique(cell_of[src], return_inverse = True)
+    for x, y, z0, z1 in columns:
+        target = cells[src_cells] + (x * dims[1] + y) * dims[2]
+        lo = first[np.searchsorted(cells, target + z0, 'left')]
+        hi = first[np.searchsorted(cells, target + z1, 'right')]
+        pairs.append(_ranges(src, lo[src_index], hi[src_index]))
+    i = order[np.concatenate([p[0] for p in pairs])]
+    j = order[np.concatenate([p[1] for p in pairs])]
+    if query is not None:
+        # 自分自身との組と、両方が query の点の組の重複を除く
+        keep = (i != j) & ~(query[i] & query[j] & (i > j))
+        i, j = i[keep], j[keep]
+    return np.minimum(i, j), np.maximum(i, j)
+
+# 衛星ごとの高度の範囲 (PERIAPSIS の最小値 - pad, APOAPSIS の最大値 + pad)。値がない衛星の範囲は無限
+def apsis_bands(elsets, pad = PAD):
+    bands = pd.DataFrame({'NORAD_CAT_ID': elsets['NORAD_CAT_ID'].to_numpy(dtype = 'int64'),
+        'LOW': elsets['PERIAPSIS'].astype('float64').fillna(-np.inf).to_numpy() - pad,
+        'HIGH': elsets['APOAPSIS'].astype('float64').fillna(np.inf).to_numpy() + pad}).groupby('NORAD_CAT_ID')
+    low = bands['LOW'].min()
+    return low.index.to_numpy(), low.to_numpy(), bands['HIGH'].max().to_numpy()
+
+# 高度の範囲が primary の衛星のいずれかの範囲と distance 以内にある衛星 (と primary の衛星) のマスク
+def apsis_prefilter(low, high, primary, distance):
+    order = np.argsort(low[primary])
+    plow = low[primary][order]
+    phigh = np.maximum.accumulate(high[primary][order])
+    # 下端が high + distance 以下の primary の衛星のうち、上端の最大のもの
+    n = np.searchsorted(plow, high + distance, 'right')
+    reach = np.where(n > 0, phigh[np.maximum(n - 1, 0)], -np.inf)
+    return primary | (reach >= low - distance)
+
+# 位置・速度による接触軌道の (単位法線ベクトル, 離心率ベクトル, 半直弦)
+def _orbit(r, v):
+    h = np.cross(r, v)
+    e = np.cross(v, h) / MU - r / np.linalg.norm(r, axis = -1)[:, None]
+    return h / np.linalg.norm(h, axis = -1)[:, None], e, (h * h).sum(axis = -1) / MU
+
+# 軌道上の方向 m から前後 delta の範囲の地心距離の (最小値, 最大値)
+def _radius_range(normal, e, p, m, delta):
+    ecc = np.linalg.norm(e, axis = -1)
+    # 方向 m の真近点離角を nu0 として、ecos = e cos(nu0), esin = e sin(nu0)
+    ecos = (m * e).sum(axis = -1)
+    esin = (m * np.cross(normal, e)).sum(axis = -1)
+    nu0 = np.abs(np.arctan2(esin, ecos))
+    ends = [ecos * np.cos(delta) - esin * np.sin(delta), ecos * np.cos(delta) + esin * np.sin(delta)]
+    # 範囲に近地点 (nu = 0), 遠地点 (nu = pi) が含まれればその値
+    ecos_max = np.where(nu0 <= delta, ecc, np.maximum(*ends))
+    ecos_min = np.where(nu0 >= np.pi - delta, -ecc, np.minimum(*ends))
+    return p / (1 + ecos_max), p / (1 + ecos_min)
+
+# 接触軌道 (二体問題) で2つの衛星が距離 distance 以内に近づける組のマスク。
+# 衛星 1 が軌道面 2 から distance 以内にあるのは、軌道面の交線の方向から角度 delta1 以内にある間のみ (衛星 2 も同様)。
+# delta1 + delta2 < 90度 ならば2つの衛星は交線の同じ側で近づくので、交線の両側それぞれで2つの衛星の地心距離の範囲が
+# distance より離れていれば近づけない。双曲線軌道、軌道面がほぼ同じ組は除かない
+def orbit_filter(r1, v1, r2, v2, distance):
+    n1, e1, p1 = _orbit(r1, v1)
+    n2, e2, p2 = _orbit(r2, v2)
+    ecc1 = np.linalg.norm(e1, axis = -1)
+    ecc2 = np.linalg.norm(e2, axis = -1)
+    line = np.cross(n1, n2)
+    s = np.linalg.norm(line, axis = -1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        m = line / s[:, None]
+        delta1 = np.arcsin(np.minimum(1, distance * (1 + ecc1) / (p1 * s)))
+        delta2 = np.arcsin(np.minimum(1, distance * (1 + ecc2) / (p2 * s)))
+        keep = ~(delta1 + delta2 < np.pi / 2) | ~(ecc1 < 1) | ~(ecc2 < 1)
+        for sign in (1, -1):
+            min1, max1 = _radius_range(n1, e1, p1, sign * m, delta1)
+            min2, max2 = _radius_range(n2, e2, p2, sign * m, delta2)
+            keep |= (min1 - max2 <= distance) & (min2 - max1 <= distance)
+    return keep
+
+# 候補の組 (elset の番号 a, b と粗い時刻のインデックス k) を、時刻 k の前後 step/2 を step/n_fine 間隔の時刻の列で計算し、
+# (最接近の時刻 [マイクロ秒], 最接近距離, 相対速度) を返す。satrecs: elset の satrec, t: 粗い時刻の列 [マイクロ秒]
+def refine(satrecs, a, b, k, t, step, n_fine):
+    fine_us = int(round(step * 1000000)) // n_fine
+    m = (n_fine + 1) // 2
+    offsets = (np.arange(2 * m + 1) - m) * fine_us
+    tca = np.zeros(len(k), dtype = 'int64')
+    dr = np.full((len(k), 3), np.nan)
+    dv = np.full((len(k), 3), np.nan)
+    # 同じ時刻の候補の elset をまとめて、その前後の時刻のみを計算する
+    order = np.argsort(k, kind = 'stable')
+    bounds = np.flatnonzero(np.r_[True, k[order][1:] != k[order][:-1], True]) if len(k) > 0 else []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        sel = order[i0:i1]
+        sats, index = np.unique(np.r_[a[sel], b[sel]], return_inverse = True)
+        ia, ib = index[:len(sel)], index[len(sel):]
+        fine = t[k[sel[0]]] + offsets
+        days = fine // propagate.DAY
+        e, r, v = SatrecArray([satrecs[x] for x in sats]).sgp4(propagate.JD_1970 + days.astype('float64'), (fine - days * propagate.DAY) / propagate.DAY)
+        r[e != 0] = np.nan
+        d = np.linalg.norm(r[ib] - r[ia], axis = -1)
+        d[np.isnan(d)] = np.inf
+        q = d.argmin(axis = 1)
+        tca[sel] = fine[q]
+        dr[sel] = r[ib, q] - r[ia, q]
+        dv[sel] = v[ib, q] - v[ia, q]
+    # 最も近い時刻の前後 1 間隔の範囲で、相対運動を等速直線運動として最接近の時刻を求める
+    dt = fine_us / 1000000
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        tau = np.clip(-(dr * dv).sum(axis = -1) / (dv * dv).sum(axis = -1), -dt, dt)
+    tau[np.isnan(tau)] = 0
+    return tca + np.round(tau * 1000000).astype('int64'), np.linalg.norm(dr + dv * tau[:, None], axis = -1), np.linalg.norm(dv, axis = -1)
+
+# 時刻の列の区間の接近を求める。segment: (時刻の列, その区間で使う elset)。
+# 返り値: refine() の返り値と、フィルタの段階ごとの候補の組の数
+def screen_segment(segment, step = STEP, distance = DISTANCE, n_fine = 10, pad = PAD, primaries = None, use_tle = True, block_size = propagate.BLOCK_SIZE):
+    times, elsets = segment
+    ids, low, high = apsis_bands(elsets, pad)
+    primary = np.isin(ids, primaries) if primaries is not None else None
+    # 前後 step/2 の間の、加速度の差による相対位置の変化の上限
+    reach = distance + MAX_ACCELERATION * (step / 2) ** 2 / 2
+    # 衛星 o の時刻 k に使う elset は、(o, k_start) の並びで (o, k) より前の最後のもの
+    _, rows, objects, k_start, _ = propagate.schedule(elsets, times)
+    satrecs = propagate.get_satrecs(elsets.iloc[rows], use_tle)
+    starts = objects * len(times) + k_start
+    counts = collections.Counter()
+    candidates = []
+    for b0, r, v in propagate.propagate_blocks(elsets, times, block_size, use_tle):
+        nb = r.shape[1]
+        r = r.transpose(1, 0, 2).reshape(-1, 3)
+        v = v.transpose(1, 0, 2).reshape(-1, 3)
+        group = np.repeat(np.arange(nb), len(ids))
+        obj = np.tile(np.arange(len(ids)), nb)
+        valid = np.flatnonzero(~np.isnan(r).any(axis = 1))
+        if len(valid) < 2:
+            continue
+        # 2つの衛星の相対速度は速さの最大値の2倍以下
+        cell = reach + np.linalg.norm(v[valid], axis = 1).max() * step
+        a, b = grid_pairs(r[valid], group[valid], cell, primary[obj[valid]] if primary is not None else None)
+        a, b = valid[a], valid[b]
+        counts['grid'] += len(a)
+
+        oa, ob = obj[a], obj[b]
+        keep = (low[oa] <= high[ob] + distance) & (low[ob] <= high[oa] + distance)
+        a, b = a[keep], b[keep]
+        counts['apsis'] += len(a)
+
+        keep = np.linalg.norm(r[b] - r[a], axis = 1) - np.linalg.norm(v[b] - v[a], axis = 1) * step / 2 <= reach
+        a, b = a[keep], b[keep]
+        counts['distance'] += len(a)
+
+        keep = orbit_filter(r[a], v[a], r[b], v[b], reach)
+        a, b = a[keep], b[keep]
+        counts['orbit'] += len(a)
+
+        candidates.append((obj[a], obj[b], b0 + group[a]))
+
+    oa, ob, k = (np.concatenate(x) for x in zip(*candidates)) if len(candidates) > 0 else (np.zeros(0, dtype = 'int64'),) * 3
+    ea = np.searchsorted(starts, oa * len(times) + k, 'right') - 1
+    eb = np.searchsorted(starts, ob * len(times) + k, 'right') - 1
+    tca, miss, speed = refine(satrecs, ea, eb, k, times.astype('datetime64[us]').astype('int64'), step, n_fine)
+    close = miss <= distance
+    return (ids[oa][close], ids[ob][close], tca[close], miss[close], speed[close]), counts
+
+# 時刻の列を segment_size 個ずつの区間に分け、各区間と、その区間で使う elset を返す
+def segments(elsets, times, segment_size):
+    for i in range(0, len(times), segment_size):
+        segment = times[i:i + segment_size]
+        rows = propagate.schedule(elsets, segment)[1]
+        yield segment, elsets.iloc[np.sort(rows)]
+
+# 区間の境界や隣り合う時刻で重複した同じ組の接近を、間隔が gap 秒以内のものをまとめて最も近いものにする
+def merge_events(conjunctions, gap):
+    df = pd.DataFrame(dict(zip(COLUMNS, conjunctions))).sort_values(['NORAD_CAT_ID_1', 'NORAD_CAT_ID_2', 'TCA'], ignore_index = True)
+    new = (df['NORAD_CAT_ID_1'].diff() != 0) | (df['NORAD_CAT_ID_2'].diff() != 0) | (df['TCA'].diff() > gap * 1000000)
+    df = df.loc[df.groupby(new.cumsum())['MISS_DISTANCE'].idxmin()]
+    df['TCA'] = df['TCA'].astype('datetime64[us]')
+    return df.sort_values(['TCA', 'NORAD_CAT_ID_1', 'NORAD_CAT_ID_2'], ignore_index = True)
+
+def main():
+    logger = setup_logger('screening')
+    metrics = get_metrics('screening')
+
+    parser = argparse.ArgumentParser(description='Screen close approaches of many objects propagated with SGP4.')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 Database file created by json2sqlite3.py')
+    parser.add_argument('START', type=str, help='Start time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC)')
+    parser.add_argument('END', type=str, help='End time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC)')
+    parser.add_argument('NORAD_CAT_ID', type=int, nargs='*', help='NORAD Catalog Numbers screened against all objects. Default: all pairs of objects')
+    parser.add_argument('-t', '--table', type=str, default='elset', help='Table name. Default: elset')
+    parser.add_argument('-d', '--distance', type=float, default=DISTANCE, help='Screening distance in km. Default: {}'.format(DISTANCE))
+    parser.add_argument('-s', '--step', type=float, default=STEP, help='Step of the time grid in seconds. Default: {}'.format(STEP))
+    parser.add_argument('--fine', type=float, default=FINE, help='Step of the time grid of the candidate pairs in seconds. Default: {}'.format(FINE))
+    parser.add_argument('--pad', type=float, default=PAD, help='Margin in km added to PERIAPSIS and APOAPSIS of the elsets. Default: {}'.format(PAD))
+    parser.add_argument('-o', '--output', type=str, default='screening.csv', help='Output CSV file. Default: screening.csv')
+    parser.add_argument('--omm', action='store_true', help='Use OMM fields instead of TLE lines even if the table has them')
+    parser.add_argument('--lookback', type=float, default=propagate.LOOKBACK, help='Days to look back for the elset at START. Default: {}'.format(propagate.LOOKBACK))
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes. Default: 1')
+    parser.add_argument('--segment', type=float, default=SEGMENT, help='Minutes screened at once by a process. Default: {}'.format(SEGMENT))
+    parser.add_argument('-b', '--block_size', type=int, default=propagate.BLOCK_SIZE, help='Number of times propagated at once. Default: {}'.format(propagate.BLOCK_SIZE))
+
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.START)
+    end = datetime.fromisoformat(args.END)
+    times = propagate.time_grid(start, end, args.step)
+    # 粗い時刻の間隔は細かい時刻の間隔の整数倍にする
+    step_us = int(args.step * 1000000)
+    n_fine = max(1, int(round(args.step / args.fine)))
+    while step_us % n_fine != 0:
+        n_fine -= 1
+    use_tle = not args.omm
+    primaries = args.NORAD_CAT_ID if len(args.NORAD_CAT_ID) > 0 else None
+
+    starttime = datetime.now()
+    elsets = propagate.load_elsets(args.DATABASE, args.table, start, end, None, args.lookback, use_tle, ['PERIAPSIS', 'APOAPSIS'])
+    if len(elsets) == 0:
+        logger.error('No elsets')
+        sys.exit(1)
+    # 時刻の列で使われない elset を除く
+    elsets = elsets.iloc[np.sort(propagate.schedule(elsets, times)[1])]
+    nobjects = elsets['NORAD_CAT_ID'].nunique()
+    if primaries is not None:
+        ids, low, high = apsis_bands(elsets, args.pad)
+        primary = np.isin(ids, primaries)
+        if not primary.any():
+            logger.error('No elsets of {}'.format(' '.join(str(x) for x in primaries)))
+            sys.exit(1)
+        elsets = elsets[elsets['NORAD_CAT_ID'].isin(ids[apsis_prefilter(low, high, primary, args.distance)])]
+    logger.info('{} elsets of {} objects ({} objects after the apogee/perigee filter), {} times'.format(
+        len(elsets), nobjects, elsets['NORAD_CAT_ID'].nunique(), len(times)))
+    metrics.set('objects', elsets['NORAD_CAT_ID'].nunique())
+
+    screen = partial(screen_segment, step = args.step, distance = args.distance, n_fine = n_fine, pad = args.pad, primaries = primaries,
+        use_tle = use_tle, block_size = args.block_size)
+    results = []
+    counts = collections.Counter()
+    with metrics.timer('screen'):
+        for conjunctions, n in imap_ordered(screen, segments(elsets, times, max(1, int(args.segment * 60 / args.step))), args.jobs):
+            results.append(conjunctions)
+            counts.update(n)
+    for stage in STAGES:
+        metrics.inc('candidates', counts[stage], stage = stage)
+    logger.info('Candidate pairs: ' + ', '.join('{} {}'.format(counts[stage], stage) for stage in STAGES))
+
+    df = merge_events([np.concatenate(x) for x in zip(*results)], 2 * args.step)
+    # 最初と最後の時刻の前後 step/2 の接近は含めない
+    df = df[(df['TCA'] >= times[0]) & (df['TCA'] <= times[-1])]
+    df.to_csv(args.output, index = False)
+    metrics.inc('conjunctions', len(df))
+    elapsed = (datetime.now() - starttime).total_seconds()
+    logger.info('{} conjunctions within {} km in {:.1f} sec: {}'.format(len(df), args.distance, elapsed, args.output))
+
+    sys.exit(0)
+
+if __name__ == '__main__':
+    run('screening', main)
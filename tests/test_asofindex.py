@@ -0,0 +1,50 @@
+import sqlite3
+from datetime import datetime
+import pytest
+import asofindex
+
+# (NORAD_CAT_ID, EPOCH, GP_ID)
+ELSETS = [(1, '2020-01-01 00:00:00', 10), (1, '2020-01-02 00:00:00', 11), (1, '2020-01-02 00:00:00', 12), (2, '2020-01-01 12:00:00', 20)]
+
+def create_database(filename, elsets):
+    con = sqlite3.connect(filename)
+    con.execute('CREATE TABLE elset (NORAD_CAT_ID integer, EPOCH timestamp, GP_ID integer primary key)')
+    con.executemany('INSERT INTO elset VALUES (?, ?, ?)', elsets)
+    con.commit()
+    return con
+
+def intervals(con):
+    return con.execute('SELECT * FROM elset_asof ORDER BY NORAD_CAT_ID, VALID_FROM').fetchall()
+
+def test_rebuild(tmp_path):
+    con = create_database(str(tmp_path / 'elset.sqlite3'), ELSETS)
+    asofindex.rebuild(con.cursor(), 'elset')
+    assert not con.in_transaction
+    assert intervals(con) == [(1, '2020-01-01 00:00:00', '2020-01-02 00:00:00', 10), (1, '2020-01-02 00:00:00', None, 12),
+        (2, '2020-01-01 12:00:00', None, 20)]
+    assert [row[3] for row in asofindex.snapshot(con, 'elset', datetime(2020, 1, 1, 18))] == [10, 20]
+
+def test_rebuild_is_atomic(tmp_path):
+    filename = str(tmp_path / 'elset.sqlite3')
+    con = create_database(filename, ELSETS[:2])
+    asofindex.rebuild(con.cursor(), 'elset')
+    old = intervals(con)
+    con.executemany('INSERT INTO elset VALUES (?, ?, ?)', ELSETS[2:])
+    con.commit()
+
+    # Fail at the last statement of the rebuild. The old index is kept
+    def authorizer(action, arg1, arg2, database, trigger):
+        return sqlite3.SQLITE_DENY if action == sqlite3.SQLITE_UPDATE and arg1 == 'elset_asof' else sqlite3.SQLITE_OK
+    con.set_authorizer(authorizer)
+    with pytest.raises(sqlite3.DatabaseError):
+        asofindex.rebuild(con.cursor(), 'elset')
+    con.set_authorizer(None)
+    assert intervals(sqlite3.connect(filename)) == old
+
+    # Until it is committed, other connections see the old index
+    con.execute('BEGIN')
+    asofindex.rebuild(con.cursor(), 'elset')
+    assert con.in_transaction
+    assert intervals(sqlite3.connect(filename)) == old
+    con.commit()
+    assert len(intervals(sqlite3.connect(filename))) == 3
@@ -0,0 +1,48 @@
+import io
+import json
+from downloadpipeline import BufferWriter, TeeWriter, DownloadPipeline
+from compressedfile import CompressedWriter
+from gpjson import parse_records, open_compressed
+import satcat2sqlite3
+from test_satcat2sqlite3 import RECORDS
+
+# spacetrack (iter_content=True) yields the response as str chunks, split anywhere
+def str_chunks(records, size = 100):
+    text = json.dumps(records, ensure_ascii = False)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+GP_RECORDS = [{'GP_ID': str(i), 'NORAD_CAT_ID': str(i), 'OBJECT_NAME': 'ÉTOILE {}'.format(i), 'EPOCH': '2020-01-01T00:00:00'} for i in range(50)]
+
+def test_buffer_of_str_chunks():
+    buffer = BufferWriter()
+    for chunk in str_chunks(GP_RECORDS):
+        buffer.write(chunk)
+    data = b''.join(buffer.chunks)
+    # As update.py parses the response
+    assert parse_records(data) == GP_RECORDS
+    assert buffer.raw_bytes == len(json.dumps(GP_RECORDS, ensure_ascii = False).encode('utf-8'))
+
+def test_buffer_of_satcat_str_chunks():
+    buffer = BufferWriter()
+    for chunk in str_chunks(RECORDS):
+        buffer.write(chunk)
+    rows = satcat2sqlite3.read_satcat(io.BytesIO(b''.join(buffer.chunks)))
+    assert [row[0] for row in rows] == [25544, 1, 99999]
+
+def test_tee_and_pipeline_of_str_chunks(tmp_path):
+    buffer = BufferWriter()
+    archive = CompressedWriter(str(tmp_path / 'archive.json.xz'), codec = 'xz', level = 1)
+    writer = TeeWriter(buffer, archive)
+    for chunk in str_chunks(GP_RECORDS):
+        writer.write(chunk)
+    archive.commit()
+    assert buffer.raw_bytes == archive.raw_bytes
+
+    saved = []
+    pipeline = DownloadPipeline('xz', 1, jobs = 1)
+    pipeline.submit(str(tmp_path / 'saved.json.xz'), buffer, lambda writer, error: saved.append((writer, error)))
+    pipeline.close()
+    assert saved[0][1] is None
+    for filename in ('archive.json.xz', 'saved.json.xz'):
+        with open_compressed(str(tmp_path / filename)) as fp:
+            assert json.load(fp) == GP_RECORDS
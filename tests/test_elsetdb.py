@@ -0,0 +1,31 @@
+import sqlite3
+import pytest
+import asofindex
+from elsetdb import ElsetDB
+
+# (NORAD_CAT_ID, EPOCH, GP_ID)
+ELSETS = [(1, '2020-01-01 00:00:00', 10), (1, '2020-01-02 00:00:00', 11), (2, '2020-01-01 12:00:00', 20)]
+
+@pytest.mark.parametrize('asof', [False, True])
+def test_query_by_id_does_not_lock(tmp_path, asof):
+    filename = str(tmp_path / 'elset.sqlite3')
+    con = sqlite3.connect(filename)
+    con.execute('CREATE TABLE elset (NORAD_CAT_ID integer, EPOCH timestamp, GP_ID integer primary key)')
+    con.executemany('INSERT INTO elset VALUES (?, ?, ?)', ELSETS)
+    con.commit()
+    if asof:
+        asofindex.rebuild(con.cursor(), 'elset')
+    con.close()
+
+    db = ElsetDB(filename)
+    assert list(db.get_elsets([1])['GP_ID']) == [10, 11]
+    assert list(db.latest_as_of('2020-01-01 18:00:00', [1, 2])['GP_ID']) == [10, 20]
+    assert not db.source.con.in_transaction
+
+    # Another connection can write while the ElsetDB is open
+    writer = sqlite3.connect(filename, timeout = 0)
+    writer.execute('INSERT INTO elset VALUES (?, ?, ?)', (2, '2020-01-03 00:00:00', 21))
+    writer.commit()
+    writer.close()
+    db.close()
+    assert sqlite3.connect(filename).execute('SELECT COUNT(*) FROM elset').fetchone()[0] == 4
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import json2parquet
+
+def make_table(rng, n, first_gp_id):
+    epoch = np.datetime64('2015-01-01', 'ns') + rng.integers(0, 365 * 5 * 86400, n).astype('timedelta64[s]')
+    columns = {'NORAD_CAT_ID': rng.integers(1, 50, n).astype('uint32'), 'EPOCH': epoch, 'GP_ID': np.arange(first_gp_id, first_gp_id + n, dtype = 'uint32')}
+    return pa.Table.from_arrays([pa.array(columns[field.name], type = field.type) if field.name in columns else pa.nulls(n, field.type)
+        for field in json2parquet.schema], schema = json2parquet.schema)
+
+def test_partitioned_writer(tmp_path):
+    rng = np.random.default_rng(0)
+    directory = str(tmp_path / 'out')
+    writer = json2parquet.PartitionedWriter(directory, 'zstd', row_group_size = 50, max_buffered_rows = 200)
+    nrows = 0
+    for i in range(20):
+        # Each table touches most of the 60 months, as files by NORAD_CAT_ID do
+        table = make_table(rng, 300, nrows)
+        nrows += table.num_rows
+        writer.write(table)
+        assert writer.nbuffered <= 200
+        assert writer.nbuffered == sum(writer.nrows.values()) == sum(x.num_rows for buffers in writer.buffers.values() for x in buffers)
+    writer.close()
+
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        assert not any(filename.startswith('.') for filename in filenames)
+        for filename in filenames:
+            table = pq.ParquetFile(os.path.join(dirpath, filename)).read()
+            assert table.schema.equals(json2parquet.schema)
+            keys = list(zip(table.column('NORAD_CAT_ID').to_pylist(), table.column('EPOCH').to_pylist()))
+            # Sorted across the whole file, not only within each chunk
+            assert keys == sorted(keys)
+            assert pq.ParquetFile(os.path.join(dirpath, filename)).metadata.row_group(0).num_rows <= 50
+            month = table.column('EPOCH').to_numpy().astype('datetime64[M]')
+            assert (month == month[0]).all()
+            total += table.num_rows
+    assert total == nrows
@@ -0,0 +1,17 @@
+import os
+from metrics import Metrics, PREFIX
+
+def test_textfile_groups_families(tmp_path):
+    metrics = Metrics('test', filename = None, textfile_dir = str(tmp_path))
+    metrics.inc('cache', result = 'miss')
+    metrics.inc('requests')
+    metrics.inc('cache', result = 'hit')
+    metrics.write(0)
+    with open(os.path.join(str(tmp_path), PREFIX + 'test.prom')) as fp:
+        lines = fp.read().splitlines()
+    names = [line.split()[2] if line.startswith('# TYPE') else line.split('{')[0].split()[0] for line in lines]
+    # Each family is one contiguous run of lines, starting with its TYPE line
+    families = [name for i, name in enumerate(names) if i == 0 or name != names[i - 1]]
+    assert len(families) == len(set(families)) == sum(line.startswith('# TYPE') for line in lines)
+    assert [line for line in lines if line.startswith(PREFIX + 'cache')] == [
+        PREFIX + 'cache{script="test",result="miss"} 1.0', PREFIX + 'cache{script="test",result="hit"} 1.0']
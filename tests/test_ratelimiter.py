@@ -0,0 +1,54 @@
+from ratelimiter import RateLimiter, RATE_LIMITS, MARGIN
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+def limiters(tmp_path, clock):
+    filename = str(tmp_path / 'ratelimit.sqlite3')
+    return [RateLimiter(filename, clock = clock, sleep = clock.sleep) for i in range(2)]
+
+def test_minute_limit_shared(tmp_path):
+    clock = FakeClock()
+    a, b = limiters(tmp_path, clock)
+    for i in range(30):
+        assert (a, b)[i % 2].reserve() == 0
+    # The budget is shared: neither instance gets the 31st slot until the first request leaves the window
+    assert a.reserve() == 60 + MARGIN
+    assert b.reserve() == 60 + MARGIN
+    clock.now = 60.0
+    assert b.reserve() == MARGIN
+    # All the 30 requests leave the window at once
+    clock.now = 60 + MARGIN
+    for i in range(30):
+        assert (a, b)[i % 2].reserve() == 0
+    assert a.reserve() == 60 + MARGIN
+
+def test_hour_limit_shared(tmp_path):
+    clock = FakeClock()
+    a, b = limiters(tmp_path, clock)
+    granted = []
+    for i in range(301):
+        (a, b)[i % 2].acquire()
+        granted.append(clock.now)
+    # 10 bursts of 30 requests, one minute (plus the margin) apart, then the 301st waits for the hour window
+    assert granted[299] == 9 * (60 + MARGIN)
+    assert granted[300] == 3600 + MARGIN
+    for count, window in RATE_LIMITS:
+        for i in range(len(granted) - count):
+            assert granted[i + count] - granted[i] >= window + MARGIN
+
+def test_acquire_returns_slept(tmp_path):
+    clock = FakeClock()
+    a, b = limiters(tmp_path, clock)
+    for i in range(30):
+        assert a.acquire() == 0
+    assert b.acquire() == 60 + MARGIN
+    assert clock.now == 60 + MARGIN
@@ -0,0 +1,115 @@
+import os
+import errno
+import pytest
+import responsecache
+from responsecache import ResponseCache, normalize_query, DEFAULT_TTL
+
+RESPONSE = b'[{"NORAD_CAT_ID":"5","OBJECT_NAME":"VANGUARD 1"}]'
+QUERY = normalize_query('satcat', {'norad_cat_id': 5})
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1600000000.0
+
+    def __call__(self):
+        return self.now
+
+class BytesWriter:
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def reset(self):
+        self.data = b''
+
+class FullDiskWriter(BytesWriter):
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+def cached(tmp_path, clock, offline = False):
+    cache = ResponseCache(str(tmp_path / 'cache'), offline = offline, clock = clock)
+    entry = cache.writer(QUERY)
+    entry.write(RESPONSE)
+    entry.commit()
+    return cache
+
+def response_file(cache):
+    (filename,) = cache.con.execute('SELECT filename FROM response').fetchone()
+    return os.path.join(cache.directory, filename)
+
+def test_hit(tmp_path, clock):
+    cache = cached(tmp_path, clock)
+    writer = BytesWriter()
+    assert cache.serve(QUERY, writer)
+    assert writer.data == RESPONSE
+    # The same query in another order and case
+    assert cache.lookup(normalize_query('SATCAT', {'NORAD_CAT_ID': ' 5'})) is not None
+
+def test_expiry(tmp_path, clock):
+    cache = cached(tmp_path, clock)
+    path = response_file(cache)
+    clock.now += DEFAULT_TTL - 1
+    assert cache.lookup(QUERY) is not None
+    clock.now += 1
+    assert cache.lookup(QUERY) is None
+    assert not cache.serve(QUERY, BytesWriter())
+    assert cache.purge() == 1
+    assert not os.path.exists(path)
+
+def test_old_epoch_range_never_expires(tmp_path, clock):
+    query = normalize_query('gp_history', {'epoch': '2000-01-01--2000-02-01'})
+    assert responsecache.expires_at(query, clock()) is None
+    assert responsecache.expires_at(normalize_query('gp_history', {'epoch': '>now-30'}), clock()) == clock() + responsecache.RECENT_TTL
+
+def test_offline_serves_expired(tmp_path, clock):
+    cached(tmp_path, clock).close()
+    clock.now += DEFAULT_TTL
+    cache = ResponseCache(str(tmp_path / 'cache'), offline = True, clock = clock)
+    writer = BytesWriter()
+    assert cache.serve(QUERY, writer)
+    assert writer.data == RESPONSE
+    assert not cache.serve(normalize_query('satcat', {'norad_cat_id': 6}), BytesWriter())
+
+@pytest.mark.parametrize('damage', ['truncate', 'remove'])
+def test_broken_file(tmp_path, clock, damage):
+    cache = cached(tmp_path, clock)
+    path = response_file(cache)
+    if damage == 'truncate':
+        with open(path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(path) // 2)
+    else:
+        os.remove(path)
+    writer = BytesWriter()
+    assert not cache.serve(QUERY, writer)
+    assert writer.data == b''
+    # Deleted, to be downloaded again
+    assert cache.lookup(QUERY) is None
+    assert not os.path.exists(path)
+
+def test_checksum_mismatch(tmp_path, clock):
+    cache = cached(tmp_path, clock)
+    with cache.con:
+        cache.con.execute("UPDATE response SET sha256 = '0'")
+    assert not cache.serve(QUERY, BytesWriter())
+    assert cache.lookup(QUERY) is None
+
+def test_writer_failure_keeps_response(tmp_path, clock):
+    cache = cached(tmp_path, clock)
+    path = response_file(cache)
+    with pytest.raises(OSError) as e:
+        cache.serve(QUERY, FullDiskWriter())
+    assert e.value.errno == errno.ENOSPC
+    assert cache.lookup(QUERY) is not None
+    assert os.path.exists(path)
+    writer = BytesWriter()
+    assert cache.serve(QUERY, writer)
+    assert writer.data == RESPONSE
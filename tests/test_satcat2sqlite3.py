@@ -0,0 +1,55 @@
+import io
+import json
+import logging
+import sqlite3
+from metrics import Metrics
+import satcat2sqlite3
+
+# SATCAT records as returned by Space-Track (all values are strings). Some objects have no APOGEE/PERIGEE or RCSVALUE
+RECORDS = [
+    {'INTLDES': '1998-067A', 'NORAD_CAT_ID': '25544', 'OBJECT_TYPE': 'PAYLOAD', 'SATNAME': 'ISS (ZARYA)', 'COUNTRY': 'ISS',
+        'LAUNCH': '1998-11-20', 'SITE': 'TTMTR', 'DECAY': None, 'PERIOD': '92.90', 'INCLINATION': '51.64',
+        'APOGEE': '422', 'PERIGEE': '418', 'COMMENT': None, 'COMMENTCODE': None, 'RCSVALUE': '0', 'RCS_SIZE': 'LARGE',
+        'FILE': '7000', 'LAUNCH_YEAR': '1998', 'LAUNCH_NUM': '67', 'LAUNCH_PIECE': 'A', 'CURRENT': 'Y',
+        'OBJECT_NAME': 'ISS (ZARYA)', 'OBJECT_ID': '1998-067A', 'OBJECT_NUMBER': '25544'},
+    {'INTLDES': '1957-001A', 'NORAD_CAT_ID': '1', 'OBJECT_TYPE': 'ROCKET BODY', 'SATNAME': 'SL-1 R/B', 'COUNTRY': 'CIS',
+        'LAUNCH': '1957-10-04', 'SITE': 'TYMSC', 'DECAY': '1957-12-01', 'PERIOD': '96.19', 'INCLINATION': '65.10',
+        'APOGEE': '938', 'PERIGEE': '214', 'COMMENT': None, 'COMMENTCODE': None, 'RCSVALUE': '0', 'RCS_SIZE': 'LARGE',
+        'FILE': '1', 'LAUNCH_YEAR': '1957', 'LAUNCH_NUM': '1', 'LAUNCH_PIECE': 'A', 'CURRENT': 'Y',
+        'OBJECT_NAME': 'SL-1 R/B', 'OBJECT_ID': '1957-001A', 'OBJECT_NUMBER': '1'},
+    {'INTLDES': '2023-999A', 'NORAD_CAT_ID': '99999', 'OBJECT_TYPE': 'UNKNOWN', 'SATNAME': 'TBA', 'COUNTRY': 'TBD',
+        'LAUNCH': None, 'SITE': None, 'DECAY': None, 'PERIOD': None, 'INCLINATION': None,
+        'APOGEE': None, 'PERIGEE': None, 'COMMENT': None, 'COMMENTCODE': None, 'RCSVALUE': None, 'RCS_SIZE': None,
+        'FILE': '8000', 'LAUNCH_YEAR': '2023', 'LAUNCH_NUM': '999', 'LAUNCH_PIECE': 'A', 'CURRENT': 'Y',
+        'OBJECT_NAME': 'TBA', 'OBJECT_ID': '2023-999A', 'OBJECT_NUMBER': '99999'},
+]
+
+def update(records, dbfile):
+    metrics = Metrics('satcat2sqlite3')
+    rows = satcat2sqlite3.read_satcat(io.StringIO(json.dumps(records)))
+    satcat2sqlite3.store_satcat(rows, dbfile, 'satcat', True, logging.getLogger('test'), metrics)
+    return metrics
+
+def history(dbfile):
+    with sqlite3.connect(dbfile) as con:
+        return con.execute('SELECT NORAD_CAT_ID, ACTION, COLUMN_NAME, OLD_VALUE, NEW_VALUE FROM satcat_history').fetchall()
+
+def test_update_is_idempotent(tmp_path):
+    dbfile = str(tmp_path / 'satcat.sqlite3')
+    metrics = update(RECORDS, dbfile)
+    assert metrics.get('records_inserted') == 3
+    assert len(history(dbfile)) == 3
+
+    metrics = update(RECORDS, dbfile)
+    assert metrics.get('records_inserted') == 0
+    assert metrics.get('records_updated') == 0
+    assert len(history(dbfile)) == 3
+
+def test_update_records_changes(tmp_path):
+    dbfile = str(tmp_path / 'satcat.sqlite3')
+    update(RECORDS, dbfile)
+    records = [dict(record) for record in RECORDS]
+    records[1]['APOGEE'] = '940'
+    metrics = update(records, dbfile)
+    assert metrics.get('records_updated') == 1
+    assert history(dbfile)[3:] == [(1, 'update', 'APOGEE', 938, 940)]
@@ -0,0 +1,36 @@
+import tleformat
+
+# Records of the gp class published by Space-Track (spacetracktest1-gp.ipynb):
+# ELSET_COLUMNS + EXTRA_COLUMNS, TLE_LINE1, TLE_LINE2
+RECORDS = [
+    ([5, '1958-002B', '2020-11-03T06:43:34.554720', -0.000027303, 34.2561, 160.5895, 0.1847138, 257.1165, 81.7729,
+        10.84868808, 22042, 'U', 0, 999, -0.00000002, 0.0],
+        '1     5U 58002B   20308.28026105 -.00000002  00000-0 -27303-4 0  9990',
+        '2     5  34.2561 160.5895 1847138 257.1165  81.7729 10.84868808220426'),
+    ([11, '1959-001A', '2020-11-03T07:20:12.942240', 0.0001111, 32.8740, 254.0817, 0.1466665, 315.3162, 33.7976,
+        11.85684888, 63320, 'U', 0, 999, 0.00000229, 0.0],
+        '1    11U 59001A   20308.30570535  .00000229  00000-0  11110-3 0  9998',
+        '2    11  32.8740 254.0817 1466665 315.3162  33.7976 11.85684888633206'),
+    # An older elset with '+' signs and zero-padded angles
+    ([12, '1959-001B', '2020-11-02T19:43:57.048384', 0.00022198, 32.8976, 226.8616, 0.1666373, 83.4083, 295.2617,
+        11.44346712, 29583, 'U', 0, 999, 0.00000365, 0.0],
+        '1    12U 59001B   20307.82218806 +.00000365 +00000-0 +22198-3 0  9994',
+        '2    12 032.8976 226.8616 1666373 083.4083 295.2617 11.44346712295831'),
+]
+
+def test_format_tle():
+    for fields, line1, line2 in RECORDS[:2]:
+        assert tleformat.format_tle(*fields) == (line1, line2)
+        assert tleformat.is_exact(fields, line1, line2)
+
+def test_not_exact():
+    # Stored verbatim by tlestore.py
+    fields, line1, line2 = RECORDS[2]
+    assert not tleformat.is_exact(fields, line1, line2)
+    assert tleformat.parse_extra(line1) == fields[-5:]
+
+def test_catalog_number():
+    assert tleformat.catalog_number(5) == '    5'
+    assert tleformat.catalog_number(25544) == '25544'
+    assert tleformat.catalog_number(100000) == 'A0000'
+    assert tleformat.catalog_number(339999) == 'Z9999'
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Format TLE lines from the OMM fields of an elset (as stored by json2sqlite3.py).
+# The lines are built with integer arithmetic where the TLE has fixed decimals (EPOCH, ECCENTRICITY),
+# so that they are the same as the lines published by Space-Track whenever the fields came from a TLE.
+# Use is_exact() to check a record before relying on the formatted lines.
+
+import math
+from datetime import datetime
+import elsetschema
+
+# Columns of the elset table used by format_tle()
+ELSET_COLUMNS = ['NORAD_CAT_ID', 'OBJECT_ID', 'EPOCH', 'BSTAR', 'INCLINATION', 'RA_OF_ASC_NODE', 'ECCENTRICITY',
+    'ARG_OF_PERICENTER', 'MEAN_ANOMALY', 'MEAN_MOTION', 'REV_AT_EPOCH']
+
+# OMM fields of line 1 which are not in the elset table
+EXTRA_COLUMNS = ['CLASSIFICATION_TYPE', 'EPHEMERIS_TYPE', 'ELEMENT_SET_NO', 'MEAN_MOTION_DOT', 'MEAN_MOTION_DDOT']
+
+# Letters of the Alpha-5 catalog numbers (100000-339999), without I and O
+ALPHA5 = 'ABCDEFGHJKLMNPQRSTUVWXYZ'
+
+# 1e-8 day of the TLE epoch in microseconds
+EPOCH_UNIT = 864
+
+def tle_checksum(line):
+    return sum(int(c) if c.isdigit() else (1 if c == '-' else 0) for c in line) % 10
+
+# ' 12345-4' (0.12345e-4) of the TLE
+def tle_exponent(x):
+    if x == 0:
+        return ' 00000-0'
+    e = int(math.floor(math.log10(abs(x)))) + 1
+    m = int(round(abs(x) / 10.0 ** e * 100000))
+    if m >= 100000:
+        m //= 10
+        e += 1
+    return ('-' if x < 0 else ' ') + '{:05d}{}{}'.format(m, '-' if e < 0 else '+', abs(e))
+
+# Inverse of tle_exponent()
+def parse_exponent(text):
+    text = text.strip()
+    if text == '':
+        return 0.0
+    sign = -1 if text[0] == '-' else 1
+    text = text.lstrip('+-')
+    return sign * float('0.' + text[:-2]) * 10.0 ** int(text[-2:])
+
+# Space-Track pads the numbers below 100000 with spaces ('    5')
+def catalog_number(norad_cat_id):
+    if norad_cat_id < 100000:
+        return '{:5d}'.format(norad_cat_id)
+    return ALPHA5[norad_cat_id // 10000 - 10] + '{:04d}'.format(norad_cat_id % 10000)
+
+# '1998-067A' -> '98067A  ' (blank if unknown)
+def designator(object_id):
+    if not isinstance(object_id, str) or len(object_id) < 6 or object_id[4] != '-':
+        return ' ' * 8
+    return '{:<8}'.format(object_id[2:4] + object_id[5:])
+
+# EPOCH (text, datetime or microseconds since 1970) -> 'YYDDD.DDDDDDDD'
+def epoch_field(epoch):
+    us = elsetschema.to_microseconds(epoch) if isinstance(epoch, (str, datetime)) else int(epoch)
+    year = elsetschema.from_microseconds(us).year
+    n = (2 * (us - elsetschema.to_microseconds('{:04d}-01-01'.format(year))) + EPOCH_UNIT) // (2 * EPOCH_UNIT)
+    return '{:02d}{:03d}.{:08d}'.format(year % 100, n // 100000000 + 1, n % 100000000)
+
+# ' .00001264' (first derivative of the mean motion)
+def ndot_field(x):
+    return ('-' if x < 0 else ' ') + '{:.8f}'.format(abs(x))[1:]
+
+def angle_field(x):
+    return '{:8.4f}'.format(x)
+
+# TLE_LINE1 and TLE_LINE2 from the OMM fields
+def format_tle(norad_cat_id, object_id, epoch, bstar, inclination, ra_of_asc_node, eccentricity, arg_of_pericenter,
+        mean_anomaly, mean_motion, rev_at_epoch, classification_type, ephemeris_type, element_set_no, mean_motion_dot, mean_motion_ddot):
+    number = catalog_number(norad_cat_id)
+    line1 = '1 {}{} {} {} {} {} {} {} {:4d}'.format(number, classification_type, designator(object_id), epoch_field(epoch),
+        ndot_field(mean_motion_dot), tle_exponent(mean_motion_ddot), tle_exponent(bstar), ephemeris_type, element_set_no % 10000)
+    line2 = '2 {} {} {} {:07d} {} {} {:11.8f}{:5d}'.format(number, angle_field(inclination), angle_field(ra_of_asc_node),
+        int(round(eccentricity * 10000000)), angle_field(arg_of_pericenter), angle_field(mean_anomaly), mean_motion, rev_at_epoch % 100000)
+    return line1 + str(tle_checksum(line1)), line2 + str(tle_checksum(line2))
+
+# The EXTRA_COLUMNS read from TLE_LINE1 (for tables which have the lines but not the OMM fields)
+def parse_extra(line1):
+    return [line1[7], int(line1[62]) if line1[62].isdigit() else 0, int(line1[64:68]) if line1[64:68].strip() != '' else 0,
+        float(line1[33:43].replace(' ', '') or '0'), parse_exponent(line1[44:52])]
+
+# True if format_tle() of the fields (ELSET_COLUMNS + EXTRA_COLUMNS) is the same as the published lines
+def is_exact(fields, line1, line2):
+    try:
+        return format_tle(*fields) == (line1, line2)
+    except (TypeError, ValueError, IndexError):
+        # Missing fields (NULL)
+        return False
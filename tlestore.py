@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# TLE lines of an elset table, stored in the side table <table>_tle instead of the TLE columns of json2sqlite3.py -t.
+#
+# The records are stored in blocks of BLOCK_SIZE records sorted by GP_ID, compressed with zlib.
+# For a record whose lines tleformat.format_tle() rebuilds byte for byte from the elset table,
+# only TLE_LINE0 and the OMM fields of line 1 which are not in the table are stored; the lines of the other records are stored as they are.
+# The lines are read with TLEReader and joined to the elsets on demand, so the queries that don't need them read only the elset table.
+#
+# Usage: tlestore.py DATABASE                          (statistics of the store)
+#        tlestore.py -i db/elset_with_tle.sqlite3 DATABASE  (store the lines of a database of json2sqlite3.py -t)
+#        tlestore.py -v db/elset_with_tle.sqlite3 DATABASE  (compare the stored lines with the database)
+
+import os
+import sys
+import zlib
+import bisect
+import argparse
+import sqlite3
+import collections
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+import json2sqlite3
+import tleformat
+
+# Number of records of a block
+BLOCK_SIZE = 1000
+
+# zlib compression level
+LEVEL = 9
+
+# Number of decompressed blocks kept by TLEReader
+CACHE_BLOCKS = 64
+
+TLE_COLUMNS = ['TLE_LINE0', 'TLE_LINE1', 'TLE_LINE2']
+
+# Columns of the rows passed to TLEWriter.write()
+COLUMNS = ['GP_ID'] + tleformat.ELSET_COLUMNS + tleformat.EXTRA_COLUMNS + TLE_COLUMNS
+
+# Columns of the elset table read to rebuild the lines
+READ_COLUMNS = ['GP_ID'] + tleformat.ELSET_COLUMNS
+
+create_table = '''CREATE TABLE IF NOT EXISTS {0}_tle (
+    BLOCK_ID integer primary key, FIRST_GP_ID integer, LAST_GP_ID integer, RECORDS integer, EXACT integer, DATA blob)'''
+create_index = '''CREATE INDEX IF NOT EXISTS index_{0}_tle_FIRST_GP_ID ON {0}_tle (FIRST_GP_ID)'''
+
+def has_store(con, table):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table + '_tle',)).fetchone() is not None
+
+# The rows (in COLUMNS order) whose GP_ID is not in the elset table yet, nor earlier in the rows.
+# Called before the rows are inserted into the elset table.
+def new_records(cur, table, rows):
+    rows = list(rows)
+    if len(rows) == 0:
+        return rows
+    gp_ids = [row[0] for row in rows]
+    seen = set()
+    for k in range(0, len(gp_ids), 500):
+        part = gp_ids[k:k + 500]
+        seen.update(x for x, in cur.execute('SELECT GP_ID FROM {} WHERE GP_ID IN ({})'.format(table, ','.join('?' * len(part))), part))
+    result = []
+    for row in rows:
+        if row[0] not in seen:
+            seen.add(row[0])
+            result.append(row)
+    return result
+
+def _encode_extra(fields):
+    classification_type, ephemeris_type, element_set_no, mean_motion_dot, mean_motion_ddot = fields
+    return '{} {} {} {!r} {!r}'.format(classification_type, int(ephemeris_type), int(element_set_no), float(mean_motion_dot), float(mean_motion_ddot))
+
+def _decode_extra(text):
+    classification_type, ephemeris_type, element_set_no, mean_motion_dot, mean_motion_ddot = text.split(' ')
+    return [classification_type, int(ephemeris_type), int(element_set_no), float(mean_motion_dot), float(mean_motion_ddot)]
+
+# Appends the TLE lines of new records to <table>_tle. The rows are in COLUMNS order.
+class TLEWriter:
+
+    def __init__(self, cur, table, block_size = BLOCK_SIZE, level = LEVEL):
+        self.cur = cur
+        self.table = table
+        self.block_size = block_size
+        self.level = level
+        cur.execute(create_table.format(table))
+        cur.execute(create_index.format(table))
+        self.pending = []
+        self.blocks = 0
+        self.records = 0
+        self.exact = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def write(self, rows):
+        nfields = len(tleformat.ELSET_COLUMNS)
+        for row in rows:
+            gp_id = int(row[0])
+            line0, line1, line2 = row[-3:]
+            if line1 is None or line2 is None:
+                continue
+            fields = list(row[1:-3])
+            if tleformat.is_exact(fields, line1, line2):
+                entry = (gp_id, line0, _encode_extra(fields[nfields:]), '', '')
+                self.exact += 1
+            else:
+                entry = (gp_id, line0, '', line1, line2)
+            self.pending.append(entry)
+            if len(self.pending) >= self.block_size:
+                self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.pending.sort(key = lambda entry: entry[0])
+        data = '\n'.join('{}\t{}\t{}\t{}\t{}'.format(gp_id, line0 if line0 is not None else '', extra, line1, line2)
+            for gp_id, line0, extra, line1, line2 in self.pending).encode('utf-8')
+        compressed = zlib.compress(data, self.level)
+        exact = sum(1 for entry in self.pending if entry[2] != '')
+        self.cur.execute('INSERT INTO {}_tle (FIRST_GP_ID, LAST_GP_ID, RECORDS, EXACT, DATA) VALUES (?,?,?,?,?)'.format(self.table),
+            (self.pending[0][0], self.pending[-1][0], len(self.pending), exact, compressed))
+        self.blocks += 1
+        self.records += len(self.pending)
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(compressed)
+        self.pending = []
+
+    # Returns the number of stored records
+    def close(self):
+        self.flush()
+        return self.records
+
+# Reads the TLE lines of the records of an elset table from <table>_tle
+class TLEReader:
+
+    def __init__(self, con, table, cache_blocks = CACHE_BLOCKS):
+        self.con = con
+        self.table = table
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+        rows = con.execute('SELECT BLOCK_ID, FIRST_GP_ID, LAST_GP_ID FROM {}_tle ORDER BY FIRST_GP_ID'.format(table)).fetchall()
+        self.block_ids = [row[0] for row in rows]
+        self.first = [row[1] for row in rows]
+        self.last = [row[2] for row in rows]
+        # Largest LAST_GP_ID of the blocks up to each block (the ranges of the blocks may overlap)
+        self.max_last = []
+        for last in self.last:
+            self.max_last.append(max(last, self.max_last[-1]) if len(self.max_last) > 0 else last)
+
+    def _block(self, block_id):
+        entries = self.cache.get(block_id)
+        if entries is not None:
+            self.cache.move_to_end(block_id)
+            return entries
+        data = self.con.execute('SELECT DATA FROM {}_tle WHERE BLOCK_ID = ?'.format(self.table), (block_id,)).fetchone()[0]
+        entries = {}
+        for line in zlib.decompress(data).decode('utf-8').split('\n'):
+            gp_id, line0, extra, line1, line2 = line.split('\t')
+            entries[int(gp_id)] = (line0 if line0 != '' else None, extra, line1, line2)
+        self.cache[block_id] = entries
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last = False)
+        return entries
+
+    def _entry(self, gp_id):
+        i = bisect.bisect_right(self.first, gp_id) - 1
+        while i >= 0 and self.max_last[i] >= gp_id:
+            if self.last[i] >= gp_id:
+                entry = self._block(self.block_ids[i]).get(gp_id)
+                if entry is not None:
+                    return entry
+            i -= 1
+        return None
+
+    # (TLE_LINE0, TLE_LINE1, TLE_LINE2) of each row (READ_COLUMNS of the elset table). (None, None, None) if not stored.
+    def lines(self, rows):
+        rows = list(rows)
+        result = [(None, None, None)] * len(rows)
+        # In GP_ID order, so that each block is decompressed once
+        for k in sorted(range(len(rows)), key = lambda k: rows[k][0]):
+            row = rows[k]
+            entry = self._entry(int(row[0]))
+            if entry is None:
+                continue
+            line0, extra, line1, line2 = entry
+            if extra != '':
+                line1, line2 = tleformat.format_tle(*(list(row[1:]) + _decode_extra(extra)))
+            result[k] = (line0, line1, line2)
+        return result
+
+    # Adds TLE_LINE0, TLE_LINE1 and TLE_LINE2 to a DataFrame with READ_COLUMNS (EPOCH as read from the table)
+    def add_lines(self, df, columns = TLE_COLUMNS):
+        lines = self.lines(zip(*(df[column].tolist() for column in READ_COLUMNS)))
+        for i, column in enumerate(TLE_COLUMNS):
+            if column in columns:
+                df[column] = [x[i] for x in lines]
+        return df
+
+# Stores the lines of a database of json2sqlite3.py -t. The OMM fields of line 1 are read from the lines.
+def import_lines(src, con, table, logger, batch_size = 100000):
+    cur = con.cursor()
+    writer = TLEWriter(cur, table)
+    # Records already in the store are skipped
+    stored = set()
+    if cur.execute('SELECT COUNT(*) FROM {}_tle'.format(table)).fetchone()[0] > 0:
+        reader = TLEReader(con, table)
+        for block_id in reader.block_ids:
+            stored.update(reader._block(block_id))
+            reader.cache.clear()
+    select = 'SELECT {}, TLE_LINE0, TLE_LINE1, TLE_LINE2 FROM {} ORDER BY GP_ID'.format(', '.join(READ_COLUMNS), table)
+    source = src.execute(select)
+    while True:
+        rows = source.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        batch = []
+        for row in rows:
+            if row[0] in stored or row[-2] is None:
+                continue
+            try:
+                extra = tleformat.parse_extra(row[-2])
+            except (ValueError, IndexError):
+                # Stored as it is
+                extra = [None] * len(tleformat.EXTRA_COLUMNS)
+            batch.append(list(row[:-3]) + extra + list(row[-3:]))
+        writer.write(batch)
+        logger.debug('{} records'.format(writer.records + len(writer.pending)))
+    writer.close()
+    return writer
+
+# Number of records whose stored lines differ from the lines of a database of json2sqlite3.py -t
+def verify_lines(src, con, table, logger, batch_size = 100000):
+    reader = TLEReader(con, table)
+    cur = con.cursor()
+    select = 'SELECT GP_ID, TLE_LINE0, TLE_LINE1, TLE_LINE2 FROM {} ORDER BY GP_ID'.format(table)
+    source = src.execute(select)
+    nrecords = 0
+    errors = 0
+    while True:
+        rows = source.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        gp_ids = [row[0] for row in rows]
+        elsets = {}
+        for k in range(0, len(gp_ids), 500):
+            part = gp_ids[k:k + 500]
+            for row in cur.execute('SELECT {} FROM {} WHERE GP_ID IN ({})'.format(', '.join(READ_COLUMNS), table, ','.join('?' * len(part))), part):
+                elsets[row[0]] = row
+        found = [row for row in rows if row[0] in elsets]
+        for row, lines in zip(found, reader.lines(elsets[row[0]] for row in found)):
+            if tuple(row[1:]) != lines:
+                errors += 1
+                logger.error('GP_ID {}: {} != {}'.format(row[0], lines, tuple(row[1:])))
+        nrecords += len(rows)
+        errors += len(rows) - len(found)
+    return nrecords, errors
+
+def main():
+    logger = setup_logger('tlestore')
+    metrics = get_metrics('tlestore')
+
+    parser = argparse.ArgumentParser(description='Store the TLE lines of an elset table in compressed blocks (TABLE_tle).')
+    parser.add_argument('DATABASE', type=str, help='SQLite3 database of elsets without TLE (json2sqlite3.py without -t).')
+    parser.add_argument('TABLE', type=str, nargs='?', default='elset', help='Table name. Default: elset')
+    parser.add_argument('-i', '--import_from', type=str, metavar='DATABASE', help='Store the lines of a database of json2sqlite3.py -t. Its elsets are also inserted into DATABASE.')
+    parser.add_argument('-v', '--verify', type=str, metavar='DATABASE', help='Compare the stored lines with a database of json2sqlite3.py -t byte for byte.')
+
+    args = parser.parse_args()
+
+    for dbfile in (args.import_from, args.verify):
+        if dbfile is not None and not os.path.isfile(dbfile):
+            logger.critical('error: {} not found'.format(dbfile))
+            sys.exit(1)
+
+    con = sqlite3.connect(args.DATABASE)
+    table = args.TABLE
+    exit_code = 0
+
+    if args.import_from is not None:
+        cur = con.cursor()
+        json2sqlite3.prepare_table(cur, table, False)
+        cur.execute("ATTACH DATABASE ? AS src", (args.import_from,))
+        # The elsets of the source (those already in DATABASE are kept), then their lines
+        columns = ', '.join(json2sqlite3.columns_out_without_tle)
+        cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM src.{0} WHERE GP_ID NOT IN (SELECT GP_ID FROM main.{0})'.format(table, columns))
+        logger.info('{} elsets inserted'.format(cur.rowcount))
+        con.commit()
+        cur.execute('DETACH DATABASE src')
+        with sqlite3.connect(args.import_from) as src, metrics.timer('import'):
+            writer = import_lines(src, con, table, logger)
+        con.commit()
+        logger.info('{} records stored ({} rebuilt from the elsets), {} bytes -> {} bytes'.format(
+            writer.records, writer.exact, writer.raw_bytes, writer.compressed_bytes))
+        metrics.inc('records', writer.records)
+        metrics.inc('exact', writer.exact)
+
+    if args.verify is not None:
+        with sqlite3.connect(args.verify) as src, metrics.timer('verify'):
+            nrecords, errors = verify_lines(src, con, table, logger)
+        logger.info('{} records verified, {} errors'.format(nrecords, errors))
+        metrics.inc('errors', errors)
+        if errors > 0:
+            exit_code = 1
+
+    if has_store(con, table):
+        blocks, records, exact, nbytes = con.execute('SELECT COUNT(*), SUM(RECORDS), SUM(EXACT), SUM(LENGTH(DATA)) FROM {}_tle'.format(table)).fetchone()
+        logger.info('{}_tle: {} blocks, {} records ({} rebuilt from the elsets), {} bytes'.format(table, blocks, records or 0, exact or 0, nbytes or 0))
+    else:
+        logger.info('{}: no table {}_tle'.format(args.DATABASE, table))
+    con.close()
+
+    sys.exit(exit_code)
+
+if __name__ == '__main__':
+    run('tlestore', main)
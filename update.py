@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import spacetrack.operators as op
+from spacetrack import SpaceTrackClient
+from datetime import datetime, timedelta
+from operator import itemgetter
+import io
+import os
+import sys
+import time
+import argparse
+import sqlite3
+from setup_logger import setup_logger
+from metrics import get_metrics, run
+from ratelimiter import RateLimiter
+from compressedfile import CODECS, CompressedWriter, compressed_filename
+from downloadpipeline import BufferWriter, TeeWriter
+from chunkplanner import RecordCounter
+from gpjson import parse_records, iter_batches, GP_CONVERTERS
+from gpdedup import Deduplicator
+import download_gp_date
+import download_satcat
+import json2sqlite3
+import elsetschema
+import satcat2sqlite3
+import tlestore
+import asofindex
+import responsecache
+import spacetrackaccount
+
+# Databases of update_cron.sh
+DATABASE = 'db/elset.sqlite3'
+DATABASE_WITH_TLE = 'db/elset_with_tle.sqlite3'
+SATCAT_DATABASE = 'db/satcat.sqlite3'
+
+# Days downloaded when the databases are empty
+NDAYS = 2
+
+# Inserts the rows into a table of json2sqlite3.py. The rows are committed by commit() after each request,
+# so that the database is not locked during the rate-limit waits and the downloads.
+# With tle_store, the TLE lines are stored in TABLE_tle as json2sqlite3.py -s does.
+class SQLiteSink:
+
+    def __init__(self, dbfile, table, with_tle, columns, logger = None, tle_store = False):
+        self.dbfile = dbfile
+        self.table = table
+        self.con = sqlite3.connect(dbfile)
+        self.cur = self.con.cursor()
+        clustered, self.compact, self.index_columns = json2sqlite3.prepare_table(self.cur, table, with_tle)
+        self.insert_record = json2sqlite3.insert_statement(table, with_tle, logger = logger)
+        self.columns_out = json2sqlite3.columns_out_with_tle if with_tle else json2sqlite3.columns_out_without_tle
+        # The rows have all the parsed columns, and each table takes its own
+        self.getter = itemgetter(*[columns.index(column) for column in self.columns_out])
+        # The as-of index is kept up to date if the database has it (json2sqlite3.py --asof)
+        self.asof = asofindex.has_index(self.con, table)
+        self.asof_getter = itemgetter(*[columns.index(column) for column in asofindex.COLUMNS])
+        self.tle = None
+        self.inserted = 0
+        if tle_store:
+            self.tle = tlestore.TLEWriter(self.cur, table)
+            self.tle_getter = itemgetter(*[columns.index(column) for column in tlestore.COLUMNS])
+        self.con.commit()
+
+    def write(self, rows):
+        if self.tle is not None:
+            # Before the rows are inserted, so that only the new records are stored
+            self.tle.write(tlestore.new_records(self.cur, self.table, [self.tle_getter(row) for row in rows]))
+        if self.asof:
+            keys = map(self.asof_getter, rows)
+            asofindex.update(self.cur, self.table, elsetschema.compact_rows(keys, asofindex.COLUMNS) if self.compact else keys)
+        rows = map(self.getter, rows)
+        if self.compact:
+            rows = elsetschema.compact_rows(rows, self.columns_out)
+        self.cur.executemany(self.insert_record, rows)
+        # Only the elset table (not TABLE_tle or TABLE_asof)
+        self.inserted += self.cur.rowcount
+
+    # The TLE lines pending in the TLEWriter are stored with their records,
+    # as tlestore.new_records() skips the records already in the table
+    def commit(self):
+        if self.tle is not None:
+            self.tle.flush()
+        self.con.commit()
+
+    # Returns the number of inserted records
+    def close(self):
+        for column in self.index_columns:
+            self.cur.execute('CREATE INDEX IF NOT EXISTS index_{0}_{1} ON {0} ({1})'.format(self.table, column))
+        if self.tle is not None:
+            self.tle.close()
+        self.con.commit()
+        self.con.close()
+        return self.inserted
+
+# Appends the rows to a Parquet dataset partitioned by json2parquet.py -p, as new files of this run.
+# Records already in the dataset (e.g. in the overlap of incremental downloads) are skipped.
+class ParquetSink:
+
+    def __init__(self, directory, compression = 'zstd'):
+        # Imported here, as pandas and pyarrow take a while and most runs don't need them
+        import json2parquet
+        self.json2parquet = json2parquet
+        self.dedup = Deduplicator()
+        if os.path.isdir(directory):
+            import pyarrow.dataset as ds
+            for batch in ds.dataset(directory, format = 'parquet', partitioning = 'hive').to_batches(columns = ['GP_ID']):
+                self.dedup.seed(batch.column(0).to_numpy(zero_copy_only = False))
+        basename = 'part-{:%Y%m%d%H%M%S}.parquet'.format(datetime.utcnow())
+        self.writer = json2parquet.PartitionedWriter(directory, compression, basename = basename)
+        self.inserted = 0
+
+    def write(self, rows):
+        table = self.json2parquet.rows_to_table(rows)
+        mask = self.dedup.filter(self.writer.directory, table.column('GP_ID').to_numpy())
+        if not mask.all():
+            import pyarrow as pa
+            table = table.filter(pa.array(mask))
+        if table.num_rows > 0:
+            self.writer.write(table)
+            self.inserted += table.num_rows
+
+    def close(self):
+        self.writer.close()
+        return self.inserted
+
+def has_tle_store(dbfile, table):
+    if not os.path.isfile(dbfile):
+        return False
+    con = sqlite3.connect(dbfile)
+    try:
+        return tlestore.has_store(con, table)
+    finally:
+        con.close()
+
+# Requests of this run: the records created after the watermark of the databases (minus the overlap),
+# or those created in the last `ndays` days if a database has no watermark.
+# Returns a list of (CREATION_DATE predicate, name of the archive file), and the oldest watermark
+def plan_requests(dbfiles, table, ndays, overlap, logger):
+    marks = [download_gp_date.load_watermark(dbfile, table) for dbfile in dbfiles]
+    for dbfile, mark in zip(dbfiles, marks):
+        logger.info('Watermark of {}: {}'.format(dbfile, mark))
+    now = datetime.utcnow()
+
+    if len(marks) > 0 and None not in marks:
+        since = min(marks) - timedelta(hours = overlap)
+        logger.info('Since: {}'.format(since.strftime('%Y-%m-%d %H:%M:%S')))
+        return [(op.greater_than(since.strftime('%Y-%m-%d %H:%M:%S')), 'download/delta-{:%Y%m%d%H%M%S}.json'.format(now))], min(marks)
+
+    requests = []
+    today = datetime(now.year, now.month, now.day)
+    for i in range(ndays):
+        day = today - timedelta(days = ndays - 1 - i)
+        requests.append((op.inclusive_range(day.strftime('%Y-%m-%d'), (day + timedelta(days = 1)).strftime('%Y-%m-%d')),
+            'download/{:%Y%m%d}.json'.format(day)))
+    return requests, None
+
+def main():
+    logger = setup_logger('update')
+    metrics = get_metrics('update')
+
+    parser = argparse.ArgumentParser(description='Download new GP and SATCAT data and store them into the databases in one process (replaces update_cron.sh).')
+    parser.add_argument('-d', '--database', type=str, action='append', help='SQLite3 database of elsets without TLE. Can be specified more than once. Default: {} (if neither -d nor -t is specified)'.format(DATABASE))
+    parser.add_argument('-t', '--with_tle', type=str, action='append', metavar='DATABASE', help='SQLite3 database of elsets with TLE lines. Can be specified more than once. Default: {} (if neither -d nor -t is specified)'.format(DATABASE_WITH_TLE))
+    parser.add_argument('--tle_store', action='store_true', help='Store TLE lines in TABLE_tle of the -d databases (see tlestore.py), instead of a database of -t. Without -d and -t, only {} is updated.'.format(DATABASE))
+    parser.add_argument('--table', type=str, default='elset', help='Table name of the elset databases. Default: elset')
+    parser.add_argument('-p', '--parquet', type=str, metavar='DIRECTORY', help='Also append the records to a Parquet dataset partitioned by json2parquet.py -p.')
+    parser.add_argument('-a', '--archive', action='store_true', help='Also save the responses to download/ as download_gp_date.py and download_satcat.py do.')
+    parser.add_argument('-z', '--codec', type=str, choices=list(CODECS), default='xz', help='Compression codec of the archive files. Default: xz')
+    parser.add_argument('-l', '--level', type=int, help='Compression level of the archive files. Default: 9 (xz, xz-mt), 19 (zstd)')
+    parser.add_argument('-s', '--satcat', type=str, default=SATCAT_DATABASE, help='SQLite3 database of SATCAT (updated with satcat2sqlite3.py -u). Default: {}'.format(SATCAT_DATABASE))
+    parser.add_argument('-n', '--no_satcat', action='store_true', help="Don't download SATCAT.")
+    parser.add_argument('--days', type=int, default=NDAYS, help='Days downloaded when the databases are empty. Default: {}'.format(NDAYS))
+    parser.add_argument('--overlap', type=float, default=download_gp_date.OVERLAP, help='Overlap of incremental download (hours). Default: {}'.format(download_gp_date.OVERLAP))
+    parser.add_argument('-b', '--batch_size', type=int, default=10000, help='Number of records converted and inserted at once. Default: 10000')
+    responsecache.add_arguments(parser)
+    args = parser.parse_args()
+    if args.offline and args.no_cache:
+        parser.error('--offline requires the response cache')
+
+    databases = args.database or []
+    databases_with_tle = args.with_tle or []
+    if len(databases) == 0 and len(databases_with_tle) == 0:
+        databases = [DATABASE]
+        # With --tle_store, the TLE lines are stored in DATABASE instead of DATABASE_WITH_TLE
+        databases_with_tle = [] if args.tle_store else [DATABASE_WITH_TLE]
+        if args.tle_store and os.path.isfile(DATABASE_WITH_TLE) and not has_tle_store(DATABASE, args.table):
+            # Otherwise the lines of the records downloaded so far would be missing
+            logger.critical('error: Import the TLE lines of {0} first: ./tlestore.py -i {0} {1}'.format(DATABASE_WITH_TLE, DATABASE))
+            sys.exit(1)
+
+    # The watermark is read before the sinks create the tables
+    requests, mark = plan_requests(databases + databases_with_tle, args.table, args.days, args.overlap, logger)
+    if mark is not None:
+        metrics.set('watermark_lag_seconds', (datetime.utcnow() - mark).total_seconds())
+
+    # Each record is parsed once, into the columns of all the sinks
+    columns = list(GP_CONVERTERS) if args.parquet is not None else json2sqlite3.columns_out_with_tle
+    if args.tle_store:
+        columns = columns + [column for column in tlestore.COLUMNS if column not in columns]
+    sinks = [SQLiteSink(dbfile, args.table, False, columns, logger, args.tle_store) for dbfile in databases]
+    sinks += [SQLiteSink(dbfile, args.table, True, columns, logger) for dbfile in databases_with_tle]
+    if args.parquet is not None:
+        sinks.append(ParquetSink(args.parquet))
+
+    os.makedirs('download', exist_ok = True)
+    st = SpaceTrackClient(spacetrackaccount.userid, spacetrackaccount.password)
+    limiter = RateLimiter(logger = logger)
+    cache = responsecache.from_arguments(args, logger)
+
+    starttime = time.monotonic()
+    error_count = 0
+    nrecords = 0
+    nbytes = 0
+
+    for epoch, filename in requests:
+        logger.info('Downloading CREATION_DATE {}'.format(epoch))
+        buffer = BufferWriter()
+        writer = buffer
+        archive = None
+        if args.archive:
+            archive = CompressedWriter(compressed_filename(filename, args.codec), codec = args.codec, level = args.level, logger = logger)
+            writer = TeeWriter(buffer, archive)
+        counter = RecordCounter()
+        try:
+            downloaded = download_gp_date.getdata(st, epoch, writer, counter, date_type = 'CREATION_DATE', limiter = limiter, logger = logger, metrics = metrics, cache = cache)
+        except OSError as e:
+            # The response can't be written (e.g. disk full). Handled as a failed request, and the sinks are still committed
+            logger.error(str(e))
+            downloaded = False
+        if not downloaded:
+            writer.abort()
+            logger.error('Error: Fail to download data for CREATION_DATE {}'.format(epoch))
+            error_count += 1
+            # The later requests are not stored, so that the watermark doesn't pass the missing records
+            break
+        if archive is not None:
+            try:
+                archive.commit()
+                metrics.inc('compressed_bytes', archive.compressed_bytes)
+                metrics.observe('compress', archive.elapsed)
+            except OSError as e:
+                # The records are stored anyway
+                archive.abort()
+                logger.error(str(e))
+                logger.error('Error: Fail to save {}'.format(archive.filename))
+                error_count += 1
+
+        with metrics.timer('parse'):
+            records = parse_records(b''.join(buffer.chunks))
+        logger.debug('{} records'.format(len(records)))
+        nrecords += len(records)
+        nbytes += buffer.raw_bytes
+        for batch in iter_batches(records, columns, args.batch_size):
+            for sink in sinks:
+                sink.write(batch)
+        # The watermark is derived from the stored records, so a run stopped later resumes after this window
+        with metrics.timer('commit'):
+            for sink in sinks:
+                if isinstance(sink, SQLiteSink):
+                    sink.commit()
+
+    with metrics.timer('commit'):
+        for sink in sinks:
+            inserted = sink.close()
+            name = sink.dbfile if isinstance(sink, SQLiteSink) else args.parquet
+            logger.info('{}: {} records inserted'.format(name, inserted))
+            metrics.inc('records_inserted', inserted, database = os.path.splitext(os.path.basename(name))[0])
+    logger.info('{} records, {} bytes in {:.1f} sec'.format(nrecords, nbytes, time.monotonic() - starttime))
+    metrics.inc('records', nrecords)
+    metrics.inc('bytes', nbytes)
+
+    if not args.no_satcat:
+        # Recorded as a run of satcat2sqlite3.py, as before
+        satcat_metrics = get_metrics('satcat2sqlite3')
+        buffer = BufferWriter()
+        writer = buffer
+        archive = None
+        if args.archive:
+            archive = CompressedWriter(compressed_filename('download/satcat_latest.json', args.codec), codec = args.codec, level = args.level, logger = logger)
+            writer = TeeWriter(buffer, archive)
+        logger.info('Downloading SATCAT')
+        try:
+            downloaded = download_satcat.getdata(st, writer, None, limiter = limiter, logger = logger, metrics = metrics, cache = cache)
+        except OSError as e:
+            logger.error(str(e))
+            downloaded = False
+        if not downloaded:
+            writer.abort()
+            logger.error('Error: Fail to download SATCAT')
+            error_count += 1
+        else:
+            if archive is not None:
+                try:
+                    archive.commit()
+                except OSError as e:
+                    archive.abort()
+                    logger.error(str(e))
+                    error_count += 1
+            rows = satcat2sqlite3.read_satcat(io.BytesIO(b''.join(buffer.chunks)))
+            if len(rows) == 0:
+                logger.error('error: No valid data in SATCAT')
+                error_count += 1
+            else:
+                satcat2sqlite3.store_satcat(rows, args.satcat, 'satcat', True, logger, satcat_metrics)
+                satcat_metrics.write(0)
+
+    if error_count > 0:
+        logger.error("The number of errors is {}".format(error_count))
+    metrics.inc('errors', error_count)
+    sys.exit(0 if error_count == 0 else 1)
+
+if __name__ == '__main__':
+    run('update', main)